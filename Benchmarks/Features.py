@@ -0,0 +1,89 @@
+"""Times extracting light curve features from a grid and querying its feature index, checked against brute force
+
+Run from the repository root: python Benchmarks/Features.py [models] [queries]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from MesaStella.StellaOutput import ReadLightCurve
+from MesaStella.LightCurveGrid import Resample
+from MesaStella.FeatureIndex import FeatureIndex
+from MesaStella import Features
+
+models = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+queries = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+sample = ReadLightCurve("ModelGrids/000_Source_12M/PostCC/stella/test/mesa.tt")
+
+# A fake grid: the sample light curve, stretched in time and shifted in brightness for every model
+step = 0.5
+bands = ["Mbol", "MU", "MB", "MV", "MR", "MI"]
+times = np.arange(0, 150, step)
+base = Resample(sample, bands, np.arange(0, 200, step))
+rng = np.random.default_rng(1)
+stretches = rng.uniform(0.7, 1.3, models)
+offsets = rng.normal(0, 0.5, models)
+data = np.empty((models, len(times), len(bands)), dtype=np.float32)
+for j in range(len(bands)):
+    for m in range(models):
+        data[m, :, j] = np.interp(times / stretches[m], np.arange(0, 200, step), base[:, j]) + offsets[m]
+
+start = time.perf_counter()
+features = {}
+for first in range(0, models, 1024):
+    for name, values in Features.Extract(times, data[first:first + 1024], bands).items():
+        features.setdefault(name, []).append(values)
+features = {name: np.concatenate(values) for name, values in features.items()}
+elapsed = time.perf_counter() - start
+print(f"Extracted {len(features)} features of {models} models x {len(bands)} bands in {elapsed:.2f} s ({models / elapsed:.0f} models/s)")
+
+with tempfile.TemporaryDirectory() as tmp:
+    index = FeatureIndex(tmp)
+    start = time.perf_counter()
+    index.AppendMany([(f"model{m}", {"stretch": float(stretches[m]), "offset": float(offsets[m])},
+                       {name: values[m] for name, values in features.items()}) for m in range(models)])
+    print(f"Wrote the table in {time.perf_counter() - start:.2f} s, {os.path.getsize(index.path) / 1e6:.1f} MB")
+
+    names = ["MV_peak", "MV_rise", "MV_dm15"]
+    table = np.column_stack([features[name] for name in names])
+    complete = np.isfinite(table).all(axis=1)
+    start = time.perf_counter()
+    index.Nearest(dict(zip(names, table[0])), 1)
+    print(f"Read the table and built the tree over {complete.sum()} models in {time.perf_counter() - start:.2f} s")
+
+    scale = table[complete].std(axis=0)
+    targets = table[complete][rng.integers(0, complete.sum(), queries)] + rng.normal(0, 0.1, (queries, len(names))) * scale
+    start = time.perf_counter()
+    found = [index.Nearest(dict(zip(names, target)), 5) for target in targets]
+    elapsed = time.perf_counter() - start
+    wrong = 0
+    for target, matches in zip(targets, found):
+        distances = np.sqrt((((table - target) / scale)**2).sum(axis=1))
+        wrong += not np.allclose(np.sort(distances[complete])[:5], [match["distance"] for match in matches])
+    print(f"  5 nearest: {elapsed / queries * 1e6:.0f} us per query, {wrong} of {queries} differ from brute force")
+
+    start = time.perf_counter()
+    found = [index.Range(MV_peak=(target[0] - 0.2, target[0] + 0.2), MV_rise=(None, target[1])) for target in targets]
+    elapsed = time.perf_counter() - start
+    # Each match's dict is only made when it's looked at, which is most of the cost of using them all
+    start = time.perf_counter()
+    for matches in found:
+        list(matches)
+    reading = time.perf_counter() - start
+    wrong = 0
+    for target, matches in zip(targets, found):
+        inside = complete & (np.abs(table[:, 0] - target[0]) <= 0.2) & (table[:, 1] <= target[1])
+        wrong += sorted(f"model{m}" for m in np.flatnonzero(inside)) != sorted(match["dirname"] for match in matches)
+    print(f"  Range: {elapsed / queries * 1e6:.0f} us per query, {np.mean([len(m) for m in found]):.0f} matches on average, "
+          f"{wrong} of {queries} differ from brute force; reading every match as a dict takes {reading / queries * 1e6:.0f} us more")
+
+    # Models added one at a time, as sims finish, are searched without the tree until there are enough to rebuild it
+    start = time.perf_counter()
+    for m in range(200):
+        index.Append(f"late{m}", {}, {name: values[m] for name, values in features.items()})
+        index.Nearest(dict(zip(names, table[m])), 5)
+    print(f"  Appending a model and querying: {(time.perf_counter() - start) / 200 * 1e3:.2f} ms each")
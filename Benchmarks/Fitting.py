@@ -0,0 +1,72 @@
+"""Times fitting a whole grid against observed photometry, and checks it finds the model the data came from
+
+Run from the repository root: python Benchmarks/Fitting.py [models] [points] [shifts] [workers]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from MesaStella.StellaOutput import ReadLightCurve
+from MesaStella import Fitting, Photometry
+
+models = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+points = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+nshifts = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+sample = ReadLightCurve("ModelGrids/000_Source_12M/PostCC/stella/test/mesa.tt")
+
+with tempfile.TemporaryDirectory() as tmp:
+    # A fake grid: the sample light curve, stretched in time and with its colour changed a little for every model
+    step = 0.5
+    modeltimes, first = np.unique(sample["time"], return_index=True)
+    times = np.arange(0, 150, step)
+    bands = ["MU", "MB", "MV", "MR", "MI"]
+    rng = np.random.default_rng(1)
+    offsets = rng.normal(0, 0.05, models)
+    stretches = rng.uniform(0.8, 1.2, models)
+    data = np.lib.format.open_memmap(os.path.join(tmp, "lightcurves.npy"), mode="w+", dtype=np.float32,
+                                     shape=(models, len(times), len(bands)))
+    for j, band in enumerate(bands):
+        curve = sample[band][first]
+        for m in range(models):
+            data[m, :, j] = np.interp(times / stretches[m], modeltimes, curve, left=np.nan, right=np.nan) + offsets[m] * j
+    data.flush()
+    del data
+    params = np.zeros(models, dtype=[("dirname", "U16"), ("offset", np.float64), ("stretch", np.float64)])
+    params["dirname"] = [f"model{m}" for m in range(models)]
+    params["offset"], params["stretch"] = offsets, stretches
+    np.save(os.path.join(tmp, "params.npy"), params)
+    np.save(os.path.join(tmp, "times.npy"), times)
+    with open(os.path.join(tmp, "meta.json"), "w") as file:
+        json.dump({"bands": bands, "step": step, "models": models}, file)
+
+    # Observations of one model in the bands of SN 2019hnl, at a known distance, extinction and explosion date
+    truth, mu, ebv, explosion = models // 3, 34.5, 0.2, 2458640.0
+    names = ["g", "r", "i", "ATLAS_c", "ATLAS_o", "B", "V", "U"]
+    band = rng.integers(0, len(names), points)
+    phase = np.sort(rng.uniform(3, 80, points))
+    err = rng.uniform(0.02, 0.15, points)
+    converted = Photometry.Convert({name: np.asarray(np.load(os.path.join(tmp, "lightcurves.npy"), mmap_mode="r")[truth, :, j])
+                                    for j, name in enumerate(bands)}, names, np.float64)
+    R = np.array([Photometry.Extinction[names[b]] for b in band])
+    mags = np.array([np.interp(p, times, converted[names[b]]) for p, b in zip(phase, band)]) + mu + R * ebv + rng.normal(0, err)
+    obs = {"name": "fake", "bands": names, "band": band, "jd": explosion + phase, "mag": mags,
+           "weight": 1 / err**2, "extinction": R}
+    shifts = np.linspace(0, 10, nshifts)
+
+    start = time.perf_counter()
+    ranked = Fitting.Fit(tmp, obs, shifts, workers=workers)
+    elapsed = time.perf_counter() - start
+
+best = ranked.iloc[0]
+print(f"{models} models x {points} points x {nshifts} shifts, {workers} worker(s): {elapsed:.2f} s "
+      f"({models * points * nshifts / elapsed / 1e6:.0f}M evaluations/s)")
+print(f"  best: {best['dirname']} (truth model{truth}), shift {best['shift']:.2f} d (truth {phase[0]:.2f}), "
+      f"mu {best['mu']:.3f} (truth {mu}), E(B-V) {best['ebv']:.3f} (truth {ebv}), reduced chi2 {best['redchi2']:.2f}")
+rank = ranked.index[ranked["dirname"] == f"model{truth}"][0]
+print(f"  model{truth} ranks {rank}, at a stretch {ranked['stretch'][rank]:.4f} against the best's {best['stretch']:.4f}")
@@ -0,0 +1,313 @@
+"""Runs MesaStellaCore.py end to end on stand-ins for MESA and Stella, to time the orchestration around the physics
+
+Everything the core does is real: rendering, materializing, the build cache, rn and its do_one parts, checkpoint
+branching, the scheduler, logging and export.  Only star and Stella's executables are replaced, by scripts that
+print output like theirs, sleep (or burn a core with --burn) and write fake models and a copy of the template's
+sample mesa.tt.  Each size runs in a fresh sandbox, so runs repeat; --json saves the numbers and --baseline
+compares against saved ones.  With --workers the grid runs through the shared work queue, with a coordinator and
+that many local workers splitting the cores.
+
+Run from the repository root: python Benchmarks/Orchestrator.py [rows ...] [options]
+"""
+import argparse
+import gzip
+import itertools
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+Repo = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+Templates = ["000_Source_12M", "000_Source_20M"]
+
+# Stands in for MESA's star: finds the model the part saves, prints steps the way MESA does, and writes the model
+Star = r"""#!/bin/bash
+model=""
+for file in inlist $(grep -ho "extra_[A-Za-z_]*inlist_name([0-9]*) *= *'[^']*'" inlist | sed "s/.*'\(.*\)'/\1/" | sort -u); do
+    found=$(grep -ho "^[^!]*save_model_filename *= *'[^']*'" "$file" 2>/dev/null | sed "s/.*'\(.*\)'/\1/" | tail -1)
+    [ -n "$found" ] && model=$found
+done
+if [ -z "$model" ]; then
+    echo "stub star: no save_model_filename in inlist"
+    exit 1
+fi
+for ((step = 1; step <= STUB_STEPS; step++)); do
+    printf ' %7d   4.123456   5.234567   1.345678  -2.456789   0.567890  11.678901   0.123456   0.234567   1.000000\n' $step
+    printf '  -3.456789   2.345678   1.234567   0.987654   0.876543   0.765432   0.654321\n'
+    printf '   1.234567E+%02d   0.345678   0.456789   0.567890   0.678901   0.789012   0.890123\n\n' $((step % 10))
+done
+if [ -n "$STUB_BURN" ]; then timeout "$STUB_SECONDS" bash -c 'while :; do :; done'; else sleep "$STUB_SECONDS"; fi
+head -c "$STUB_MODEL_BYTES" /dev/zero > "$model"
+# run_star_extras writes Stella's inputs at the end of the last part
+if [ "$model" = "shock_part5.mod" ]; then
+    head -c 200000 /dev/zero > mesa.hyd
+    head -c 100000 /dev/zero > mesa.abn
+fi
+echo "termination code: stub"
+"""
+
+# MESA's do_one, which rn gets from star/test_suite/test_suite_helpers
+Helpers = r"""function do_one {
+    cp "$1" inlist || exit 1
+    if [ -n "$3" ]; then
+        rm -rf "$3"
+    fi
+    echo 'run' "$1"
+    ./rn1 || exit 1
+    if [ ! -r "$2" ]; then
+        echo "failed to create $2 when running $1"
+        exit 1
+    fi
+    echo
+    echo 'finished' "$1"
+}
+"""
+
+# Stands in for each of Stella's executables, by name
+Stella = r"""#!/bin/bash
+if [ "$1" = "strad" ]; then
+    for ((step = 1; step <= STUB_STELLA_STEPS; step++)); do
+        printf ' t = %d.%02d  NSTEP= %d  HNOW= 1.2345E-02  TAU= 3.4567E+01  LBOL= 4.2  MBOL= -16.5\n' $((step / 100)) $((step % 100)) $step
+    done
+    if [ -n "$STUB_BURN" ]; then timeout "$STUB_STELLA_SECONDS" bash -c 'while :; do :; done'; else sleep "$STUB_STELLA_SECONDS"; fi
+    cp "$STUB_TT" ../../res/mesa.tt
+else
+    echo "stub $1"
+fi
+"""
+
+# Build steps that install the stand-ins instead of compiling
+Mk = '#!/bin/bash\ncp "$STUB_DIR/star" star && chmod +x star\n'
+StellaMakefile = "clean:\n\t@true\n" + "".join(
+    f"{target}:\n\t@printf '#!/bin/bash\\nexec \"$$STUB_DIR/stella\" {name}\\n' > {path} && chmod +x {path}\n"
+    for target, name, path in [("eve2", "eve2", "../eve/run/eve2.exe"), ("ronfict", "ronfict", "../vladsf/xronfict.exe"),
+                               ("stella6_mesa", "strad", "../strad/run/xstella6_mesa.exe")])
+ExtrasMakefile = "stella_extras:\n\t@printf '#!/bin/bash\\nexec \"$$STUB_DIR/stella\" extras\\n' > stella_extras && chmod +x stella_extras\n"
+
+def Rows(count, seed=1):
+    """count distinct simlist rows spread over five progenitors, the same ones every time"""
+    grid = list(itertools.product([11.0, 12.0, 15.0, 20.0, 25.0], [0.5, 1.0, 1.5, 2.0, 3.0], [0.02, 0.04, 0.06, 0.08, 0.1],
+                                  [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3], [1, 2, 4, 8, 12, 16, 24, 32, 48, 64]))
+    if count > len(grid):
+        raise ValueError(f"At most {len(grid)} distinct rows")
+    picked = np.random.default_rng(seed).permutation(len(grid))[:count]
+    rows = [grid[i] for i in sorted(picked)]
+    return pd.DataFrame({
+        "mass": [row[0] for row in rows], "windscalar": 1.7, "metallicity": 0.0142, "hefrac": 0.2703,
+        "energy": [row[1] for row in rows], "ni56": [row[2] for row in rows], "csmvelo": 20,
+        "csmrate": [row[3] for row in rows], "csmtime": [row[4] for row in rows], "gridtag": "Benchmark",
+    })
+
+def Sandbox(root, rows, args):
+    """Sets up a copy of the repository's layout in root with stubbed templates; returns the environment to run in"""
+    griddir = os.path.join(root, "mesa-24.08.1", "ModelGrids")
+    os.makedirs(os.path.join(root, "mesa-24.08.1", "star", "test_suite"))
+    os.makedirs(os.path.join(root, "mesasdk", "bin"))
+    os.makedirs(os.path.join(root, "InputFiles"))
+    os.makedirs(os.path.join(root, "stubs"))
+    # A copy rather than a link, since the core finds its directories from where it lives
+    shutil.copy(os.path.join(Repo, "MesaStellaCore.py"), root)
+    os.symlink(os.path.join(Repo, "MesaStella"), os.path.join(root, "MesaStella"))
+    for template in Templates:
+        src = os.path.join(Repo, "ModelGrids", template)
+        dst = os.path.join(griddir, template)
+        shutil.copytree(src, dst, symlinks=True)
+        for path, text in [("PreCC/mk", Mk), ("PostCC/mk", Mk), ("PostCC/stella/obj/f90StellaGF.mak", StellaMakefile),
+                           ("PostCC/stella/res/makefile", ExtrasMakefile)]:
+            with open(os.path.join(dst, path), "w") as file:
+                file.write(text)
+
+    files = {
+        "mesa-24.08.1/star/test_suite/test_suite_helpers": Helpers,
+        "mesasdk/bin/mesasdk_init.sh": "",
+        "stubs/star": Star,
+        "stubs/stella": Stella,
+        "SetupConfig.cfg": (
+            f"[MAIN]\nUser = benchmark\nMesaSDK_Dir = {root}/mesasdk\nNumThreads = {args.threads}\nTimeoutTime = 3600\nSimlistName = simlist.csv\n"
+            f"[SCHEDULER]\nCoreBudget = {args.cores}\n[RETRY]\nMaxAttempts = 1\n[FIT]\nPhotometry =\n[EMULATOR]\nBuild = no\n[REFINE]\nEnabled = no\n"
+            + f"[RETENTION]\nPolicy = {args.retention}\n"
+            + (f"[SCRATCH]\nDir = {root}/scratch\nMaxGB = {args.scratch_gb}\nSimGB = {args.scratch_gb / 4}\n" if args.scratch_gb else "")
+        ),
+    }
+    for relpath, text in files.items():
+        with open(os.path.join(root, relpath), "w") as file:
+            file.write(text)
+        os.chmod(os.path.join(root, relpath), 0o755)
+    Rows(rows).to_csv(os.path.join(root, "InputFiles", "simlist.csv"))
+
+    return dict(os.environ, STUB_DIR=os.path.join(root, "stubs"), STUB_STEPS=str(args.mesa_steps), STUB_SECONDS=str(args.mesa_seconds),
+                STUB_MODEL_BYTES=str(args.model_kb * 1024), STUB_STELLA_STEPS=str(args.stella_steps),
+                STUB_STELLA_SECONDS=str(args.stella_seconds), STUB_BURN="1" if args.burn else "",
+                STUB_TT=os.path.join(Repo, "ModelGrids", Templates[0], "PostCC/stella/test/mesa.tt"))
+
+def Stamp(line):
+    return datetime.strptime(line[:23], "%Y-%m-%d %H:%M:%S,%f").timestamp()
+
+def Summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return {"mean": float("nan"), "p95": float("nan")}
+    return {"mean": float(values.mean()), "p95": float(np.percentile(values, 95))}
+
+def Measure(root, rows, args, wall):
+    """Reads the run's logs and manifest back into the numbers the benchmark reports"""
+    marks = {}
+    written, shared = [], []
+    # The coordinator's log, then any workers'
+    logs = [os.path.join(root, "Logs", "Latest.log")]
+    if os.path.isdir(os.path.join(root, "Logs", "Workers")):
+        logs += [os.path.join(root, "Logs", "Workers", name, "Latest.log") for name in sorted(os.listdir(os.path.join(root, "Logs", "Workers")))]
+    for path in logs:
+        with open(path) as file:
+            for line in file:
+                # Leaves out the continuation lines of messages like the run summary
+                if not re.match(r"\d{4}-\d\d-\d\d ", line):
+                    continue
+                if path == logs[0]:
+                    marks.setdefault("start", Stamp(line))
+                    for key, text in [("planned", "------------- "), ("scheduled", " finished: {"), ("finished", "Finished simulations")]:
+                        if text in line and (key != "planned" or "planned" not in marks):
+                            marks[key] = Stamp(line)
+                match = re.search(r"Materialized .*; ([\d.]+) MB written, ([\d.]+) MB shared", line)
+                if match:
+                    written.append(float(match.group(1)))
+                    shared.append(float(match.group(2)))
+
+    started, stages = {}, {}
+    with open(os.path.join(root, "mesa-24.08.1", "ModelGrids", "Manifest.jsonl")) as file:
+        for line in file:
+            record = json.loads(line)
+            key = (record["sim"], record["stage"])
+            if record["event"] == "started":
+                started[key] = record["time"]
+            elif key in started:
+                stages.setdefault(record["sim"], {})[record["stage"]] = (started[key], record["time"])
+
+    cores = {"PreCC": args.threads, "PostCC": args.threads}
+    durations = {}
+    busy = 0.0
+    waits = []
+    for sim, runs in stages.items():
+        for stage, (start, stop) in runs.items():
+            durations.setdefault(stage, []).append(stop - start)
+            busy += min(cores.get(stage, 1), args.cores) * (stop - start)
+        ordered = sorted(runs.values())
+        waits += [later[0] - earlier[1] for earlier, later in zip(ordered, ordered[1:])]
+    span = marks.get("scheduled", marks["start"]) - marks.get("planned", marks["start"])
+
+    logbytes = 0
+    for dirpath, _, filenames in os.walk(os.path.join(root, "Logs", "Sims")):
+        for name in filenames:
+            with gzip.open(os.path.join(dirpath, name), "rb") as file:
+                logbytes += sum(len(chunk) for chunk in iter(lambda: file.read(1 << 20), b""))
+    running = sum(sum(durations.get(stage, [])) for stage in ("PreCC", "PostCC", "Stella"))
+
+    return {
+        "rows": rows,
+        "finished": len(durations.get("ExportData", [])),
+        "wall_s": wall,
+        "setup_s": marks.get("planned", marks["start"]) - marks["start"],
+        "scheduler_s": span,
+        "grids_s": marks.get("finished", marks["start"]) - marks.get("scheduled", marks["start"]),
+        "createsim_ms": {key: value * 1e3 for key, value in Summary(durations.get("CreateSim", [])).items()},
+        "written_mb_per_sim": float(np.mean(written)) if written else float("nan"),
+        "shared_mb_per_sim": float(np.mean(shared)) if shared else float("nan"),
+        "idle_fraction": 1 - busy / (args.cores * span) if span > 0 else float("nan"),
+        "wait_between_stages_s": Summary(waits),
+        "log_mb": logbytes / 1024**2,
+        "log_mb_per_s": logbytes / 1024**2 / running if running else float("nan"),
+        "export_ms": {key: value * 1e3 for key, value in Summary(durations.get("ExportData", [])).items()},
+        "stage_s": {stage: Summary(values) for stage, values in durations.items()},
+    }
+
+def Flatten(result, prefix=""):
+    out = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            out.update(Flatten(value, f"{prefix}{key}."))
+        else:
+            out[f"{prefix}{key}"] = value
+    return out
+
+def Report(result, baseline=None):
+    print(f"{result['rows']} rows: {result['finished']} exported in {result['wall_s']:.1f} s "
+          f"(setup {result['setup_s']:.2f} s, scheduler {result['scheduler_s']:.1f} s, grids {result['grids_s']:.2f} s)")
+    previous = Flatten(baseline) if baseline else {}
+    for key, value in Flatten(result).items():
+        if key in ("rows", "finished") or not isinstance(value, float):
+            continue
+        line = f"  {key:32s} {value:12.4f}"
+        if previous.get(key):
+            line += f"   {value / previous[key]:6.2f}x baseline"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rows", nargs="*", type=int, default=[10, 100])
+    parser.add_argument("--cores", type=int, default=16, help="CoreBudget of the run")
+    parser.add_argument("--threads", type=int, default=1, help="NumThreads, the cores each MESA stage takes")
+    parser.add_argument("--mesa-seconds", type=float, default=0.05, help="Time each MESA part takes")
+    parser.add_argument("--mesa-steps", type=int, default=200, help="Steps each MESA part prints, four lines each")
+    parser.add_argument("--stella-seconds", type=float, default=0.2)
+    parser.add_argument("--stella-steps", type=int, default=2000, help="Lines strad prints")
+    parser.add_argument("--model-kb", type=int, default=1024, help="Size of each fake model")
+    parser.add_argument("--burn", action="store_true", help="Burn CPU for the stand-ins' time instead of sleeping")
+    parser.add_argument("--retention", default="keep", choices=["keep", "compact", "lean"], help="Retention policy for finished sims")
+    parser.add_argument("--scratch-gb", type=float, default=0, help="Run sims in a scratch directory in the sandbox capped at this size")
+    parser.add_argument("--workers", type=int, default=0, help="Run through the work queue with this many local workers")
+    parser.add_argument("--json", help="Save the results here")
+    parser.add_argument("--baseline", help="Results saved by an earlier --json to compare against")
+    parser.add_argument("--keep", action="store_true", help="Keep the sandboxes, and print where they are")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    results = {}
+    for rows in args.rows:
+        root = tempfile.mkdtemp(prefix=f"orchestrator-{rows}-")
+        try:
+            env = Sandbox(root, rows, args)
+            start = time.perf_counter()
+            with open(os.path.join(root, "console.log"), "w") as console:
+                if args.workers:
+                    queue = ["--queue", os.path.join(root, "Queue")]
+                    workers = [subprocess.Popen([sys.executable, "MesaStellaCore.py", "worker", *queue, "--cores", str(max(1, args.cores // args.workers))],
+                                                cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(args.workers)]
+                    code = subprocess.run([sys.executable, "MesaStellaCore.py", "coordinate", *queue], cwd=root, env=env,
+                                          stdout=console, stderr=subprocess.STDOUT).returncode
+                    for worker in workers:
+                        code = code or worker.wait()
+                else:
+                    code = subprocess.run([sys.executable, "MesaStellaCore.py"], cwd=root, env=env, stdout=console, stderr=subprocess.STDOUT).returncode
+            wall = time.perf_counter() - start
+            if code != 0:
+                print(f"{rows} rows: MesaStellaCore.py exited with code {code}; see {root}/console.log")
+                args.keep = True
+                continue
+            results[str(rows)] = Measure(root, rows, args, wall)
+            Report(results[str(rows)], baseline.get(str(rows)))
+            if results[str(rows)]["finished"] != rows:
+                print(f"  only {results[str(rows)]['finished']} of {rows} sims finished; see {root}/Logs")
+                args.keep = True
+        finally:
+            if args.keep:
+                print(f"  sandbox kept in {root}")
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Times the photometry registry against the per-sim pandas BandConv path ExportData used to take
+
+Run from the repository root: python Benchmarks/Photometry.py [models]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from MesaStella.StellaOutput import ReadLightCurve
+from MesaStella import Photometry
+
+models = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+sample = ReadLightCurve("ModelGrids/000_Source_12M/PostCC/stella/test/mesa.tt")
+
+def BandConv(data, bandout):
+    # The conversion as it was in MesaStellaCore.py: every band rebuilt, and the square root recomputed, per call
+    out = {}
+    for band in ["U", "B", "V", "R", "I"]:
+        out[band] = data[f"M{band}"]
+    out["u"] = 7.30606e-11 * (-5.66804e9 + 4.31686e10*data["MB"] + 77341.9 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]))
+    out["g"] = 3.44116e-8 * (-1.90779e6 + 1.453e7*data["MB"] - 38.1182 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]))
+    out["r"] = 4.75955e-11 * (1.14344e9 - 7.65731e9*data["MB"] + 20088.3 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]) + 3.6325e10*data["MV"])
+    out["i"] = 1.29688e-13 * (2.76958e12 + 6.7614e12*data["MB"] + 2.6263e13*data["MR"] - 1.7738e7 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]) - 3.2075e13*data["MV"])
+    out["z"] = 2.05854e-15 * (6.85196e14 + 4.25968e14*data["MB"] + 1.65457e15*data["MR"] - 1.11749e9 *np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]) - 2.02072e15*data["MV"])
+    return out[bandout]
+
+# A fake grid: the sample light curve, shifted a little for every model
+rng = np.random.default_rng(1)
+shifts = rng.normal(0, 0.3, models)
+stacked = {band: sample[band][None, :] + shifts[:, None] for band in ("MU", "MB", "MV", "MR", "MI")}
+frames = [pd.DataFrame({band: stacked[band][m] for band in stacked}) for m in range(models)]
+
+start = time.perf_counter()
+for frame in frames:
+    for band in ["u", "g", "r", "i", "z"]:
+        frame[band] = BandConv(frame, band)
+old = time.perf_counter() - start
+
+start = time.perf_counter()
+grid64 = Photometry.Convert(stacked, ["u", "g", "r", "i", "z"], np.float64)
+new64 = time.perf_counter() - start
+
+stacked32 = {band: values.astype(np.float32) for band, values in stacked.items()}
+start = time.perf_counter()
+grid32 = Photometry.Convert(stacked32, ["u", "g", "r", "i", "z"], np.float32)
+new32 = time.perf_counter() - start
+
+error64 = max(np.abs(grid64[band] - np.stack([frame[band] for frame in frames])).max() for band in "ugriz")
+error32 = max(np.abs(grid32[band] - grid64[band]).max() for band in "ugriz")
+
+print(f"ugriz for {models} models x {len(sample['time'])} epochs")
+print(f"  per-sim pandas BandConv: {old:8.3f} s")
+print(f"  Convert, float64:        {new64:8.3f} s  ({old / new64:.0f}x, max difference {error64:.1e} mag)")
+print(f"  Convert, float32:        {new32:8.3f} s  ({old / new32:.0f}x, max difference {error32:.1e} mag)")
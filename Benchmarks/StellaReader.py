@@ -0,0 +1,78 @@
+"""Times the mesa.tt reader and grid store against the pandas path ExportData used to take
+
+Run from the repository root: python Benchmarks/StellaReader.py [path/to/mesa.tt] [repeats]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from MesaStella.StellaOutput import ReadLightCurve
+from MesaStella.ExportStore import GridStore
+
+path = sys.argv[1] if len(sys.argv) > 1 else "ModelGrids/000_Source_12M/PostCC/stella/test/mesa.tt"
+repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+def ReadPandas(datapath):
+    # What ExportData did before: scan for the exact header string, then read_csv on single spaces
+    csvstr = "time           Tbb         vFe        Teff      Rlast_sc   R(tau2/3)    Mbol     MU      MB      MV      MI      MR   Mbolavg  gdepos"
+    found = False
+    with open(datapath, "r") as file:
+        for linenum, line in enumerate(file):
+            if csvstr in line:
+                found = True
+                break
+    if not found:
+        raise ValueError("header not found")
+    return pd.read_csv(datapath, skiprows=linenum, skipinitialspace=True, header=0, delimiter=" ")
+
+def Time(func):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = func(path)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+old, frame = Time(ReadPandas)
+new, table = Time(ReadLightCurve)
+
+# Both should agree on every column they share
+for column in table:
+    if column in frame:
+        assert np.allclose(frame[column].to_numpy(dtype=float), table[column], equal_nan=True), column
+
+print(f"{path}: {len(table['time'])} rows, {len(table)} columns, best of {repeats}")
+print(f"  pandas read_csv:  {old * 1e3:8.2f} ms")
+print(f"  ReadLightCurve:   {new * 1e3:8.2f} ms  ({old / new:.1f}x)")
+
+# Exporting a whole grid: one CSV per model as before, against appending to the grid's store
+models = repeats
+with tempfile.TemporaryDirectory() as tmp:
+    start = time.perf_counter()
+    for n in range(models):
+        ReadPandas(path).to_csv(os.path.join(tmp, f"Data_{n}.csv"))
+    csvtime = time.perf_counter() - start
+
+    store = GridStore(os.path.join(tmp, "store"))
+    start = time.perf_counter()
+    for n in range(models):
+        store.Append(f"model{n}", {"n": n}, ReadLightCurve(path))
+    storetime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for n in range(models):
+        pd.read_csv(os.path.join(tmp, f"Data_{n}.csv"))["MV"].to_numpy().min()
+    csvload = time.perf_counter() - start
+    start = time.perf_counter()
+    for params, columns in GridStore(os.path.join(tmp, "store")).Read().values():
+        columns["MV"].min()
+    storeload = time.perf_counter() - start
+
+print(f"Exporting {models} models:")
+print(f"  per-sim CSVs:     {csvtime:8.3f} s, reading back {csvload:8.3f} s")
+print(f"  GridStore:        {storetime:8.3f} s, reading back {storeload:8.3f} s")
@@ -0,0 +1,64 @@
+"""Runs chains of shell jobs through the shared work queue with several local workers, killing one partway
+
+Checks every job ran after its dependencies and that the killed worker's jobs were picked up by the others.
+Run from the repository root: python Benchmarks/WorkQueue.py [chains] [workers] [cores per worker]
+"""
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from MesaStella.WorkQueue import WorkQueue, Listing
+
+chains = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+cores = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+# The same shape as a sim's chain, with MESA stages taking several cores for longer
+stages = [("CreateSim", 1, 0.05), ("PreCC", 2, 0.5), ("PostCC", 2, 0.5), ("Stella", 1, 0.3), ("ExportData", 1, 0.05)]
+
+with tempfile.TemporaryDirectory() as tmp:
+    root = os.path.join(tmp, "Queue")
+    log = os.path.join(tmp, "order.log")
+    queue = WorkQueue(root)
+    queue.Open(lease=2, attempts=3)
+    for chain in range(chains):
+        previous = None
+        for priority, (stage, need, seconds) in enumerate(stages):
+            name = f"{stage}:sim{chain}"
+            previous = queue.Submit(name, {"command": f"echo start {name} >> {log}; sleep {seconds}; echo end {name} >> {log}"},
+                                    need, [previous], priority)
+
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    start = time.perf_counter()
+    procs = [subprocess.Popen([sys.executable, "-m", "MesaStella.WorkQueue", root, str(cores)], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True) for _ in range(workers)]
+    # Kill one worker and everything it started while it's in the middle of its jobs
+    time.sleep(1.5)
+    os.killpg(procs[0].pid, signal.SIGKILL)
+    counts = queue.Run(poll=0.2)
+    elapsed = time.perf_counter() - start
+    queue.Close()
+    for proc in procs[1:]:
+        proc.wait(timeout=60)
+
+    expired = len(Listing(os.path.join(root, "expired")))
+    with open(log) as file:
+        events = [line.split() for line in file]
+
+ended = {}
+for position, (event, name) in enumerate(events):
+    if event == "end":
+        ended.setdefault(name, position)
+ordered = True
+for chain in range(chains):
+    for (before, _, _), (after, _, _) in zip(stages, stages[1:]):
+        first = next(position for position, (event, name) in enumerate(events) if event == "start" and name == f"{after}:sim{chain}")
+        ordered &= ended.get(f"{before}:sim{chain}", len(events)) < first
+
+work = chains * sum(need * seconds for _, need, seconds in stages)
+print(f"{chains} chains of {len(stages)} jobs on {workers} workers x {cores} cores, one killed: {elapsed:.2f} s "
+      f"(ideal {work / ((workers - 1) * cores):.2f} s on the survivors)")
+print(f"  {counts}; {expired} lease(s) expired and requeued; every job ran after its dependencies: {ordered}")
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from MesaStella.ProgCache import FileLock, HashFiles
+from MesaStella import Telemetry
+
+logger = logging.getLogger(__name__)
+
+# What each compiled component is built from, how to build it, and the binaries the run scripts need.
+# Paths are relative to the component's directory within a source template.
+Components = {
+    "PreCC": {
+        "dir": "PreCC",
+        "sources": ["src", "make", "mk"],
+        "build": "./mk",
+        "artifacts": ["star"],
+    },
+    "PostCC": {
+        "dir": "PostCC",
+        "sources": ["src", "make", "mk"],
+        "build": "./mk",
+        "artifacts": ["star"],
+    },
+    "Stella": {
+        "dir": "PostCC/stella",
+        "sources": ["src", "strad", "vladsf", "eve", "obj", "res"],
+        # Same targets as stella/rn.  res/makefile points MESA_DIR at ../.., which only works inside $MESA_DIR/stella
+        "build": (
+            "cd obj && make -f f90StellaGF.mak clean && make -f f90StellaGF.mak eve2 && "
+            "make -f f90StellaGF.mak ronfict && make -f f90StellaGF.mak stella6_mesa && "
+            'cd ../res && make MESA_DIR="$MESA_DIR"'
+        ),
+        "artifacts": ["eve/run/eve2.exe", "vladsf/xronfict.exe", "strad/run/xstella6_mesa.exe", "res/stella_extras"],
+    },
+}
+
+def ListSources(root, entries):
+    """Lists every file under the given entries of root, relative to root"""
+    files = []
+    for entry in entries:
+        path = os.path.join(root, entry)
+        if os.path.isfile(path):
+            files.append(entry)
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                files.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return files
+
+def ToolchainStamp(mesadir, sdkdir):
+    """Identifies the MESA installation and SDK that binaries are built against"""
+    parts = [os.path.realpath(mesadir), os.path.realpath(sdkdir)]
+    for path in (os.path.join(mesadir, "data/version_number"), os.path.join(sdkdir, "bin/mesasdk_init.sh")):
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                parts.append(hashlib.sha256(file.read()).hexdigest())
+    # Reinstalling MESA or the SDK in place changes these even when the version files don't
+    for path in (os.path.join(mesadir, "lib/libstar.a"), os.path.join(sdkdir, "bin/gfortran")):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}:{int(stat.st_mtime)}")
+    return "\n".join(parts)
+
+class BuildCache:
+    """Compiles the MESA star executables and Stella binaries once per template and links them into sims"""
+
+    def __init__(self, root, env, mesadir, sdkdir):
+        self.root = root
+        self.env = env
+        self.stamp = ToolchainStamp(mesadir, sdkdir)
+        self.keys = {}
+        self.keylock = threading.Lock()
+        os.makedirs(os.path.join(root, "locks"), exist_ok=True)
+
+    def Key(self, templatedir, component):
+        """Hashes the component's sources together with the toolchain; memoized since templates don't change mid-run"""
+        with self.keylock:
+            if (templatedir, component) not in self.keys:
+                spec = Components[component]
+                srcdir = os.path.join(templatedir, spec["dir"])
+                files = [path for path in ListSources(srcdir, spec["sources"]) if not path.endswith((".o", ".exe"))]
+                digest = hashlib.sha256()
+                digest.update(f"{component}\n{spec['build']}\n{self.stamp}\n".encode())
+                digest.update(HashFiles(srcdir, files).encode())
+                self.keys[(templatedir, component)] = f"{component}-{digest.hexdigest()[:32]}"
+            return self.keys[(templatedir, component)]
+
+    def EntryDir(self, key):
+        return os.path.join(self.root, key)
+
+    def IsValid(self, key, component):
+        entry = self.EntryDir(key)
+        return all(os.path.isfile(os.path.join(entry, path)) for path in Components[component]["artifacts"])
+
+    def Ensure(self, templatedir, component):
+        """Builds the component for a template unless a valid build is already cached; returns False on failure"""
+        key = self.Key(templatedir, component)
+        with FileLock(os.path.join(self.root, "locks", f"{key}.lock")):
+            if self.IsValid(key, component):
+                logger.info(f"Using cached {component} binaries for {os.path.basename(templatedir)} ({key})")
+                return True
+
+            spec = Components[component]
+            logger.info(f"Building {component} binaries for {os.path.basename(templatedir)} ({key})")
+            builddir = tempfile.mkdtemp(prefix=f".build-{key}-", dir=self.root)
+            staging = None
+            try:
+                srcdir = os.path.join(templatedir, spec["dir"])
+                for entry in spec["sources"]:
+                    src = os.path.join(srcdir, entry)
+                    if os.path.isdir(src):
+                        shutil.copytree(src, os.path.join(builddir, entry), symlinks=True)
+                    else:
+                        shutil.copy2(src, os.path.join(builddir, entry))
+
+                process = subprocess.Popen(["bash", "-c", f"{self.env}\n{spec['build']}"], cwd=builddir,
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                with process.stdout:
+                    output = process.stdout.read()
+                # Waiting through Telemetry counts the compile towards the stage that asked for it
+                Telemetry.Reap(process)
+                if process.returncode != 0:
+                    tail = "\n".join(output.splitlines()[-20:])
+                    logger.error(f"Building {component} for {os.path.basename(templatedir)} failed; sims will compile their own copy\n{tail}")
+                    return False
+
+                # Assemble the entry next to its final location and rename it into place in one step
+                staging = tempfile.mkdtemp(prefix=f".stage-{key}-", dir=self.root)
+                for path in spec["artifacts"]:
+                    os.makedirs(os.path.dirname(os.path.join(staging, path)), exist_ok=True)
+                    shutil.copy2(os.path.join(builddir, path), os.path.join(staging, path))
+                if os.path.exists(self.EntryDir(key)):
+                    shutil.rmtree(self.EntryDir(key))
+                os.replace(staging, self.EntryDir(key))
+                logger.info(f"Cached {component} binaries as {key}")
+                return True
+            finally:
+                shutil.rmtree(builddir, ignore_errors=True)
+                if staging is not None and os.path.exists(staging):
+                    shutil.rmtree(staging, ignore_errors=True)
+
+    def Link(self, templatedir, component, simdir):
+        """Links cached binaries into a sim directory; returns False if there is no valid build to link"""
+        key = self.Key(templatedir, component)
+        if not self.IsValid(key, component):
+            return False
+
+        spec = Components[component]
+        for path in spec["artifacts"]:
+            src = os.path.join(self.EntryDir(key), path)
+            dst = os.path.join(simdir, spec["dir"], path)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                # Different filesystem, so fall back to a symlink
+                os.symlink(src, dst)
+        return True
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+import re
+from functools import lru_cache
+
+from MesaStella.Restart import Parts
+
+logger = logging.getLogger(__name__)
+
+# extra_<namelist>_inlist_name(n) = '<file>', in a header or in an inlist it reads
+IncludeLine = re.compile(r"extra_\w+_inlist_name\s*\(\s*\d+\s*\)\s*=\s*['\"]([^'\"]+)['\"]", re.IGNORECASE)
+
+# Inlists that the run's own code reads rather than a header, and the header of the first part whose output
+# they affect.  Any other inlist that no header reads is taken to affect every part.
+LateInputs = {"inlist_stella": "inlist_shock_part5_header"}
+
+# Everything besides the inlists that a part's output depends on
+Sources = ["rn", "src", "make"]
+DataSuffixes = (".net", ".list")
+
+@lru_cache(maxsize=None)
+def TemplateBytes(path):
+    # Templates don't change during a run, and every sim of one hashes the same files
+    with open(path, "rb") as file:
+        return file.read()
+
+def Contents(workdir, rendered, name):
+    """A file as this sim sees it: its rendered text if it has one, the template's otherwise"""
+    if name in rendered:
+        return rendered[name].encode()
+    return TemplateBytes(os.path.join(workdir, name))
+
+def Files(workdir, names):
+    """Every file under the given names in workdir, recursing into directories and leaving out missing ones"""
+    found = []
+    for name in names:
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                found += [os.path.relpath(os.path.join(dirpath, filename), workdir) for filename in filenames]
+        elif os.path.isfile(path):
+            found.append(name)
+    return found
+
+def Digest(workdir, rendered, names, seed=""):
+    """Hashes the names and contents of files, on top of seed, so digests can be chained"""
+    digest = hashlib.sha256(seed.encode())
+    for name in sorted(set(names)):
+        digest.update(name.encode() + b"\0")
+        digest.update(Contents(workdir, rendered, name))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def Inlists(workdir):
+    # 'inlist' itself is just a copy of whichever header MESA is running
+    return [name for name in os.listdir(workdir) if name.startswith("inlist_") and os.path.isfile(os.path.join(workdir, name))]
+
+def CommonInputs(workdir):
+    """The run script, sources and data files of a MESA work directory"""
+    data = [name for name in os.listdir(workdir) if name.endswith(DataSuffixes)]
+    return Files(workdir, Sources + data)
+
+def RunDigest(workdir, rendered):
+    """Hash of everything that determines a whole MESA run, e.g. a progenitor"""
+    return Digest(workdir, rendered, Inlists(workdir) + CommonInputs(workdir))
+
+def Included(workdir, rendered, header):
+    """A header and every inlist it reads, directly or through other inlists"""
+    seen = set()
+    stack = [header]
+    while stack:
+        name = stack.pop()
+        if name in seen or not (name in rendered or os.path.isfile(os.path.join(workdir, name))):
+            continue
+        seen.add(name)
+        stack += IncludeLine.findall(Contents(workdir, rendered, name).decode(errors="replace"))
+    return seen
+
+def PartKeys(workdir, rendered, base):
+    """(header, output model, key) of every part of a work directory's rn
+
+    Each part's key chains the previous part's key with the inlists that part reads, so two sims share
+    a part's output exactly when everything up to and including it is the same for both.  base is the
+    hash of what the run starts from, e.g. RunDigest of the progenitor's run.  rendered is {name: text}
+    of this sim's rendered files, which take the place of the template's.
+    """
+    parts = Parts(workdir)
+    headers = [header for header, _ in parts]
+    reached = set()
+    for header in headers:
+        reached |= Included(workdir, rendered, header)
+    late = {name: first for name, first in LateInputs.items()
+            if first in headers and (name in rendered or os.path.isfile(os.path.join(workdir, name)))}
+    everywhere = [name for name in Inlists(workdir) if name not in reached and name not in late]
+
+    previous = Digest(workdir, rendered, everywhere + CommonInputs(workdir), base)
+    keys = []
+    for header, output in parts:
+        names = Included(workdir, rendered, header) | {name for name, first in late.items() if first == header}
+        previous = Digest(workdir, rendered, names, previous)
+        keys.append((header, output, previous))
+    return keys
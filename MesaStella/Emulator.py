@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from MesaStella import Photometry
+from MesaStella.LightCurveGrid import LightCurveGrid, SortOrder
+
+logger = logging.getLogger(__name__)
+
+# Stella's own bands are what's emulated; every other band is synthesized from them, as for exports
+StellaBands = ["MU", "MB", "MV", "MR", "MI"]
+
+def Distances(a, b, scales):
+    """Squared distances between two sets of normalized parameter points, in length scales"""
+    a, b = a / scales, b / scales
+    return np.maximum(np.sum(a * a, axis=1)[:, None] + np.sum(b * b, axis=1)[None, :] - 2 * a @ b.T, 0)
+
+def Kernel(a, b, scales):
+    """Squared exponential covariance between two sets of normalized parameter points"""
+    return np.exp(-0.5 * Distances(a, b, scales))
+
+def Build(grid, path, variance=0.999, maxcomponents=30, lengthscale=1.0, nugget=1e-6):
+    """Trains an emulator on a LightCurveGrid, saves it to path (.npz) and returns its validation report
+
+    The models' light curves, over the times every model covers, are reduced to their leading principal
+    components, and each component is interpolated across the parameters that vary in the grid with a
+    Gaussian process, whose length scale along each parameter is lengthscale grid spacings.  The report
+    has every model's leave-one-out error: how far off the emulator is at that model when it's trained
+    on all the others, which shows where the grid is too sparse to trust.  The principal components
+    aren't recomputed for each left-out model, so the errors are a little optimistic.
+    """
+    if isinstance(grid, str):
+        grid = LightCurveGrid(grid)
+    bands = [band for band in StellaBands if band in grid.bands]
+    if len(grid) < 3 or not bands:
+        raise ValueError(f"Need at least 3 models with Stella magnitudes to build an emulator, not {len(grid)}")
+
+    # Parameters that vary across the grid, on a log scale when they span decades
+    names, columns, logscale = [], [], []
+    for key in SortOrder:
+        if key in grid.params.dtype.names and grid.params.dtype[key] == np.float64:
+            values = grid.params[key]
+            if np.all(np.isfinite(values)) and np.ptp(values) > 0:
+                uselog = bool(values.min() > 0 and values.max() / values.min() > 10)
+                names.append(key)
+                columns.append(np.log10(values) if uselog else values)
+                logscale.append(uselog)
+    if not names:
+        raise ValueError("No parameter varies across the grid")
+    raw = np.stack(columns, axis=1)
+    low, high = raw.min(axis=0), raw.max(axis=0)
+    x = (raw - low) / (high - low)
+    spacing = np.array([np.median(np.diff(np.unique(column))) for column in x.T])
+    scales = lengthscale * spacing
+
+    # Only the times every model covers can be decomposed
+    data = np.asarray(grid.data[..., [grid.Band(band) for band in bands]], dtype=np.float64)
+    covered = np.all(np.isfinite(data), axis=(0, 2))
+    if not covered.any():
+        raise ValueError("No time is covered by every model")
+    y = data[:, covered].reshape(len(grid), -1)
+
+    mean = y.mean(axis=0)
+    u, s, vt = np.linalg.svd(y - mean, full_matrices=False)
+    explained = np.cumsum(s**2) / np.sum(s**2)
+    ncomp = int(min(np.searchsorted(explained, variance) + 1, maxcomponents, len(s)))
+    coeffs = u[:, :ncomp] * s[:ncomp]
+    basis = vt[:ncomp]
+    # What the dropped components leave behind, per time and band
+    floor = np.mean((y - mean - coeffs @ basis)**2, axis=0)
+
+    squared = Distances(x, x, scales)
+    K = np.exp(-0.5 * squared) + nugget * np.eye(len(x))
+    Kinv = np.linalg.inv(K)
+    alpha = Kinv @ coeffs
+    amplitude = np.einsum("ic,ic->c", coeffs, alpha) / len(x)
+
+    # Leave-one-out predictions in closed form, from the inverse covariance
+    diag = np.diag(Kinv)
+    loo = coeffs - alpha / diag[:, None]
+    loovar = amplitude[None, :] / diag[:, None]
+    error = mean + loo @ basis - y
+    sigma = np.sqrt(loovar @ basis**2 + floor)
+    zscore = np.sqrt(np.mean((error / sigma)**2, axis=1))
+    # Uncertainties are scaled so the held-out errors come out at one sigma on average
+    calibration = float(np.sqrt(np.mean(zscore**2)))
+
+    np.fill_diagonal(squared, np.inf)
+    distance = np.sqrt(squared.min(axis=1))
+    report = pd.DataFrame(grid.params)
+    report["rms"] = np.sqrt(np.mean(error**2, axis=1))
+    report["max"] = np.abs(error).max(axis=1)
+    report["zscore"] = zscore / calibration
+    report["neighbour"] = distance
+    report = report.sort_values("rms", ascending=False, kind="stable").reset_index(drop=True)
+
+    meta = {"bands": bands, "params": names, "logscale": logscale, "components": ncomp,
+            "models": len(grid), "calibration": calibration}
+    temp = f"{path}.tmp.npz"
+    np.savez(temp, meta=json.dumps(meta), low=low, high=high, scales=scales, x=x, alpha=alpha, Kinv=Kinv,
+             amplitude=amplitude, mean=mean, basis=basis, floor=floor, times=grid.times[covered])
+    os.replace(temp, path)
+    logger.info(f"Built emulator '{path}' on {len(grid)} models over {names}: {ncomp} components, "
+                f"median held-out error {np.median(report['rms']):.3f} mag, worst {report['rms'].iloc[0]:.3f} mag ({report['dirname'].iloc[0]})")
+    return report
+
+class Emulator:
+    """Predicts light curves between the models of a grid, from an emulator saved by Build"""
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as file:
+            for key in file.files:
+                if key != "meta":
+                    setattr(self, key, file[key])
+            meta = json.loads(str(file["meta"]))
+        self.bands = meta["bands"]
+        self.params = meta["params"]
+        self.logscale = meta["logscale"]
+        self.calibration = meta["calibration"]
+
+    def __reduce__(self):
+        return (Emulator, (self.path,))
+
+    def Normalize(self, **params):
+        missing = [name for name in self.params if name not in params]
+        if missing:
+            raise KeyError(f"Emulator needs {missing} too; it was trained over {self.params}")
+        raw = np.array([np.log10(params[name]) if uselog else params[name] for name, uselog in zip(self.params, self.logscale)], dtype=np.float64)
+        x = (raw - self.low) / (self.high - self.low)
+        if np.any(x < 0) or np.any(x > 1):
+            logger.warning(f"Extrapolating outside the grid: {params}")
+        return x
+
+    def Predict(self, bands=None, samples=200, seed=None, **params):
+        """Light curve at the given parameters; returns times, {band: magnitudes} and {band: one sigma}
+
+        Parameters the grid doesn't vary are ignored.  Stella's bands have analytic uncertainties; any other
+        band is synthesized from them, with its uncertainty estimated from samples of the Stella bands.
+        """
+        bands = list(bands) if bands is not None else ["U", "B", "V", "R", "I"]
+        x = self.Normalize(**params)
+        k = Kernel(x[None, :], self.x, self.scales)[0]
+        coeffs = k @ self.alpha
+        var = self.amplitude * max(0.0, 1.0 - k @ self.Kinv @ k) * self.calibration**2
+        shape = (len(self.times), len(self.bands))
+
+        curve = (self.mean + coeffs @ self.basis).reshape(shape)
+        mean = Photometry.Convert({band: curve[:, j] for j, band in enumerate(self.bands)}, bands, np.float64)
+        direct = {f"M{band}" if band in ("U", "B", "V", "R", "I") else band for band in bands}
+        if direct <= set(self.bands):
+            sigma = np.sqrt(var @ self.basis**2 + self.floor * self.calibration**2).reshape(shape)
+            std = {band: sigma[:, self.bands.index(band if band in self.bands else f"M{band}")] for band in bands}
+        else:
+            rng = np.random.default_rng(seed)
+            draws = coeffs + np.sqrt(var) * rng.standard_normal((samples, len(coeffs)))
+            curves = self.mean + draws @ self.basis
+            curves += np.sqrt(self.floor) * self.calibration * rng.standard_normal(curves.shape)
+            curves = curves.reshape(samples, *shape)
+            drawn = Photometry.Convert({band: curves[..., j] for j, band in enumerate(self.bands)}, bands, np.float64)
+            std = {band: drawn[band].std(axis=0) for band in bands}
+        return self.times, mean, std
+
+if __name__ == "__main__":
+    # Trains an emulator by hand: python -m MesaStella.Emulator DataExports/<gridtag>
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    Build(os.path.join(sys.argv[1], "grid"), os.path.join(sys.argv[1], "emulator.npz")).to_csv(
+        os.path.join(sys.argv[1], "EmulatorValidation.csv"), index=False)
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from MesaStella.ProgCache import FileLock
+
+logger = logging.getLogger(__name__)
+
+class GridStore:
+    """Append-only columnar store of every exported light curve of one grid
+
+    Each column is a flat file of float64 values that models are appended to, and index.jsonl has one
+    line per model with its parameters and where its rows are.  The index line is written last, so a
+    model only exists once all of its data is on disk; anything a crash left past the end of the index is
+    cut off by the next append.  Several processes can append at once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.coldir = os.path.join(root, "columns")
+        self.indexpath = os.path.join(root, "index.jsonl")
+        os.makedirs(self.coldir, exist_ok=True)
+
+    def ColumnPath(self, name):
+        # Column names like 'R(tau2/3)' aren't all safe as file names
+        safe = "".join(char if char.isalnum() or char in "_-" else "_" for char in name)
+        return os.path.join(self.coldir, f"{safe}.f64")
+
+    def Index(self):
+        """Every model in the store, latest export of each, in the order they were added"""
+        models = {}
+        if os.path.exists(self.indexpath):
+            with open(self.indexpath, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    models.pop(entry["dirname"], None)
+                    models[entry["dirname"]] = entry
+        return list(models.values())
+
+    def LastEntry(self):
+        """The last complete line of the index, read from the end so appends don't slow down as the store grows"""
+        if not os.path.exists(self.indexpath):
+            return None
+        with open(self.indexpath, "rb") as file:
+            size = file.seek(0, os.SEEK_END)
+            block = 1 << 16
+            while True:
+                file.seek(max(0, size - block))
+                lines = file.read().split(b"\n")
+                # The first line may be cut off by the block boundary unless the block reached the start of the file
+                candidates = lines if size <= block else lines[1:]
+                for line in reversed(candidates):
+                    try:
+                        return json.loads(line)
+                    except ValueError:
+                        continue
+                if size <= block:
+                    return None
+                block *= 4
+
+    def Dirnames(self):
+        return {entry["dirname"] for entry in self.Index()}
+
+    def Append(self, dirname, params, columns):
+        """Adds one model's light curve; columns is {name: array}, all the same length"""
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) != 1:
+            raise ValueError(f"Columns of {dirname} have different lengths: {lengths}")
+        length = lengths.pop()
+
+        with FileLock(os.path.join(self.root, "store.lock")):
+            # Where the data ends is whatever the index says, not what the column files happen to hold
+            last = self.LastEntry()
+            rows = 0 if last is None else last["offset"] + last["length"]
+            names = set() if last is None else set(last["allcolumns"])
+
+            for name in sorted(names | set(columns)):
+                path = self.ColumnPath(name)
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                with open(path, "ab") as file:
+                    if size > rows * 8:
+                        file.truncate(rows * 8)
+                    elif size < rows * 8:
+                        # A column this model adds gets NaN for every model before it
+                        np.full(rows - size // 8, np.nan).tofile(file)
+                    values = columns.get(name)
+                    values = np.full(length, np.nan) if values is None else np.asarray(values, dtype=np.float64)
+                    values.tofile(file)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            entry = {"dirname": dirname, "params": params, "offset": rows, "length": length,
+                     "columns": sorted(columns), "allcolumns": sorted(names | set(columns)), "time": time.time()}
+            with open(self.indexpath, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+        return entry
+
+    def Columns(self):
+        """Memory-maps every column; returns {name: array} over all rows in the store"""
+        entries = self.Index()
+        rows = max((entry["offset"] + entry["length"] for entry in entries), default=0)
+        names = sorted({name for entry in entries for name in entry["columns"]})
+        out = {}
+        for name in names:
+            if rows == 0:
+                out[name] = np.empty(0)
+            else:
+                out[name] = np.memmap(self.ColumnPath(name), dtype=np.float64, mode="r", shape=(rows,))
+        return out
+
+    def Read(self, dirname=None):
+        """Returns {dirname: (params, {column: array})}, or just the one model, as views into the mapped columns"""
+        columns = self.Columns()
+        out = {}
+        for entry in self.Index():
+            if dirname is not None and entry["dirname"] != dirname:
+                continue
+            start, stop = entry["offset"], entry["offset"] + entry["length"]
+            out[entry["dirname"]] = (entry["params"], {name: columns[name][start:stop] for name in entry["columns"]})
+        if dirname is not None:
+            return out.get(dirname)
+        return out
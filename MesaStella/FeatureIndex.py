@@ -0,0 +1,401 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections.abc import Sequence
+
+import numpy as np
+
+from MesaStella.ProgCache import FileLock
+
+logger = logging.getLogger(__name__)
+
+def Spans(starts, stops):
+    """Every index from each start up to its stop, all concatenated"""
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=int)
+    return np.arange(total) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+class KDTree:
+    """Static k-d tree over a set of points, searched through the bounding boxes of its leaves
+
+    Points are reordered so that each leaf's are one contiguous block, split at the median of the
+    dimension they spread most along until there are at most leafsize of them.  Runs of GroupSize
+    neighbouring leaves have a box too.  A query checks every group's box at once, then the boxes of the
+    leaves in the groups that could hold an answer, then those leaves' points; numpy does each of those
+    faster than Python could walk down the tree a node at a time.
+    """
+
+    GroupSize = 64
+
+    def __init__(self, points, leafsize=32):
+        self.points = np.ascontiguousarray(points, dtype=np.float64) # points x dimensions
+        self.leafsize = leafsize
+        self.order = np.arange(len(self.points))
+        leaves = []
+        stack = [(0, len(self.points))] if len(self.points) else []
+        while stack:
+            start, stop = stack.pop()
+            points = self.points[self.order[start:stop]]
+            spread = points.max(axis=0) - points.min(axis=0)
+            dim = int(np.argmax(spread))
+            if stop - start > leafsize and spread[dim] > 0:
+                half = (stop - start) // 2
+                self.order[start:stop] = self.order[start:stop][np.argpartition(points[:, dim], half)]
+                # Left first, so the leaves come out in order and neighbouring ones are near each other
+                stack += [(start + half, stop), (start, start + half)]
+            else:
+                leaves.append((start, stop))
+        width = self.points.shape[1]
+        self.sorted = self.points[self.order]
+        self.starts = np.array([start for start, _ in leaves], dtype=int)
+        self.stops = np.array([stop for _, stop in leaves], dtype=int)
+        self.lo = np.array([self.sorted[start:stop].min(axis=0) for start, stop in leaves]).reshape(-1, width)
+        self.hi = np.array([self.sorted[start:stop].max(axis=0) for start, stop in leaves]).reshape(-1, width)
+        groups = np.arange(0, len(leaves), self.GroupSize)
+        self.groupstarts = groups
+        self.groupstops = np.minimum(groups + self.GroupSize, len(leaves))
+        self.grouplo = np.minimum.reduceat(self.lo, groups) if len(leaves) else self.lo
+        self.grouphi = np.maximum.reduceat(self.hi, groups) if len(leaves) else self.hi
+
+    def __len__(self):
+        return len(self.points)
+
+    @staticmethod
+    def BoxDistances(lo, hi, point):
+        """Squared distance from the point to each box"""
+        gaps = np.maximum(lo - point, 0) + np.maximum(point - hi, 0)
+        return np.einsum("ij,ij->i", gaps, gaps)
+
+    def Distances(self, spans, point):
+        diff = self.sorted[spans] - point
+        return np.einsum("ij,ij->i", diff, diff)
+
+    def Nearest(self, point, k=1):
+        """(distances, indices) of the k points nearest point, nearest first"""
+        point = np.asarray(point, dtype=np.float64)
+        k = min(k, len(self))
+        if k < 1:
+            return np.empty(0), np.empty(0, dtype=int)
+        groups = self.BoxDistances(self.grouplo, self.grouphi, point)
+        # Any k points bound how far the answer can be, and the nearest group's nearest leaf usually has them
+        nearest = int(np.argmin(groups))
+        leaves = np.arange(self.groupstarts[nearest], self.groupstops[nearest])
+        leaf = leaves[np.argmin(self.BoxDistances(self.lo[leaves], self.hi[leaves], point))]
+        if self.stops[leaf] - self.starts[leaf] >= k:
+            bound = np.partition(self.Distances(np.arange(self.starts[leaf], self.stops[leaf]), point), k - 1)[k - 1]
+        else:
+            bound = np.inf
+        # So only the leaves within that bound, in the groups within it, need looking at
+        groups = np.flatnonzero(groups <= bound)
+        leaves = Spans(self.groupstarts[groups], self.groupstops[groups])
+        leaves = leaves[self.BoxDistances(self.lo[leaves], self.hi[leaves], point) <= bound]
+        candidates = Spans(self.starts[leaves], self.stops[leaves])
+        distances = self.Distances(candidates, point)
+        nearest = np.argpartition(distances, k - 1)[:k] if len(distances) > k else np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return np.sqrt(distances[nearest]), self.order[candidates[nearest]]
+
+    def Within(self, low, high):
+        """Indices of the points inside the box from low to high (inclusive), in no particular order"""
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+        groups = np.flatnonzero(~((self.grouphi < low).any(axis=1) | (self.grouplo > high).any(axis=1)))
+        leaves = Spans(self.groupstarts[groups], self.groupstops[groups])
+        lo, hi = self.lo[leaves], self.hi[leaves]
+        touching = ~((hi < low).any(axis=1) | (lo > high).any(axis=1))
+        inside = touching & (lo >= low).all(axis=1) & (hi <= high).all(axis=1)
+        partly = leaves[touching & ~inside]
+        edge = Spans(self.starts[partly], self.stops[partly])
+        points = self.sorted[edge]
+        edge = edge[((points >= low) & (points <= high)).all(axis=1)]
+        inside = leaves[inside]
+        return self.order[np.concatenate([Spans(self.starts[inside], self.stops[inside]), edge])]
+
+class Matches(Sequence):
+    """Models a query found, each as a dict of its directory name, parameters, features and any distance
+
+    The rows and their feature values are picked out with numpy when the query runs; a model's dict is only
+    made when it's looked at, so a query that matches thousands of models but is only counted, or whose
+    rows are all that's wanted, costs no Python per match.
+    """
+
+    def __init__(self, index, rows, names, distances=None):
+        self.index = index
+        self.rows = rows # Rows of the index's table
+        self.names = names
+        self.values = index.values[np.ix_(rows, index._Columns(names))]
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        row = int(self.rows[position])
+        match = {"dirname": self.index.dirnames[row], "params": self.index.params[row],
+                 "features": dict(zip(self.names, self.values[position].tolist()))}
+        if self.distances is not None:
+            match["distance"] = float(self.distances[position])
+        return match
+
+    def Dirnames(self):
+        return [self.index.dirnames[row] for row in self.rows.tolist()]
+
+class FeatureIndex:
+    """Light curve features of every model of a grid, with k-d trees for nearest-neighbour and range queries
+
+    The table is DataExports/<GridTag>/features.jsonl, one line per model with its parameters and
+    features, appended to by every process exporting to the grid; a model exported again replaces its
+    earlier line.  Queries first read whatever lines were added since the last one, so a long-lived
+    index keeps up with a running grid.  A tree is built for each set of features queried together,
+    over the models that have all of them, in units of each feature's spread (or the scale given).
+    Models added since it was built are searched directly until there are enough of them to rebuild.
+    """
+
+    # A tree is rebuilt once the models added since it was built are this many, or a quarter of it
+    RebuildMin = 256
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, "features.jsonl")
+        self.lock = threading.RLock()
+        self.offset = 0 # Bytes of the table read so far
+        self.names = [] # Feature names, in the order of the value columns
+        self.columns = {}
+        self.values = np.empty((0, 0))
+        self.count = 0
+        self.dirnames = []
+        self.params = []
+        self.rows = {} # dirname -> row
+        self.trees = {} # (names, scale) -> {"tree", "rows", "scale", "built"}
+
+    def Append(self, dirname, params, features):
+        """Adds one model's features to the table; features is {name: value}, NaN where there's none"""
+        self.AppendMany([(dirname, params, features)])
+
+    def AppendMany(self, models):
+        """Adds (dirname, params, features) of several models to the table at once"""
+        lines = []
+        for dirname, params, features in models:
+            # NaN isn't JSON, so missing features are null
+            values = {name: None if value is None or not math.isfinite(value) else float(value) for name, value in features.items()}
+            lines.append(json.dumps({"dirname": dirname, "params": params, "features": values, "time": time.time()}) + "\n")
+        if not lines:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with FileLock(os.path.join(self.root, "features.lock")):
+            with open(self.path, "a") as file:
+                file.write("".join(lines))
+                file.flush()
+                os.fsync(file.fileno())
+
+    def Refresh(self):
+        """Takes in lines added to the table since it was last read; returns how many"""
+        with self.lock:
+            try:
+                if os.path.getsize(self.path) <= self.offset:
+                    return 0
+            except FileNotFoundError:
+                return 0
+            with open(self.path, "rb") as file:
+                file.seek(self.offset)
+                data = file.read()
+            # A line that's still being written is left for next time
+            complete = data[:data.rfind(b"\n") + 1]
+            self.offset += len(complete)
+            added = 0
+            for line in complete.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._Insert(entry)
+                added += 1
+            return added
+
+    def _Insert(self, entry):
+        """Must be called with the lock held"""
+        for name in entry["features"]:
+            if name not in self.columns:
+                self.columns[name] = len(self.names)
+                self.names.append(name)
+        row = self.rows.get(entry["dirname"])
+        if row is None:
+            row = self.count
+            self.count += 1
+            self.rows[entry["dirname"]] = row
+            self.dirnames.append(entry["dirname"])
+            self.params.append(entry["params"])
+        else:
+            self.params[row] = entry["params"]
+            # A model that changed may be anywhere in the trees
+            self.trees.clear()
+        if self.values.shape[0] < self.count or self.values.shape[1] < len(self.names):
+            # Grown by doubling, so adding one model at a time stays cheap
+            grown = np.full((max(self.count, 2 * self.values.shape[0], 64), len(self.names)), np.nan)
+            grown[:self.values.shape[0], :self.values.shape[1]] = self.values
+            self.values = grown
+        self.values[row] = np.nan
+        for name, value in entry["features"].items():
+            if value is not None:
+                self.values[row, self.columns[name]] = value
+
+    def __len__(self):
+        self.Refresh()
+        return self.count
+
+    def Dirnames(self):
+        self.Refresh()
+        return set(self.rows)
+
+    def Features(self, dirname):
+        """{name: value} of one model's features"""
+        self.Refresh()
+        with self.lock:
+            row = self.rows[dirname]
+            return {name: float(self.values[row, column]) for name, column in self.columns.items()}
+
+    def Table(self):
+        """Every model's parameters and features as a DataFrame indexed by directory name"""
+        import pandas as pd
+        self.Refresh()
+        with self.lock:
+            params = pd.DataFrame(self.params, index=self.dirnames)
+            features = pd.DataFrame(self.values[:self.count, :len(self.names)], index=self.dirnames, columns=self.names)
+        return params.join(features)
+
+    def _Columns(self, names):
+        unknown = [name for name in names if name not in self.columns]
+        if unknown:
+            raise KeyError(f"No feature {', '.join(unknown)}; the table has {', '.join(self.names)}")
+        return [self.columns[name] for name in names]
+
+    def _Tree(self, names, scale):
+        """The tree for these features, with the rows it doesn't cover yet.  Must be called with the lock held."""
+        key = (tuple(names), None if scale is None else tuple(scale.get(name, 1.0) for name in names))
+        entry = self.trees.get(key)
+        if entry is None or self.count - entry["built"] >= max(self.RebuildMin, entry["built"] // 4):
+            values = self.values[:self.count, self._Columns(names)]
+            rows = np.flatnonzero(np.isfinite(values).all(axis=1))
+            if scale is None:
+                complete = values[rows]
+                spread = complete.std(axis=0) if len(rows) > 1 else np.zeros(len(names))
+                # A feature every model has the same value of, to within rounding, is left in its own units
+                units = np.where(spread > 1e-9 * (1 + np.abs(complete).max(axis=0, initial=0)), spread, 1.0)
+            else:
+                units = np.array(key[1])
+            entry = {"tree": KDTree(values[rows] / units), "rows": rows, "scale": units, "built": self.count}
+            self.trees[key] = entry
+        return entry
+
+    def _Pending(self, entry, names):
+        """Rows added since the tree was built that have every feature, and their scaled values"""
+        values = self.values[entry["built"]:self.count, self._Columns(names)] / entry["scale"]
+        keep = np.isfinite(values).all(axis=1)
+        return entry["built"] + np.flatnonzero(keep), values[keep]
+
+    def Nearest(self, target, k=5, scale=None):
+        """The k models whose features are nearest target ({name: value}), nearest first
+
+        Distance is in units of each feature's spread across the grid, unless scale ({name: unit}) says
+        otherwise.  Only models that have every feature in target are considered.  Each match is a dict
+        of the model's directory name, the parameters it was made with, its values of the features and
+        its distance, made as it's looked at (see Matches).
+        """
+        self.Refresh()
+        names = list(target)
+        with self.lock:
+            entry = self._Tree(names, scale)
+            point = np.array([target[name] for name in names], dtype=np.float64) / entry["scale"]
+            distances, found = entry["tree"].Nearest(point, k)
+            rows = entry["rows"][found]
+            pending, values = self._Pending(entry, names)
+            if len(pending):
+                distances = np.concatenate([distances, np.sqrt(((values - point)**2).sum(axis=1))])
+                rows = np.concatenate([rows, pending])
+                nearest = np.argsort(distances, kind="stable")[:k]
+                distances, rows = distances[nearest], rows[nearest]
+            return Matches(self, rows, names, distances)
+
+    def Range(self, **conditions):
+        """Models whose features meet every condition, in the order they were added
+
+        As in LightCurveGrid.Select, a condition is a value for equality (to within float rounding) or a
+        (low, high) tuple for an inclusive range, either end of which can be None, e.g.
+        Range(r_peak=(-17.5, -16.5), r_rise=(None, 15)).  Matches are as Nearest gives them, without distances.
+        """
+        rows = self.Select(**conditions)
+        with self.lock:
+            return Matches(self, rows, list(conditions))
+
+    def Select(self, **conditions):
+        """Rows of the table whose models meet every condition, as Range takes them, in the order they were added"""
+        self.Refresh()
+        names = list(conditions)
+        low, high = [], []
+        for name in names:
+            condition = conditions[name]
+            lower, upper = condition if isinstance(condition, tuple) else (condition, condition)
+            lower = -np.inf if lower is None else lower - 1e-9 * max(1, abs(lower))
+            upper = np.inf if upper is None else upper + 1e-9 * max(1, abs(upper))
+            low.append(lower)
+            high.append(upper)
+        with self.lock:
+            entry = self._Tree(names, None)
+            low, high = np.array(low) / entry["scale"], np.array(high) / entry["scale"]
+            rows = entry["rows"][entry["tree"].Within(low, high)]
+            pending, values = self._Pending(entry, names)
+            rows = np.concatenate([rows, pending[((values >= low) & (values <= high)).all(axis=1)]])
+            return np.sort(rows)
+
+def Update(index, gridpath, bands, batch=1024):
+    """Adds the features of every model of a LightCurveGrid that the index doesn't have yet; returns how many
+
+    This picks up models exported before features were, or whose features couldn't be worked out when
+    they were exported.  Models are done a batch at a time, all of a batch's bands at once.
+    """
+    from MesaStella import Features
+    from MesaStella.LightCurveGrid import LightCurveGrid
+    grid = LightCurveGrid(gridpath)
+    have = index.Dirnames()
+    missing = np.array([i for i, dirname in enumerate(grid.params["dirname"]) if dirname not in have], dtype=int)
+    bands = [band for band in bands if band in grid.bands]
+    columns = [grid.Band(band) for band in bands]
+    fields = [name for name in grid.params.dtype.names if name != "dirname"]
+    for first in range(0, len(missing), batch):
+        chunk = missing[first:first + batch]
+        features = Features.Extract(grid.times, grid.data[chunk][..., columns], bands)
+        models = []
+        for j, i in enumerate(chunk):
+            params = {name: grid.params[name][i].item() for name in fields}
+            models.append((str(grid.params["dirname"][i]), params, {name: values[j] for name, values in features.items()}))
+        index.AppendMany(models)
+    if len(missing):
+        logger.info(f"Added the features of {len(missing)} model(s) of '{gridpath}' to its feature index")
+    return len(missing)
+
+if __name__ == "__main__":
+    # Queries a grid's features by hand: python -m MesaStella.FeatureIndex DataExports/<gridtag> r_peak=-17.5:-16.5 r_rise=:15
+    # finds the models in those ranges, and r_peak=-17 r_rise=12 with plain values finds the 5 (or -k) nearest
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    k = 5
+    if "-k" in args:
+        k = int(args.pop(args.index("-k") + 1))
+        args.remove("-k")
+    index = FeatureIndex(args[0])
+    query = dict(arg.split("=", 1) for arg in args[1:])
+    if any(":" in value for value in query.values()):
+        bounds = {name: tuple(float(end) if end else None for end in value.split(":", 1)) if ":" in value else float(value)
+                  for name, value in query.items()}
+        matches = index.Range(**bounds)
+    else:
+        matches = index.Nearest({name: float(value) for name, value in query.items()}, k)
+    for match in matches:
+        print(match["dirname"], json.dumps(match["features"]), f"distance {match['distance']:.3f}" if "distance" in match else "")
@@ -0,0 +1,114 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Light curves are smoothed with a running median this many days wide before anything is measured,
+# which takes out Stella's noise and spikes narrower than half of it, like a shock breakout's
+Smoothing = 3.0
+# A band's rise is the time it takes to brighten by its last RiseMag magnitudes before peak
+RiseMag = 1.0
+# Days after peak that declines (dm15, dm40) are measured at
+Declines = (15, 40)
+# Linear slopes (magnitudes per day) over these ranges of days after peak
+Slopes = {"plateau": (10, 40), "tail": (60, 120)}
+# Colours taken wherever both bands are extracted, at these days after the bolometric peak (or the first band's)
+Colours = [("MU", "MB"), ("MB", "MV"), ("MV", "MR"), ("MR", "MI"), ("u", "g"), ("g", "r"), ("r", "i"), ("i", "z")]
+Epochs = (0, 10, 30)
+
+def Names(bands):
+    """Names of the features Extract gives for these bands, in order"""
+    names = []
+    for band in bands:
+        names += [f"{band}_peak", f"{band}_peak_time", f"{band}_rise"]
+        names += [f"{band}_dm{days:g}" for days in Declines]
+        names += [f"{band}_{name}_slope" for name in Slopes]
+    for blue, red in Colours:
+        if blue in bands and red in bands:
+            names += [f"{blue}_{red}_colour_{epoch:g}d" for epoch in Epochs]
+    return names
+
+def At(mags, index):
+    """mags[..., index] for an index per light curve, NaN where it's off the end"""
+    inside = (index >= 0) & (index < mags.shape[-1])
+    values = np.take_along_axis(mags, np.clip(index, 0, mags.shape[-1] - 1)[..., None], axis=-1)[..., 0]
+    return np.where(inside, values, np.nan)
+
+def Extract(times, data, bands):
+    """Features of every model and band of light curves on one regular time grid; returns {name: array over models}
+
+    data is models x times x bands of magnitudes, NaN where a model doesn't cover a time, as in a
+    LightCurveGrid.  Everything is computed for all models and bands at once.  A band the model doesn't
+    have gets NaN for all of its features, as does any feature whose epoch the light curve doesn't reach.
+    """
+    raw = np.moveaxis(np.asarray(data, dtype=np.float64), 1, 2) # models x bands x times
+    count = raw.shape[2]
+    step = float(times[1] - times[0]) if len(times) > 1 else 1.0
+    width = 2 * int(round(Smoothing / step / 2)) + 1
+    out = {}
+    if count < width:
+        return {name: np.full(len(raw), np.nan) for name in Names(bands)}
+
+    # NaN wherever the window runs past what the light curve covers
+    mags = np.full_like(raw, np.nan)
+    mags[..., width // 2:count - width // 2] = np.median(np.lib.stride_tricks.sliding_window_view(raw, width, axis=2), axis=3)
+
+    brightest = np.where(np.isnan(mags), np.inf, mags)
+    peakindex = brightest.argmin(axis=2)
+    found = np.isfinite(At(brightest, peakindex))
+    peak = np.where(found, At(mags, peakindex), np.nan)
+    peaktime = np.where(found, np.asarray(times)[peakindex], np.nan)
+
+    # Rise: from the last time before peak that it was RiseMag fainter, interpolated to where it crossed
+    target = peak + RiseMag
+    steps = np.arange(count)
+    last = np.where((mags > target[..., None]) & (steps < peakindex[..., None]), steps, -1).max(axis=2)
+    before, after = At(mags, last), At(mags, last + 1)
+    crossing = last + (before - target) / (before - after)
+    rise = np.where(last >= 0, (peakindex - crossing) * step, np.nan)
+
+    declines = {days: At(mags, peakindex + int(round(days / step))) - peak for days in Declines}
+
+    slopes = {}
+    for name, (first, final) in Slopes.items():
+        offsets = np.arange(int(round(first / step)), int(round(final / step)) + 1)
+        index = peakindex[..., None] + offsets
+        values = np.where(index < count, np.take_along_axis(mags, np.clip(index, 0, count - 1), axis=2), np.nan)
+        valid = np.isfinite(values)
+        n = valid.sum(axis=2)
+        x = np.where(valid, offsets * step, 0.0)
+        y = np.where(valid, values, 0.0)
+        xmean = x.sum(axis=2) / np.maximum(n, 1)
+        ymean = y.sum(axis=2) / np.maximum(n, 1)
+        dx = np.where(valid, x - xmean[..., None], 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            slope = (dx * (y - ymean[..., None])).sum(axis=2) / (dx**2).sum(axis=2)
+        # Only over a window the light curve covers at least half of
+        slopes[name] = np.where(n >= max(3, len(offsets) // 2), slope, np.nan)
+
+    for j, band in enumerate(bands):
+        out[f"{band}_peak"] = peak[:, j]
+        out[f"{band}_peak_time"] = peaktime[:, j]
+        out[f"{band}_rise"] = rise[:, j]
+        for days in Declines:
+            out[f"{band}_dm{days:g}"] = declines[days][:, j]
+        for name in Slopes:
+            out[f"{band}_{name}_slope"] = slopes[name][:, j]
+
+    reference = bands.index("Mbol") if "Mbol" in bands else 0
+    for blue, red in Colours:
+        if blue in bands and red in bands:
+            for epoch in Epochs:
+                index = peakindex[:, reference] + int(round(epoch / step))
+                colour = At(mags[:, bands.index(blue)], index) - At(mags[:, bands.index(red)], index)
+                out[f"{blue}_{red}_colour_{epoch:g}d"] = np.where(found[:, reference], colour, np.nan)
+    return out
+
+def FromColumns(columns, bands, step=0.5):
+    """Features of one exported light curve ({column: array}, as GridStore takes it), resampled as LightCurveGrid.Build does"""
+    from MesaStella.LightCurveGrid import Resample
+    bands = [band for band in bands if band in columns]
+    times = np.arange(0, float(np.nanmax(columns["time"])) + step, step)
+    features = Extract(times, Resample(columns, bands, times)[None], bands)
+    return {name: float(values[0]) for name, values in features.items()}
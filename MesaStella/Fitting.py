@@ -0,0 +1,209 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from MesaStella import Photometry
+from MesaStella.LightCurveGrid import LightCurveGrid
+
+logger = logging.getLogger(__name__)
+
+# Model features held at once while scoring; about 32 MB of float64
+ChunkElements = 2**22
+
+def Precision(err):
+    """Weight of a Gaussian prior: 0 leaves the offset free, an error of 0 fixes it at its mean"""
+    if err is None or np.isinf(err):
+        return 0.0
+    return 1e12 if err == 0 else 1.0 / err**2
+
+def LoadPhotometry(path):
+    """Reads a photometry file with filter, jd, mag and magerr columns into flat arrays
+
+    Every point is tagged with the index of its band in bands.  Filters that Photometry can't
+    synthesize are dropped with a warning, as are points without a magnitude or a positive error.
+    """
+    frame = pd.read_csv(path)
+    missing = {"filter", "jd", "mag", "magerr"} - set(frame.columns)
+    if missing:
+        raise ValueError(f"Photometry file '{path}' has no {sorted(missing)} column(s)")
+    frame = frame[np.isfinite(frame["mag"]) & (frame["magerr"] > 0)]
+
+    bands = []
+    for band in sorted(frame["filter"].unique()):
+        if band not in Photometry.Filters and band not in ("U", "B", "V", "R", "I"):
+            logger.warning(f"Skipping {np.sum(frame['filter'] == band)} point(s) in '{path}': no filter '{band}' in the registry")
+        elif band not in Photometry.Extinction:
+            logger.warning(f"Skipping filter '{band}' in '{path}': it has no extinction coefficient")
+        else:
+            bands.append(band)
+    frame = frame[frame["filter"].isin(bands)]
+    if not len(frame):
+        raise ValueError(f"No usable photometry in '{path}'")
+
+    band = np.array([bands.index(name) for name in frame["filter"]])
+    return {
+        "name": os.path.splitext(os.path.basename(path))[0],
+        "bands": bands,
+        "band": band,
+        "jd": frame["jd"].to_numpy(dtype=np.float64),
+        "mag": frame["mag"].to_numpy(dtype=np.float64),
+        "weight": 1.0 / frame["magerr"].to_numpy(dtype=np.float64)**2,
+        "extinction": np.array([Photometry.Extinction[bands[b]] for b in band]),
+    }
+
+def Coefficients(obs, shifts, times, step, mu, ebv):
+    """Per-band matrices that turn a model's features into every sum chi2 needs, for all shifts at once
+
+    A point at phase p falls between grid times j and j + 1 with weight f on the later one, so the model's
+    value there is (1 - f) m_j + f m_j+1, and its square is a sum of m_j^2, m_j m_j+1 and m_j+1^2.  Every
+    sum over points of a weight times 1, m or m^2 is therefore linear in those per-time features, with
+    coefficients that only depend on the observations and the shift.  Returns the time range the features
+    cover and, per band, the q (coverage), m and m^2 matrices; see ScoreBlock for how they're used.
+    """
+    phase = (obs["jd"] - obs["jd"].min())[None, :] + shifts[:, None]
+    position = (phase - times[0]) / step
+    lower = np.floor(position).astype(np.int64)
+    frac = position - lower
+    # Points before the explosion or past the end of the grid can't be fitted and are left out of every sum
+    valid = (lower >= 0) & (lower + 1 < len(times))
+    if not valid.any():
+        return None
+    first, last = lower[valid].min(), lower[valid].max() + 1
+    length = last - first
+
+    R = obs["extinction"]
+    target = obs["mag"] - mu - R * ebv
+    w = obs["weight"]
+    qweights = np.stack([np.ones_like(w), w, w * R, w * R * R, w * target, w * R * target, w * target**2], axis=1)
+    mweights = np.stack([w, w * R, w * target], axis=1)
+
+    shift, point = np.nonzero(valid)
+    j = lower[shift, point] - first
+    f = frac[shift, point]
+    nshifts = len(shifts)
+    matrices = []
+    for b in range(len(obs["bands"])):
+        mine = obs["band"][point] == b
+        s, k, jb, fb = shift[mine], point[mine], j[mine], f[mine]
+        q = np.zeros((length, nshifts, 7))
+        np.add.at(q, (jb, s), qweights[k])
+        m = np.zeros((2, length, nshifts, 3))
+        np.add.at(m[0], (jb, s), mweights[k] * (1 - fb)[:, None])
+        np.add.at(m[1], (jb, s), mweights[k] * fb[:, None])
+        m2 = np.zeros((3, length, nshifts))
+        np.add.at(m2[0], (jb, s), w[k] * (1 - fb)**2)
+        np.add.at(m2[1], (jb, s), w[k] * 2 * fb * (1 - fb))
+        np.add.at(m2[2], (jb, s), w[k] * fb**2)
+        matrices.append((q.reshape(length, -1), m.reshape(2 * length, -1), m2.reshape(3 * length, -1)))
+    return first, last, matrices
+
+def ScoreBlock(grid, start, stop, obs, shifts, mu, ebv, penalty):
+    """Best fit of models start:stop of a grid; see Fit.  Returns arrays of chi2, shift, mu, E(B-V) and points used
+
+    Rather than interpolating every model at every point for every shift, each model is reduced to a few
+    features per grid time, and Coefficients' matrices turn those into the sums for all shifts with one
+    matrix product per band.  The distance modulus and E(B-V) that minimise chi2 are then solved for
+    exactly, from the 2x2 weighted normal equations.
+    """
+    nmodels, nshifts, npoints = stop - start, len(shifts), len(obs["mag"])
+    chi2 = np.full(nmodels, np.inf)
+    best = np.zeros(nmodels, dtype=np.int64)
+    dmu = np.full(nmodels, np.nan)
+    debv = np.full(nmodels, np.nan)
+    used = np.zeros(nmodels, dtype=np.int64)
+    found = Coefficients(obs, shifts, grid.times, grid.step, mu[0], ebv[0])
+    if found is None:
+        return chi2, shifts[best], dmu, debv, used
+    first, last, matrices = found
+    pmu, pebv = Precision(mu[1]), Precision(ebv[1])
+
+    chunk = max(1, ChunkElements // (6 * (last - first) * len(obs["bands"])))
+    for lo in range(start, stop, chunk):
+        hi = min(stop, lo + chunk)
+        block = np.asarray(grid.data[lo:hi, first:last + 1])
+        converted = Photometry.Convert({band: block[..., j] for j, band in enumerate(grid.bands)}, obs["bands"], np.float64)
+        q = np.zeros((hi - lo, nshifts * 7))
+        m = np.zeros((hi - lo, nshifts * 3))
+        m2 = np.zeros((hi - lo, nshifts))
+        for band, (qmatrix, mmatrix, m2matrix) in zip(obs["bands"], matrices):
+            values = converted[band]
+            covered = ~np.isnan(values)
+            values = np.where(covered, values, 0)
+            # Both ends of an interval have to be there for a point inside it to be
+            inside = covered[:, :-1] & covered[:, 1:]
+            m0, m1 = values[:, :-1] * inside, values[:, 1:] * inside
+            q += inside @ qmatrix
+            m += np.concatenate([m0, m1], axis=1) @ mmatrix
+            m2 += np.concatenate([m0 * m0, m0 * m1, m1 * m1], axis=1) @ m2matrix
+        q = q.reshape(-1, nshifts, 7)
+        m = m.reshape(-1, nshifts, 3)
+
+        # With d = target - model over the covered points: sum(w d), sum(w R d) and sum(w d^2)
+        d0 = q[..., 4] - m[..., 0]
+        d1 = q[..., 5] - m[..., 1]
+        dd = q[..., 6] - 2 * m[..., 2] + m2
+        a, b, c = q[..., 1] + pmu, q[..., 2], q[..., 3] + pebv
+        with np.errstate(divide="ignore", invalid="ignore"):
+            det = a * c - b * b
+            x = (c * d0 - b * d1) / det
+            y = (a * d1 - b * d0) / det
+        count = np.rint(q[..., 0]).astype(np.int64)
+        score = dd - x * d0 - y * d1 + penalty * (npoints - count)
+        score[~np.isfinite(score)] = np.inf
+
+        pick = np.argmin(score, axis=1)
+        take = np.arange(hi - lo)
+        span = slice(lo - start, hi - start)
+        chi2[span] = score[take, pick]
+        best[span] = pick
+        dmu[span] = x[take, pick]
+        debv[span] = y[take, pick]
+        used[span] = count[take, pick]
+    return chi2, shifts[best], mu[0] + dmu, ebv[0] + debv, used
+
+def Fit(grid, obs, shifts, mu=(0.0, np.inf), ebv=(0.0, np.inf), penalty=25.0, workers=1):
+    """Scores every model of a LightCurveGrid against observed photometry; returns a table ranked by chi2
+
+    shifts are the days between explosion and the first observation to try.  mu and ebv are (mean, error)
+    Gaussian priors on the distance modulus and E(B-V), with an infinite error for a free offset and 0 to
+    hold one fixed.  Every point a model doesn't cover at a shift adds penalty to its chi2.  loglike is
+    -chi2 / 2, up to a constant that's the same for every model.  With more than one worker the models are
+    split over a process pool; each worker maps the same grid file rather than receiving a copy.
+    """
+    if isinstance(grid, str):
+        grid = LightCurveGrid(grid)
+    shifts = np.asarray(shifts, dtype=np.float64)
+    blocks = np.array_split(np.arange(len(grid)), max(1, min(workers, len(grid))))
+    blocks = [(block[0], block[-1] + 1) for block in blocks if len(block)]
+
+    args = [(grid, start, stop, obs, shifts, mu, ebv, penalty) for start, stop in blocks]
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(len(blocks)) as executor:
+            results = list(executor.map(ScoreBlock, *zip(*args)))
+    else:
+        results = [ScoreBlock(*arg) for arg in args]
+    chi2, shift, fitmu, fitebv, used = (np.concatenate(columns) for columns in zip(*results))
+
+    table = pd.DataFrame(grid.params)
+    table["chi2"] = chi2
+    table["redchi2"] = chi2 / max(1, len(obs["mag"]) - 2)
+    table["loglike"] = -0.5 * chi2
+    table["shift"] = shift
+    table["explosion_jd"] = obs["jd"].min() - shift
+    table["mu"] = fitmu
+    table["ebv"] = fitebv
+    table["points"] = used
+    table = table.sort_values("chi2", kind="stable").reset_index(drop=True)
+    table.index.name = "rank"
+    return table
+
+if __name__ == "__main__":
+    # Fits a built grid by hand: python -m MesaStella.Fitting DataExports/<gridtag>/grid InputFiles/<object>.csv [workers]
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    observed = LoadPhotometry(sys.argv[2])
+    ranked = Fit(sys.argv[1], observed, np.arange(0, 30.25, 0.25), workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    print(ranked.head(20).to_string())
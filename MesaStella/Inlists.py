@@ -0,0 +1,117 @@
+import os
+import re
+from functools import lru_cache
+
+# Which namelist entries of which template files get filled in from a Sim.  Values are Sim attribute
+# names, or functions of the Sim for anything derived.  Keys are matched by name, not by line.
+InlistMap = {
+    "PreCC/inlist_mass_Z_wind_rotation": {
+        "new_Z": "metallicity",
+        "Zbase": "metallicity",
+        "initial_mass": "mass",
+        "initial_z": "metallicity",
+        "initial_y": "HeFrac",
+        "Dutch_scaling_factor": "windscalar",
+    },
+    "PostCC/inlist_mass_Z": {
+        "new_Z": "metallicity",
+        "Zbase": "metallicity",
+        "initial_z": "metallicity",
+        "initial_mass": "mass",
+    },
+    "PostCC/inlist_edep": {
+        "initial_mass": "mass",
+        "initial_z": "metallicity",
+        "inject_until_reach_model_with_total_energy": lambda sim: f"{sim.energy}d+50",
+    },
+    "PostCC/inlist_shock_part3": {
+        "x_ctrl(12)": "ni56",
+    },
+    "PostCC/inlist_shock_part5": {
+        "x_ctrl(12)": "ni56",
+    },
+    "PostCC/inlist_stella": {
+        # Adds CSM cells if CSM is present
+        "stella_nz_extra": lambda sim: 40 if sim.csmrate != 0 else 0,
+        "stella_mdot_years_for_wind": "csmtime",
+        "stella_mdot_for_wind": "csmrate",
+        "stella_v_wind": "csmvelo",
+    },
+}
+
+# A namelist assignment whose value is still the placeholder, e.g. "   x_ctrl(12) = PLACEHOLDER ! comment"
+PlaceholderLine = re.compile(r"^(\s*)([A-Za-z_]\w*(?:\(\s*\d+\s*\))?)(\s*=\s*)PLACEHOLDER", re.MULTILINE)
+
+class UnfilledPlaceholder(Exception):
+    pass
+
+def InlistValues(sim):
+    """Resolves InlistMap for one sim into {relpath: ((key, value), ...)}, hashable so renders can be cached"""
+    out = {}
+    for relpath, entries in InlistMap.items():
+        values = []
+        for key, source in entries.items():
+            value = source(sim) if callable(source) else getattr(sim, source)
+            values.append((key, str(value)))
+        out[relpath] = tuple(values)
+    return out
+
+@lru_cache(maxsize=None)
+def TemplateText(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+@lru_cache(maxsize=None)
+def PlaceholderFiles(templatedir):
+    """Every file in a template that still has a placeholder in it, so none can be missed"""
+    found = set()
+    for dirpath, _, filenames in os.walk(templatedir):
+        for name in filenames:
+            if name.startswith("inlist"):
+                path = os.path.join(dirpath, name)
+                if "PLACEHOLDER" in TemplateText(path):
+                    found.add(os.path.relpath(path, templatedir))
+    return frozenset(found)
+
+@lru_cache(maxsize=4096)
+def RenderInlist(path, values):
+    """Fills every placeholder of a template inlist in one pass, checking that each one and each value is used"""
+    lookup = {key.replace(" ", "").lower(): value for key, value in values} # Fortran names are case-insensitive
+    used = set()
+
+    def Fill(match):
+        key = match.group(2).replace(" ", "").lower()
+        if key not in lookup:
+            return match.group(0)
+        used.add(key)
+        return f"{match.group(1)}{match.group(2)}{match.group(3)}{lookup[key]}"
+
+    text = PlaceholderLine.sub(Fill, TemplateText(path))
+
+    if "PLACEHOLDER" in text:
+        line = next(line for line in text.splitlines() if "PLACEHOLDER" in line)
+        raise UnfilledPlaceholder(f"No value for '{line.strip()}' in '{path}'")
+    unused = set(lookup) - used
+    if unused:
+        raise UnfilledPlaceholder(f"'{path}' has no placeholder for {sorted(unused)}")
+    return text
+
+def RenderInlists(templatedir, sim):
+    """Renders every parameterised inlist of a template for a sim; returns {relpath: text}"""
+    values = InlistValues(sim)
+    missing = PlaceholderFiles(templatedir) - set(values)
+    if missing:
+        raise UnfilledPlaceholder(f"No parameters mapped for {sorted(missing)} in '{templatedir}'")
+    return {relpath: RenderInlist(os.path.join(templatedir, relpath), values[relpath]) for relpath in values}
+
+@lru_cache(maxsize=64)
+def ReplaceBlock(path, block, start_marker="# BEGIN BLOCK", end_marker="# END BLOCK"):
+    """Returns a template script with the text between its block markers swapped for block"""
+    lines = TemplateText(path).splitlines(keepends=True)
+
+    # Find indices of the start and end markers
+    start_index = next(i for i, line in enumerate(lines) if line.strip() == start_marker)
+    end_index = next(i for i, line in enumerate(lines) if line.strip() == end_marker)
+
+    new_block = [start_marker + "\n", *[line + "\n" for line in block.split("\n")], end_marker + "\n"]
+    return "".join(lines[:start_index] + new_block + lines[end_index + 1:])
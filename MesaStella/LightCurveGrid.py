@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Models are stored sorted by these, so that a query fixing the leading parameters picks out one contiguous block
+SortOrder = ["mass", "energy", "ni56", "metallicity", "HeFrac", "windscalar", "csmtime", "csmrate", "csmvelo"]
+
+def ParamTable(entries):
+    """Structured array of every model's parameters and directory name; numbers (and flags) become float64"""
+    fields = {}
+    for entry in entries:
+        for key, value in entry["params"].items():
+            if isinstance(value, str):
+                fields[key] = max(fields.get(key, 1), len(value))
+            elif key not in fields:
+                fields[key] = None
+    dtype = [("dirname", f"U{max([len(entry['dirname']) for entry in entries] + [1])}")]
+    dtype += [(key, np.float64 if width is None else f"U{width}") for key, width in fields.items()]
+
+    table = np.zeros(len(entries), dtype=dtype)
+    for i, entry in enumerate(entries):
+        table["dirname"][i] = entry["dirname"]
+        for key, width in fields.items():
+            value = entry["params"].get(key)
+            if width is None:
+                table[key][i] = np.nan if value is None else float(value)
+            else:
+                table[key][i] = "" if value is None else value
+    return table
+
+def Resample(columns, bands, times):
+    """One model's light curve ({column: array}) interpolated onto times, as times x bands with NaN outside it"""
+    # Stella repeats its first few time steps, and np.interp wants them strictly increasing
+    modeltimes, first = np.unique(columns["time"], return_index=True)
+    out = np.full((len(times), len(bands)), np.nan)
+    for j, band in enumerate(bands):
+        if band in columns:
+            out[:, j] = np.interp(times, modeltimes, columns[band][first], left=np.nan, right=np.nan)
+    return out
+
+def Build(store, path, step=0.5, bands=None):
+    """Resamples every light curve in a GridStore onto one time grid and writes it as a memory-mappable grid
+
+    The grid is models x times x bands of float32, with NaN wherever a model doesn't cover a time.  It's
+    written next to path and renamed into place, so readers never see a half-written grid.
+    """
+    entries = store.Index()
+    if not entries:
+        return None
+    columns = store.Columns()
+    if bands is None:
+        bands = [name for name in sorted(columns) if name != "time"]
+
+    table = ParamTable(entries)
+    keys = [key for key in reversed(SortOrder) if key in table.dtype.names and table.dtype[key] == np.float64]
+    order = np.lexsort([table[key] for key in keys]) if keys else np.arange(len(entries))
+    table = table[order]
+    entries = [entries[i] for i in order]
+
+    tmax = max(float(np.nanmax(columns["time"][entry["offset"]:entry["offset"] + entry["length"]])) for entry in entries)
+    times = np.arange(0, tmax + step, step)
+
+    staging = f"{path}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    data = np.lib.format.open_memmap(os.path.join(staging, "lightcurves.npy"), mode="w+", dtype=np.float32,
+                                     shape=(len(entries), len(times), len(bands)))
+    for i, entry in enumerate(entries):
+        rows = slice(entry["offset"], entry["offset"] + entry["length"])
+        data[i] = Resample({name: columns[name][rows] for name in ["time"] + entry["columns"] if name in columns}, bands, times)
+    data.flush()
+    del data
+
+    np.save(os.path.join(staging, "params.npy"), table)
+    np.save(os.path.join(staging, "times.npy"), times)
+    with open(os.path.join(staging, "meta.json"), "w") as file:
+        json.dump({"bands": bands, "step": step, "models": len(entries)}, file, indent=1)
+
+    if os.path.exists(path):
+        shutil.rmtree(f"{path}.old", ignore_errors=True)
+        os.replace(path, f"{path}.old")
+    os.replace(staging, path)
+    shutil.rmtree(f"{path}.old", ignore_errors=True)
+    logger.info(f"Built light curve grid '{path}': {len(entries)} models x {len(times)} times x {len(bands)} bands")
+    return path
+
+class LightCurveGrid:
+    """Read-only, memory-mapped model grid with a parameter index
+
+    Every process that opens the same grid shares the operating system's one cached copy of it, and
+    pickling a grid only sends its path, so it can be handed to worker processes cheaply.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.load(os.path.join(path, "lightcurves.npy"), mmap_mode="r")
+        self.params = np.load(os.path.join(path, "params.npy"))
+        self.times = np.load(os.path.join(path, "times.npy"))
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        self.bands = meta["bands"]
+        self.step = meta["step"]
+        self.sorted = {} # parameter -> (argsort, sorted values), built the first time it's queried
+
+    def __reduce__(self):
+        return (LightCurveGrid, (self.path,))
+
+    def __len__(self):
+        return len(self.params)
+
+    def Band(self, band):
+        return self.bands.index(band)
+
+    def _Sorted(self, key):
+        if key not in self.sorted:
+            order = np.argsort(self.params[key], kind="stable")
+            self.sorted[key] = (order, self.params[key][order])
+        return self.sorted[key]
+
+    def Select(self, **conditions):
+        """Indices of the models matching every condition, in grid order
+
+        A condition is a value for equality (to within float rounding) or a (low, high) tuple for an
+        inclusive range, e.g. Select(mass=11, csmrate=(0.001, 0.01)).  Either end of a range can be None.
+        """
+        selected = None
+        for key, condition in conditions.items():
+            if key not in self.params.dtype.names:
+                raise KeyError(f"Grid has no parameter '{key}' - is it one of {self.params.dtype.names}?")
+            order, values = self._Sorted(key)
+            if self.params.dtype[key].kind == "U":
+                low = high = condition
+                lo, hi = np.searchsorted(values, low, "left"), np.searchsorted(values, high, "right")
+            else:
+                low, high = condition if isinstance(condition, tuple) else (condition, condition)
+                low = -np.inf if low is None else low
+                high = np.inf if high is None else high
+                # Parameters come from the simlist through float formatting, so equality gets a little slack
+                lo = np.searchsorted(values, low - 1e-9 * max(1, abs(low)), "left")
+                hi = np.searchsorted(values, high + 1e-9 * max(1, abs(high)), "right")
+            match = order[lo:hi]
+            selected = match if selected is None else np.intersect1d(selected, match, assume_unique=True)
+        if selected is None:
+            return np.arange(len(self))
+        return np.sort(selected)
+
+    def Query(self, bands=None, **conditions):
+        """Returns (params, light curves) for the models matching the conditions
+
+        The light curves are a view into the mapped grid, without copying, whenever the matches are
+        contiguous, which they are for any query on leading parameters of SortOrder.  Otherwise they're
+        gathered into a new array.
+        """
+        indices = self.Select(**conditions)
+        # A single band name keeps the result a view; a list of them has to be gathered
+        if bands is None:
+            bandindex = slice(None)
+        elif isinstance(bands, str):
+            bandindex = self.Band(bands)
+        else:
+            bandindex = [self.Band(band) for band in bands]
+        if len(indices) and indices[-1] - indices[0] + 1 == len(indices):
+            data = self.data[indices[0]:indices[-1] + 1]
+        else:
+            data = self.data[indices]
+        if bands is not None:
+            data = data[..., bandindex]
+        return self.params[indices], data
+
+if __name__ == "__main__":
+    # Rebuilds the grid of an export directory by hand: python -m MesaStella.LightCurveGrid DataExports/<gridtag> [step]
+    import sys
+    from MesaStella.ExportStore import GridStore
+    logging.basicConfig(level=logging.INFO)
+    Build(GridStore(sys.argv[1]), os.path.join(sys.argv[1], "grid"), float(sys.argv[2]) if len(sys.argv) > 2 else 0.5)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from MesaStella.ProgCache import FileLock
+from MesaStella import Retention
+
+logger = logging.getLogger(__name__)
+
+# The stages of a sim's chain, in the order they run
+Stages = ["CreateSim", "PreCC", "PostCC", "Stella", "ExportData"]
+
+def ParamHash(params):
+    """Hashes a sim's parameters, so a row that changed under the same directory name isn't mistaken for a finished one"""
+    text = json.dumps({key: str(value) for key, value in params.items()}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def FileDigest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class RunManifest:
+    """Persistent record of which stages of which sims finished, and what they produced
+
+    Records are appended to a JSON-lines file and replayed on startup, so a crash can at worst lose the
+    line being written, which is then ignored.  A finished stage only counts if all of its artifacts are
+    still there with the size and checksum they had when it finished.  Processes on several hosts can
+    share one manifest: appends take a file lock, and each picks up the others' records as they come.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {} # (dirname, paramhash) -> {stage: artifacts}
+        self.known = set() # dirnames this manifest has ever created
+        self.offset = 0 # How far into the file has been read
+        self.Load()
+
+    def Load(self):
+        if not os.path.exists(self.path):
+            return
+        # Finish off a line cut short by a crash, so the next record doesn't get glued onto it
+        with FileLock(f"{self.path}.lock"), open(self.path, "rb+") as file:
+            if file.seek(0, os.SEEK_END) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+        with self.lock:
+            self.Refresh()
+        logger.info(f"Loaded run manifest with {sum(len(stages) for stages in self.entries.values())} finished stages")
+
+    def Refresh(self):
+        """Replays the records appended since the last read, by this process or any other.  Must be called with the lock held."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            data = file.read()
+        # A line still being written by someone else is left for next time
+        data = data[:data.rfind(b"\n") + 1]
+        for line in data.split(b"\n")[:-1]:
+            self.offset += len(line) + 1
+            try:
+                record = json.loads(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                logger.warning(f"Ignoring unreadable line of the run manifest '{self.path}'")
+                continue
+            key = (record["sim"], record["params"])
+            self.known.add(record["sim"])
+            if record["event"] == "done":
+                self.entries.setdefault(key, {})[record["stage"]] = record["artifacts"]
+            elif record["event"] == "started":
+                # A rerun of a stage makes its old outputs, and everything after them, stale
+                stages = self.entries.get(key, {})
+                for stage in Stages[Stages.index(record["stage"]):]:
+                    stages.pop(stage, None)
+
+    def _Append(self, record):
+        with self.lock, FileLock(f"{self.path}.lock"):
+            with open(self.path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    def Known(self, sim):
+        """Whether the sim's directory was made by a run that used this manifest, and so is safe to replace"""
+        with self.lock:
+            self.Refresh()
+            return sim in self.known
+
+    def Start(self, sim, params, stage):
+        with self.lock:
+            self.known.add(sim)
+            stages = self.entries.get((sim, params), {})
+            for later in Stages[Stages.index(stage):]:
+                stages.pop(later, None)
+        self._Append({"sim": sim, "params": params, "stage": stage, "event": "started", "time": time.time()})
+
+    def Complete(self, sim, params, stage, paths):
+        """Records a stage as finished along with its artifacts, all of which have to exist"""
+        artifacts = {}
+        for path in paths:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"{stage} for {sim} finished without producing '{path}'")
+            artifacts[path] = {"size": os.path.getsize(path), "sha256": FileDigest(path)}
+        with self.lock:
+            self.entries.setdefault((sim, params), {})[stage] = artifacts
+        self._Append({"sim": sim, "params": params, "stage": stage, "event": "done", "time": time.time(), "artifacts": artifacts})
+
+    def IsDone(self, sim, params, stage):
+        """Whether a stage finished and its artifacts are still intact"""
+        with self.lock:
+            self.Refresh()
+            artifacts = self.entries.get((sim, params), {}).get(stage)
+        if artifacts is None:
+            return False
+        for path, meta in artifacts.items():
+            try:
+                if os.path.getsize(path) != meta["size"] or FileDigest(path) != meta["sha256"]:
+                    logger.warning(f"'{path}' changed since {stage} finished for {sim}; rerunning it")
+                    return False
+            except FileNotFoundError:
+                # Compressed after the sim finished, which keeps the original's checksum in the sim's index
+                if Retention.Stat(path) == {"size": meta["size"], "sha256": meta["sha256"]}:
+                    continue
+                logger.warning(f"'{path}' from {stage} of {sim} is missing; rerunning it")
+                return False
+        return True
+    
+    def Artifacts(self, sim, params):
+        """Paths of every artifact the sim's finished stages left"""
+        with self.lock:
+            self.Refresh()
+            return [path for artifacts in self.entries.get((sim, params), {}).values() for path in artifacts]
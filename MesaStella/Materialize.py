@@ -0,0 +1,133 @@
+import errno
+import fcntl
+import fnmatch
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# Template files that are only ever read during a run, so every sim can share the template's copy.
+# Paths are relative to the template root.  Anything not listed here gets a real copy.
+SharedPatterns = [
+    "*/src/*", # MESA and Stella Fortran sources
+    "*/make/makefile",
+    "*.list", # History and profile columns
+    "*.net",
+    "*/standard_*.mod", # rn overwrites these with cp --remove-destination, which never writes through a link
+    "*/pre_ccsn.mod", # Replaced with a rename by the progenitor cache
+    "*/docs/*",
+    "*/README*",
+    "*/testhub.yml",
+    "*/.vscode/*",
+    "*/stella/test/*",
+    "*/stella/obj/*.mak",
+    "*/stella/obj/*.inc",
+    "*/stella/strad/*.f",
+    "*/stella/strad/*.trf",
+    "*/stella/vladsf/*.f",
+    "*/stella/vladsf/*.trf",
+    "*/stella/vladsf/yakovlev*", # Opacity data
+    "*/stella/eve/*.f",
+    "*/stella/eve/*.trf",
+    "*/stella/eve/run/*.sample",
+    "*/stella/strad/run/*.sample",
+    "*/stella/res/*.dat",
+    "*/stella/res/*.f90",
+    "*/stella/res/makefile",
+]
+
+# Linux ioctl that makes dst share src's extents (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+Modes = ("copy", "link", "symlink")
+
+def IsShared(relpath, src):
+    """Whether a template file can be linked rather than copied"""
+    name = os.path.basename(relpath)
+    # Inlists with placeholders get filled in per sim, and do_one copies each header over 'inlist'
+    if name.startswith("inlist"):
+        if name == "inlist":
+            return False
+        with open(src, "rb") as file:
+            return b"PLACEHOLDER" not in file.read()
+    return any(fnmatch.fnmatch(relpath, pattern) for pattern in SharedPatterns)
+
+def IsStaleOutput(relpath):
+    """Leftovers from whatever run the template was made from, which a new run regenerates"""
+    parts = relpath.split(os.sep)
+    if "photos" in parts[:-1]:
+        return True
+    # Models sitting directly in PreCC/ or PostCC/ are outputs of rn, apart from its inputs
+    if len(parts) == 2 and parts[1].endswith(".mod"):
+        return not (parts[1].startswith("standard_") or parts[1] == "pre_ccsn.mod")
+    return False
+
+def CopyFile(src, dst):
+    """Copies a file, sharing its blocks with a reflink where the filesystem allows; returns True if it reflinked"""
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            reflinked = True
+        except OSError:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+            reflinked = False
+    shutil.copystat(src, dst)
+    return reflinked
+
+def LinkFile(src, dst, mode):
+    """Hard links (falling back to a symlink across filesystems) or symlinks dst to src"""
+    if mode == "link":
+        try:
+            os.link(src, dst)
+            return "hardlinked"
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    os.symlink(os.path.abspath(src), dst)
+    return "symlinked"
+
+def Materialize(src, dst, mode="link", exclude=()):
+    """Creates a sim directory from a template and returns counts of what was done
+
+    'copy' reproduces the template exactly.  'link' and 'symlink' share read-only files with the template,
+    copy the rest (with a reflink where possible) and leave out the template's stale run outputs.
+    Paths in exclude are left for the caller to write.
+    """
+    if mode not in Modes:
+        raise ValueError(f"Unknown materialization mode '{mode}' - is it one of {Modes}?")
+
+    stats = {"copied": 0, "reflinked": 0, "hardlinked": 0, "symlinked": 0, "skipped": 0,
+             "bytes_written": 0, "bytes_shared": 0}
+
+    os.makedirs(dst)
+    for dirpath, dirnames, filenames in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        for name in dirnames:
+            os.makedirs(os.path.join(dst, reldir, name), exist_ok=True)
+
+        for name in filenames:
+            relpath = os.path.normpath(os.path.join(reldir, name))
+            if relpath in exclude:
+                continue
+            srcpath = os.path.join(src, relpath)
+            dstpath = os.path.join(dst, relpath)
+
+            if os.path.islink(srcpath):
+                os.symlink(os.readlink(srcpath), dstpath)
+                continue
+
+            size = os.path.getsize(srcpath)
+            if mode != "copy" and IsStaleOutput(relpath):
+                stats["skipped"] += 1
+            elif mode != "copy" and IsShared(relpath, srcpath):
+                stats[LinkFile(srcpath, dstpath, mode)] += 1
+                stats["bytes_shared"] += size
+            elif CopyFile(srcpath, dstpath):
+                stats["reflinked"] += 1
+                stats["bytes_shared"] += size
+            else:
+                stats["copied"] += 1
+                stats["bytes_written"] += size
+
+    return stats
@@ -0,0 +1,169 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+def HashFiles(root, relpaths):
+    """Hashes the names and contents of the given files relative to root"""
+    digest = hashlib.sha256()
+    for relpath in sorted(relpaths):
+        digest.update(relpath.encode() + b"\0")
+        with open(os.path.join(root, relpath), "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def AtomicCopy(src, dst):
+    """Copies src to dst through a temporary file so readers never see a partial file"""
+    tmp = os.path.join(os.path.dirname(dst), f".tmp-{uuid.uuid4().hex}-{os.path.basename(dst)}")
+    try:
+        with open(src, "rb") as fin, open(tmp, "wb") as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+@contextmanager
+def FileLock(path, shared=False, blocking=True):
+    """Holds an flock on path, which works across processes and hosts sharing the directory
+
+    Yields False instead of waiting if blocking is off and someone else holds the lock.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+class ProgenitorCache:
+    """Content-addressed store of pre-core-collapse models, safe to share between concurrent runs
+
+    kind is what the models are called in the log, since the same store also keeps other MESA models.
+    onpublish, if given, is called whenever a model is added, e.g. to wake up jobs waiting for it.
+    """
+
+    def __init__(self, root, maxbytes, kind="progenitor", onpublish=None):
+        self.root = root
+        self.maxbytes = maxbytes
+        self.kind = kind
+        self.onpublish = onpublish
+        self.lockdir = os.path.join(root, "locks")
+        os.makedirs(self.lockdir, exist_ok=True)
+
+    def ModelPath(self, key):
+        return os.path.join(self.root, f"{key}.mod")
+
+    def InfoPath(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    def Lock(self, key, shared=False, blocking=True):
+        """Holds a file lock on a cache entry; yields False if a non-blocking lock couldn't be taken"""
+        return FileLock(os.path.join(self.lockdir, f"{key}.lock"), shared, blocking)
+
+    def _Copy(self, key, dest):
+        """Copies a cached model to dest without taking the lock"""
+        path = self.ModelPath(key)
+        if not os.path.exists(path):
+            return False
+        AtomicCopy(path, dest)
+        # The modification time doubles as the last-used time for eviction
+        os.utime(path)
+        return True
+
+    def Has(self, key):
+        return os.path.exists(self.ModelPath(key))
+
+    def Fetch(self, key, dest):
+        """Copies a cached model to dest, waiting for any build of it in progress; returns False on a miss"""
+        with self.Lock(key, shared=True):
+            return self._Copy(key, dest)
+
+    def Build(self, key, dest, builder, info):
+        """Fetches the model for key into dest, running builder() and publishing its output on a miss
+
+        builder returns the path of the model it made.  Concurrent callers with the same key wait for the
+        first one rather than duplicating the work.
+        """
+        with self.Lock(key):
+            if self._Copy(key, dest):
+                logger.info(f"{self.kind.capitalize()} cache hit for {info.get('name', info.get('premodname', key))}")
+                return False
+
+            logger.info(f"{self.kind.capitalize()} cache miss for {info.get('name', info.get('premodname', key))}; building it")
+            built = builder()
+            self._Publish(key, built, info)
+            if os.path.abspath(built) != os.path.abspath(dest):
+                AtomicCopy(built, dest)
+
+        self.Evict(protect=(key,))
+        return True
+
+    def _Publish(self, key, path, info):
+        # Publish the metadata first so that any visible model always has its description next to it
+        tmp = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}.json")
+        with open(tmp, "w") as file:
+            json.dump({**info, "key": key, "created": time.time()}, file, indent=1)
+        os.replace(tmp, self.InfoPath(key))
+        AtomicCopy(path, self.ModelPath(key))
+        logger.info(f"Published {self.kind} {info.get('name', info.get('premodname', key))} to the cache as {key}")
+        if self.onpublish is not None:
+            self.onpublish()
+
+    def Publish(self, key, path, info):
+        """Adds a model that was made elsewhere, unless the cache already has one for key; returns whether it was added"""
+        with self.Lock(key):
+            if self.Has(key):
+                return False
+            self._Publish(key, path, info)
+        self.Evict(protect=(key,))
+        return True
+
+    def Evict(self, protect=()):
+        """Removes the least recently used models until the cache fits within maxbytes"""
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(".mod") and not name.startswith(".tmp-"):
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name[:-len(".mod")]))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            if key in protect:
+                continue
+            # Entries being built or read by anyone right now are left alone
+            with self.Lock(key, blocking=False) as locked:
+                if not locked:
+                    continue
+                for path in (self.ModelPath(key), self.InfoPath(key)):
+                    if os.path.exists(path):
+                        os.remove(path)
+            total -= size
+            logger.info(f"Evicted {self.kind} {key} from the cache")
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from MesaStella.LightCurveGrid import SortOrder
+
+logger = logging.getLogger(__name__)
+
+def Midpoint(low, high, uselog):
+    """Halfway between two values, geometrically on a log axis, rounded to 4 significant figures for the sim's name"""
+    middle = np.sqrt(low * high) if uselog else (low + high) / 2
+    return float(f"{middle:.4g}")
+
+def Key(params):
+    # Parameters as they'd be compared between sims, without float formatting noise
+    return tuple(sorted((key, round(value, 10) if isinstance(value, float) else value) for key, value in params.items()))
+
+def RowParams(row):
+    """A grid parameter row as a dict of plain Python values"""
+    return {key: row[key].item() for key in row.dtype.names if key != "dirname"}
+
+class Refiner:
+    """Proposes where to add sims to a grid next, from the light curves it already has
+
+    Every pair of neighbouring models (adjacent along one parameter, equal in all the others) is an
+    interval that can be split at its midpoint.  An interval's score is how much the light curve changes
+    across it, as the RMS magnitude difference, and in 'fit' mode that is weighted by how well the better
+    of its two ends fits the observed light curve, so intervals in regions the data rule out aren't refined.
+    Each call proposes the best-scoring intervals' midpoints, until the best score drops below tolerance
+    (converged), the intervals get narrower than minspacing of the parameter's range, or the budget of
+    sims or iterations runs out.  Every proposal and the reason for it, and the reason for stopping,
+    are appended to a JSON lines record at path, which is also what a rerun resumes from.
+    """
+
+    def __init__(self, path, mode="change", bands=("MB", "MV", "MR"), batch=10, maxsims=100, maxiterations=10,
+                 tolerance=0.05, minspacing=0.01):
+        if mode not in ("change", "fit"):
+            raise ValueError(f"Refinement mode must be 'change' or 'fit', not '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.bands = list(bands)
+        self.batch = batch
+        self.maxsims = maxsims
+        self.maxiterations = maxiterations
+        self.tolerance = tolerance
+        self.minspacing = minspacing
+        self.lock = threading.Lock()
+
+        self.proposed = set()
+        self.iteration = 0
+        self.stopped = None
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # A record cut short by a crash
+                    self.iteration = max(self.iteration, record["iteration"] + 1)
+                    if record["event"] == "proposed":
+                        self.proposed.add(Key(record["params"]))
+
+    def Record(self, event, **fields):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(json.dumps({"event": event, "iteration": self.iteration, "time": time.time(), **fields}) + "\n")
+
+    def Stop(self, reason):
+        self.stopped = reason
+        self.Record("stopped", reason=reason)
+        logger.info(f"Refinement of '{os.path.dirname(self.path)}' stopped after {self.iteration} iteration(s): {reason}")
+        return []
+
+    def Intervals(self, grid):
+        """(first, second, parameter) for every pair of models adjacent along one parameter"""
+        params = grid.params
+        axes = [key for key in SortOrder if key in params.dtype.names and params.dtype[key] == np.float64]
+        others = [key for key in params.dtype.names if key != "dirname"]
+        for axis in axes:
+            groups = {}
+            for i, row in enumerate(params):
+                rest = tuple(round(float(row[key]), 10) if params.dtype[key] == np.float64 else row[key] for key in others if key != axis)
+                groups.setdefault(rest, []).append(i)
+            for members in groups.values():
+                members.sort(key=lambda i: params[axis][i])
+                for first, second in zip(members, members[1:]):
+                    if params[axis][second] > params[axis][first]:
+                        yield first, second, axis
+
+    def Propose(self, grid, ranked=None):
+        """Parameter sets of the next batch of sims; an empty list once refinement has stopped
+
+        ranked is Fitting.Fit's table for the grid, which 'fit' mode needs.  Each proposal is a dict of
+        the grid's parameters, with the reason it was chosen recorded alongside it.
+        """
+        if self.stopped:
+            return []
+        if self.iteration >= self.maxiterations:
+            return self.Stop(f"reached {self.maxiterations} iterations")
+        if len(self.proposed) >= self.maxsims:
+            return self.Stop(f"reached the budget of {self.maxsims} sims")
+
+        bands = [grid.Band(band) for band in self.bands if band in grid.bands]
+        if not bands:
+            raise ValueError(f"Grid has none of the bands {self.bands} to compare light curves in")
+        existing = {Key(RowParams(row)) for row in grid.params}
+
+        weights = np.ones(len(grid))
+        if self.mode == "fit":
+            if ranked is None:
+                raise ValueError("Refinement in 'fit' mode needs the grid fitted to an observed light curve")
+            chi2 = ranked.set_index("dirname")["chi2"].reindex(grid.params["dirname"]).to_numpy()
+            best = np.nanmin(chi2)
+            # Errors are scaled up until the best model fits, so one bad error bar doesn't rule everything else out
+            scale = max(1.0, float(ranked["redchi2"].min()))
+            weights = np.exp(-0.5 * (chi2 - best) / scale)
+            weights[~np.isfinite(weights)] = 0
+
+        candidates = []
+        narrow = 0
+        for first, second, axis in self.Intervals(grid):
+            values = grid.params[axis]
+            low, high = values[first], values[second]
+            uselog = bool(values.min() > 0 and values.max() / values.min() > 10)
+            if uselog:
+                width = np.log(high / low) / np.log(values.max() / values.min())
+            else:
+                width = (high - low) / np.ptp(values)
+            if width < self.minspacing:
+                narrow += 1
+                continue
+            difference = grid.data[first][:, bands] - grid.data[second][:, bands]
+            if not np.isfinite(difference).any():
+                continue
+            change = float(np.sqrt(np.nanmean(difference**2)))
+            weight = float(max(weights[first], weights[second]))
+            params = RowParams(grid.params[first])
+            params[axis] = Midpoint(float(low), float(high), uselog)
+            if params[axis] in (low, high) or Key(params) in existing or Key(params) in self.proposed:
+                continue
+            reason = {"mode": self.mode, "parameter": axis, "between": [str(grid.params["dirname"][first]), str(grid.params["dirname"][second])],
+                      "values": [float(low), float(high)], "change": change, "weight": weight, "score": change * weight}
+            if self.mode == "fit":
+                reason["chi2"] = [float(chi2[first]), float(chi2[second])]
+            candidates.append((change * weight, params, reason))
+
+        if not candidates:
+            return self.Stop(f"every interval is narrower than {self.minspacing} of its parameter's range" if narrow else "no interval left to split")
+        candidates.sort(key=lambda candidate: -candidate[0])
+        if candidates[0][0] < self.tolerance:
+            return self.Stop(f"converged: the best interval scores {candidates[0][0]:.4f} < {self.tolerance}")
+
+        proposals = []
+        for score, params, reason in candidates[:min(self.batch, self.maxsims - len(self.proposed))]:
+            if score < self.tolerance:
+                break
+            self.proposed.add(Key(params))
+            self.Record("proposed", params=params, reason=reason)
+            proposals.append(params)
+        logger.info(f"Refinement iteration {self.iteration}: {len(proposals)} new sim(s) out of {len(candidates)} candidate interval(s), "
+                    f"best score {candidates[0][0]:.4f}")
+        self.iteration += 1
+        return proposals
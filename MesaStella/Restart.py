@@ -0,0 +1,157 @@
+import logging
+import os
+import re
+import statistics
+
+logger = logging.getLogger(__name__)
+
+# do_one [inlist] [output model] [LOGS directory], as used in MESA's rn scripts
+DoOneLine = re.compile(r"^\s*do_one\s+(\S+)\s+(\S+)", re.MULTILINE)
+
+# Replaces rn's do_one once test_suite_helpers has defined it.  Parts that already finished are skipped, the
+# interrupted one is restarted from a photo with MESA's re script (or from its start if there is none), and
+# everything after it runs as usual.
+Override = '''
+# Added by MesaStellaCore.py to resume an interrupted run
+RESUME_SKIP=" {skip} "
+RESUME_FROM="{resume}"
+RESUME_PHOTO="{photo}"
+RESUME_INLIST="{inlist}"
+eval "resume_do_one() $(declare -f do_one | tail -n +2)"
+function do_one {{
+    if [[ "$RESUME_SKIP" == *" $1 "* ]]; then
+        echo "skipping $1, which finished before the restart"
+        return
+    fi
+    if [ "$1" != "$RESUME_FROM" ]; then
+        resume_do_one "$@"
+        return
+    fi
+    RESUME_FROM=""
+    cp "$RESUME_INLIST" inlist || exit 1
+    echo 'run' "$1"
+    if [ -n "$RESUME_PHOTO" ]; then
+        echo "restarting $1 from photo $RESUME_PHOTO"
+        ./re "$RESUME_PHOTO" || exit 1
+        rm -f restart_photo
+    else
+        if [ -n "$3" ]; then
+            rm -rf "$3"
+        fi
+        ./rn1 || exit 1
+    fi
+    if [ ! -r "$2" ]; then
+        echo "failed to create $2 when resuming $1"
+        exit 1
+    fi
+    echo
+    echo 'finished' "$1"
+}}
+'''
+
+def Parts(workdir, rn="rn"):
+    """The (header, output model) of each do_one in a run script, in order"""
+    with open(os.path.join(workdir, rn), "r") as file:
+        return DoOneLine.findall(file.read())
+
+def Mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+def Interrupted(workdir, parts, since):
+    """Index of the first part whose output model is missing or older than what it was made from"""
+    previous = since
+    for index, (_, output) in enumerate(parts):
+        mtime = Mtime(os.path.join(workdir, output))
+        if mtime is None or mtime < previous:
+            return index, previous
+        previous = mtime
+    return None, previous
+
+def LatestPhoto(workdir, since, failed=()):
+    """The newest photo written after since that looks complete, leaving out ones a restart already failed from
+
+    A photo cut short by a crash is smaller than the ones before it, so anything under half the typical
+    size is passed over.
+    """
+    photodir = os.path.join(workdir, "photos")
+    if not os.path.isdir(photodir):
+        return None
+    photos = []
+    for name in os.listdir(photodir):
+        path = os.path.join(photodir, name)
+        if os.path.isfile(path) and os.path.getmtime(path) >= since:
+            photos.append((os.path.getmtime(path), os.path.getsize(path), name))
+    if not photos:
+        return None
+
+    typical = statistics.median(size for _, size, _ in photos)
+    for _, size, name in sorted(photos, reverse=True):
+        if name in failed:
+            continue
+        if size == 0 or size < typical / 2:
+            logger.warning(f"Photo '{name}' in '{workdir}' looks truncated; skipping it")
+            continue
+        return name
+    return None
+
+def RelaxHeader(text, relaxed):
+    """Adds inlist_relax as the last extra controls inlist of a header, so its values win"""
+    start = text.index("&controls")
+    end = text.index("\n/", start)
+    used = [int(n) for n in re.findall(r"read_extra_controls_inlist\((\d+)\)", text[start:end])]
+    n = max(used, default=0) + 1
+    lines = (f"\n      read_extra_controls_inlist({n}) = .true."
+             f"\n      extra_controls_inlist_name({n}) = '{relaxed}'")
+    return text[:end] + lines + text[end:]
+
+def PrepareResume(workdir, since, script="run_mesa.sh", relaxed=None, failed=(), start=0):
+    """Writes rn_resume and a run script that calls it; returns a description of the restart, or None
+
+    since is when the sim's inlists were written, so leftovers from the template don't count as finished
+    parts.  relaxed is a list of 'name = value' controls to use for the restarted part.  Parts before
+    start are skipped regardless, since their last output model was put in place some other way, e.g.
+    from a checkpoint.  None is returned if every part already finished, in which case there is nothing
+    to resume from.
+    """
+    parts = Parts(workdir)
+    if start:
+        since = max(since, Mtime(os.path.join(workdir, parts[start - 1][1])) or since)
+    index, partstart = Interrupted(workdir, parts[start:], since)
+    if index is None:
+        return None
+    index += start
+    header, output = parts[index]
+
+    photo = LatestPhoto(workdir, partstart, failed)
+
+    inlist = header
+    if relaxed:
+        with open(os.path.join(workdir, "inlist_relax"), "w") as file:
+            file.write("&controls\n" + "".join(f"      {control}\n" for control in relaxed) + "/ ! end of controls namelist\n")
+        with open(os.path.join(workdir, header), "r") as file:
+            text = RelaxHeader(file.read(), "inlist_relax")
+        inlist = "inlist_resume"
+        with open(os.path.join(workdir, inlist), "w") as file:
+            file.write(text)
+
+    skip = " ".join(part for part, _ in parts[:index])
+    with open(os.path.join(workdir, "rn"), "r") as file:
+        rn = file.read()
+    source = re.search(r"^\s*source .*test_suite_helpers.*$", rn, re.MULTILINE)
+    override = Override.format(skip=skip, resume=header, photo=photo or "", inlist=inlist)
+    with open(os.path.join(workdir, "rn_resume"), "w") as file:
+        file.write(rn[:source.end()] + "\n" + override + rn[source.end():])
+    os.chmod(os.path.join(workdir, "rn_resume"), 0o755)
+
+    # Same environment and build step as the normal run script, just running rn_resume instead of rn
+    with open(os.path.join(workdir, script), "r") as file:
+        text = re.sub(r"^(\s*)rn$", r"\1rn_resume", file.read(), flags=re.MULTILINE)
+    resumescript = script.replace(".sh", "_resume.sh")
+    with open(os.path.join(workdir, resumescript), "w") as file:
+        file.write(text)
+    os.chmod(os.path.join(workdir, resumescript), 0o755)
+
+    return {"script": resumescript, "part": header, "output": output, "photo": photo, "skipped": index, "relaxed": bool(relaxed)}
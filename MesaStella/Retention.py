@@ -0,0 +1,228 @@
+import fnmatch
+import hashlib
+import io
+import json
+import logging
+import lzma
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Name of the per-sim index of compressed files, at the top of the sim's directory
+IndexName = "Retained.json"
+
+# Files are compressed in independent blocks of this size, so any part of one can be read without the rest
+BlockSize = 4 << 20
+
+def Codec(name, level):
+    """(extension, compress, decompress) for a codec name; zstd falls back to xz without the zstandard package"""
+    if name == "zstd":
+        try:
+            import zstandard
+            return ".zst", zstandard.ZstdCompressor(level=level).compress, lambda data: zstandard.ZstdDecompressor().decompress(data)
+        except ImportError:
+            logger.warning("zstd needs the zstandard package; compressing with xz instead")
+    elif name != "xz":
+        raise ValueError(f"Unknown compression codec '{name}'; use xz or zstd")
+    return ".xz", lambda data: lzma.compress(data, preset=level), lzma.decompress
+
+def Decompressor(extension):
+    return Codec("zstd" if extension == ".zst" else "xz", 0)[2]
+
+def Matches(relpath, patterns):
+    return any(fnmatch.fnmatchcase(relpath, pattern) for pattern in patterns)
+
+def SameFile(path, template):
+    """Whether a sim's file is the template's, by link or by content"""
+    try:
+        stat = os.stat(path)
+        other = os.stat(template)
+    except FileNotFoundError:
+        return False
+    if (stat.st_dev, stat.st_ino) == (other.st_dev, other.st_ino):
+        return True
+    if stat.st_size != other.st_size:
+        return False
+    with open(path, "rb") as a, open(template, "rb") as b:
+        while True:
+            chunk = a.read(1 << 20)
+            if chunk != b.read(1 << 20):
+                return False
+            if not chunk:
+                return True
+
+def ReadIndex(simdir):
+    try:
+        with open(os.path.join(simdir, IndexName), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"files": {}}
+
+def WriteIndex(simdir, index):
+    path = os.path.join(simdir, IndexName)
+    tmp = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(tmp, "w") as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+def Compress(src, dst, compress):
+    """Compresses src into dst block by block; returns the original's size and sha256 and the blocks' offsets in dst"""
+    digest = hashlib.sha256()
+    offsets = [0]
+    size = 0
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for block in iter(lambda: fin.read(BlockSize), b""):
+            digest.update(block)
+            size += len(block)
+            offsets.append(offsets[-1] + fout.write(compress(block)))
+        fout.flush()
+        os.fsync(fout.fileno())
+    return {"size": size, "sha256": digest.hexdigest(), "offsets": offsets}
+
+def Compact(simdir, templatedir, delete, compress, protect=(), codec="xz", level=6):
+    """Deletes what a finished sim can do without and compresses what it keeps
+
+    Files matching delete, and copies of the template's files, are deleted.  Files matching compress are
+    stored as <name>.xz (or .zst) and recorded in the sim's index, which Open() and Stat() read them back
+    through.  Files in protect (relative paths, e.g. the manifest's artifacts) are never deleted, only
+    compressed.  Safe to interrupt: an original is only removed once the index records its compressed copy.
+    Returns {"deleted", "compressed", "before", "after"}, in files and bytes.
+    """
+    extension, compressor, _ = Codec(codec, level)
+    index = ReadIndex(simdir)
+    protect = set(protect)
+    stored = {entry["stored"] for entry in index["files"].values()}
+    stats = {"deleted": 0, "compressed": 0, "before": 0, "after": 0}
+    # Compressed files a stricter policy than the last one doesn't keep
+    dropped = {index["files"].pop(relpath)["stored"] for relpath in list(index["files"]) if relpath not in protect and Matches(relpath, delete)}
+    stored -= dropped
+    if dropped:
+        WriteIndex(simdir, index)
+    pending = []
+    for dirpath, dirnames, filenames in os.walk(simdir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, simdir)
+            size = os.lstat(path).st_size
+            stats["before"] += size
+            if relpath == IndexName or relpath in stored:
+                stats["after"] += size
+            elif name.startswith(".tmp-"):
+                # Left by an interrupted compaction
+                os.remove(path)
+            elif relpath in dropped:
+                os.remove(path)
+                stats["deleted"] += 1
+            elif relpath not in protect and (Matches(relpath, delete) or os.path.islink(path) or SameFile(path, os.path.join(templatedir, relpath))):
+                os.remove(path)
+                stats["deleted"] += 1
+            elif Matches(relpath, compress):
+                pending.append(relpath)
+            else:
+                stats["after"] += size
+
+    for relpath in pending:
+        path = os.path.join(simdir, relpath)
+        target = relpath + extension
+        tmp = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}-{os.path.basename(target)}")
+        try:
+            entry = Compress(path, tmp, compressor)
+            os.replace(tmp, os.path.join(simdir, target))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        index["files"][relpath] = dict(entry, stored=target)
+        stats["compressed"] += 1
+        stats["after"] += entry["offsets"][-1]
+    if pending:
+        WriteIndex(simdir, index)
+    for relpath in pending:
+        os.remove(os.path.join(simdir, relpath))
+
+    # Directories emptied by the deletions go too
+    for dirpath, dirnames, filenames in os.walk(simdir, topdown=False):
+        if dirpath != simdir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    return stats
+
+def Lookup(path):
+    """(sim directory, index entry) of a file compressed by Compact, found through the nearest index above it, or None"""
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    while True:
+        if os.path.isfile(os.path.join(parent, IndexName)):
+            entry = ReadIndex(parent)["files"].get(os.path.relpath(path, parent))
+            return (parent, entry) if entry is not None else None
+        if os.path.dirname(parent) == parent:
+            return None
+        parent = os.path.dirname(parent)
+
+def Stat(path):
+    """{"size", "sha256"} of a file as it was before Compact compressed it, or None if it wasn't"""
+    found = Lookup(path)
+    if found is None:
+        return None
+    simdir, entry = found
+    if not os.path.isfile(os.path.join(simdir, entry["stored"])):
+        return None
+    return {"size": entry["size"], "sha256": entry["sha256"]}
+
+class RetainedFile(io.RawIOBase):
+    """Reads a file compressed by Compact as if it weren't, decompressing only the blocks that are read"""
+
+    def __init__(self, path, entry):
+        self.file = open(path, "rb")
+        self.offsets = entry["offsets"]
+        self.size = entry["size"]
+        self.decompress = Decompressor(os.path.splitext(path)[1])
+        self.position = 0
+        self.cached = (None, b"")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def Block(self, number):
+        if self.cached[0] != number:
+            self.file.seek(self.offsets[number])
+            self.cached = (number, self.decompress(self.file.read(self.offsets[number + 1] - self.offsets[number])))
+        return self.cached[1]
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        number, within = divmod(self.position, BlockSize)
+        data = self.Block(number)[within:within + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def Open(path, mode="rb"):
+    """Opens a sim's file for reading whether or not Compact compressed it, in binary or text mode"""
+    if mode not in ("r", "rb"):
+        raise ValueError("Retained files can only be read")
+    if os.path.exists(path):
+        return open(path, mode)
+    found = Lookup(path)
+    if found is None:
+        raise FileNotFoundError(f"No such file, compressed or not: '{path}'")
+    simdir, entry = found
+    file = io.BufferedReader(RetainedFile(os.path.join(simdir, entry["stored"]), entry))
+    return file if mode == "rb" else io.TextIOWrapper(file)
@@ -0,0 +1,266 @@
+import copy
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+from MesaStella import Telemetry
+
+logger = logging.getLogger(__name__)
+
+# How long a timed out run gets to exit after SIGTERM before its process group is sent SIGKILL
+KillGrace = 30
+# gzip holds output back until it has a full block, so the log is flushed this often to be readable mid-run
+FlushInterval = 5
+
+class RunResult:
+    """What came out of one run of a shell script"""
+    def __init__(self, returncode, timedout, elapsed, tail, usage=None):
+        self.returncode = returncode
+        self.timedout = timedout
+        self.elapsed = elapsed
+        self.tail = tail
+        self.usage = usage # resource.struct_rusage of the run and everything it waited for
+
+    def Tail(self, lines=20):
+        return "\n".join(list(self.tail)[-lines:])
+
+def KillGroup(process, sig):
+    """Signals every process in the run's process group, so star and Stella die along with their shell"""
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+def Run(command, cwd, env, logpath, parser=None, timeout=None, tailsize=200, cpus=None):
+    """Runs a shell command, draining stdout and stderr together into a gzipped log
+
+    Both pipes are read as data arrives, so neither can fill up and stall the run.  Each line is handed
+    to parser.Feed() and the last tailsize lines are kept for error reports.  The command runs in a
+    process group of its own, which is sent SIGTERM once the run has taken longer than timeout seconds
+    and SIGKILL if it's still around KillGrace seconds later.  With cpus, the shell and everything it
+    starts only run on those CPUs.
+    """
+    os.makedirs(os.path.dirname(logpath), exist_ok=True)
+    tail = deque(maxlen=tailsize)
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    timedout = False
+    killed = False
+
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                               start_new_session=True)
+    if cpus:
+        # Before the shell gets round to starting anything, which inherits it
+        try:
+            os.sched_setaffinity(process.pid, cpus)
+        except OSError as err:
+            logger.warning(f"Couldn't pin '{command}' to CPUs {cpus}: {err}")
+    selector = selectors.DefaultSelector()
+    pending = {}
+    for stream, prefix in ((process.stdout, b""), (process.stderr, b"[stderr] ")):
+        os.set_blocking(stream.fileno(), False)
+        selector.register(stream, selectors.EVENT_READ, prefix)
+        pending[stream] = b""
+
+    try:
+        # Appending makes a multi-member gzip file, which reads back as one stream, so reruns keep the earlier output
+        with gzip.open(logpath, "ab") as log:
+            def Emit(prefix, raw):
+                log.write(prefix + raw + b"\n")
+                line = raw.decode("utf-8", errors="replace").rstrip("\r")
+                tail.append(prefix.decode() + line)
+                if parser is not None:
+                    try:
+                        parser.Feed(line)
+                    except Exception as err:
+                        # A confused parser shouldn't take the run down with it
+                        logger.debug(f"Progress parser failed on '{line}': {err}")
+
+            lastflush = start
+            while selector.get_map():
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    if not timedout:
+                        timedout = True
+                        KillGroup(process, signal.SIGTERM)
+                        deadline = now + KillGrace
+                    elif not killed:
+                        killed = True
+                        KillGroup(process, signal.SIGKILL)
+                        deadline = now + KillGrace
+                    else:
+                        # Something that left the process group is still holding the pipes open
+                        break
+                wait = FlushInterval if deadline is None else min(FlushInterval, deadline - now)
+
+                for key, _ in selector.select(max(wait, 0)):
+                    stream = key.fileobj
+                    data = os.read(stream.fileno(), 1 << 16)
+                    if not data:
+                        if pending[stream]:
+                            Emit(key.data, pending[stream])
+                        selector.unregister(stream)
+                        continue
+                    lines = (pending[stream] + data).split(b"\n")
+                    pending[stream] = lines.pop()
+                    for raw in lines:
+                        Emit(key.data, raw)
+
+                if time.monotonic() - lastflush >= FlushInterval:
+                    log.flush()
+                    lastflush = time.monotonic()
+    finally:
+        # Whatever happened, nothing from this run may keep running (and holding its cores) once we return
+        KillGroup(process, signal.SIGKILL)
+        selector.close()
+        process.stdout.close()
+        process.stderr.close()
+        # Also counts the run towards the stage it's part of
+        usage = Telemetry.Reap(process)
+
+    return RunResult(process.returncode, timedout, time.monotonic() - start, tail, usage)
+
+class TimeoutLog:
+    """Appends a JSON line for every stage that ran out of time, for tuning the stage budgets later"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def Record(self, sim, stage, budget, elapsed, **extra):
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "sim": sim, "stage": stage,
+                  "budget": budget, "elapsed": round(elapsed, 1), **extra}
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(record) + "\n")
+
+def ToFloat(token):
+    # Fortran writes doubles as 1.0D+00 now and then
+    return float(token.replace("D", "E").replace("d", "e"))
+
+class MesaProgress:
+    """Follows MESA's terminal output, recording the model number, timestep and age of each step
+
+    MESA prints every step as three rows: model number and the first column block, then log dt,
+    then age in years.  rn's do_one announces each part with 'run <inlist>'.
+    """
+
+    def __init__(self, update):
+        self.update = update
+        self.state = 0
+        self.step = {}
+
+    def Feed(self, line):
+        tokens = line.split()
+        if not tokens:
+            self.state = 0
+            return
+
+        if tokens[0] == "run" and len(tokens) == 2 and tokens[1].startswith("inlist"):
+            self.update(part=tokens[1], model=None, log_dt=None, age_yr=None, log_age=None)
+            return
+        if tokens[0] == "finished" and len(tokens) == 2 and tokens[1].startswith("inlist"):
+            self.update(finished=tokens[1])
+            return
+        if line.strip().startswith("termination code:"):
+            self.update(termination=line.split(":", 1)[1].strip())
+            return
+
+        try:
+            if self.state == 0:
+                if len(tokens) >= 10 and tokens[0].isdigit():
+                    [ToFloat(token) for token in tokens[1:6]]
+                    self.step = {"model": int(tokens[0])}
+                    self.state = 1
+            elif self.state == 1:
+                self.step["log_dt"] = ToFloat(tokens[0])
+                self.state = 2
+            elif self.state == 2:
+                age = ToFloat(tokens[0])
+                self.step["age_yr"] = age
+                self.step["log_age"] = math.log10(age) if age > 0 else None
+                self.update(**self.step)
+                self.state = 0
+        except ValueError:
+            self.state = 0
+
+class StellaProgress:
+    """Follows the phases of Stella's rn and the model time reported by strad"""
+
+    Phases = {
+        "construct opacity tables": "opacity",
+        "run stella": "strad",
+        "stella extras": "extras",
+    }
+    Time = re.compile(r"\bt\s*=\s*([-+]?\d+\.?\d*(?:[EeDd][-+]?\d+)?)")
+
+    def __init__(self, update):
+        self.update = update
+        self.phase = "setup"
+
+    def Feed(self, line):
+        lowered = line.strip().lower()
+        for marker, phase in self.Phases.items():
+            if lowered.startswith(marker):
+                self.phase = phase
+                self.update(phase=phase)
+                return
+        if self.phase == "strad":
+            match = self.Time.search(line)
+            if match:
+                self.update(time=ToFloat(match.group(1)))
+
+class ProgressRegistry:
+    """Latest progress of every running stage, queryable in-process and mirrored to a JSON file"""
+
+    def __init__(self, path=None, interval=10):
+        self.path = path
+        self.interval = interval
+        self.records = {}
+        self.lock = threading.Lock()
+        self.lastdump = 0
+
+    def Update(self, sim, stage, **fields):
+        with self.lock:
+            record = self.records.setdefault(sim, {}).setdefault(stage, {})
+            record.update(fields)
+            record["updated"] = time.time()
+            due = self.path is not None and time.time() - self.lastdump >= self.interval
+        if due:
+            self.Dump()
+
+    def Updater(self, sim, stage):
+        """Returns an update function bound to one stage of one sim, for the parsers"""
+        def Update(**fields):
+            self.Update(sim, stage, **fields)
+        return Update
+
+    def Get(self, sim=None, stage=None):
+        """Returns a copy of the records of everything, one sim, or one stage of one sim"""
+        with self.lock:
+            if sim is None:
+                return copy.deepcopy(self.records)
+            if stage is None:
+                return copy.deepcopy(self.records.get(sim, {}))
+            return dict(self.records.get(sim, {}).get(stage, {}))
+
+    def Dump(self):
+        """Writes the current records to the JSON file through a rename, so readers never see half of it"""
+        if self.path is None:
+            return
+        with self.lock:
+            snapshot = json.dumps(self.records, indent=1)
+            self.lastdump = time.time()
+        tmp = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as file:
+            file.write(snapshot)
+        os.replace(tmp, self.path)
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Higher priority stages get first pick of free cores so that a chain is pushed through to the end
+# (Stella, export) before new MESA chains are started.  Compiles gate everything else, so they go first.
+StagePriority = {
+    "CreateSim": 0,
+    "PreCC": 1,
+    "PostCC": 2,
+    "Stella": 3,
+    "ExportData": 4,
+    "Build": 5,
+}
+
+class Job:
+    """A single stage of a simulation chain"""
+    def __init__(self, name, func, cores, deps, priority, seq, gate=None, shape=None):
+        self.name = name
+        self.func = func
+        self.cores = cores
+        self.deps = list(deps)
+        self.priority = priority
+        self.seq = seq
+        self.gate = gate # Asked just before the job starts, so it can be held back e.g. until there's room for it
+        self.shape = shape # Sizes the job to the cores free when it starts, if it can run on any number of them
+
+        self.state = "waiting" # waiting, running, done, failed or skipped
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.last = None # Once it's finished, the dependency that finished last, which is all it keeps of them
+
+    def __repr__(self):
+        return f"Job({self.name!r}, state={self.state!r})"
+
+class StageScheduler:
+    """Runs jobs as soon as their dependencies finish, without exceeding a global core budget"""
+
+    # How often jobs held back by their gate are asked again, besides whenever Wake() is called
+    GatePoll = 5
+
+    def __init__(self, budget):
+        self.budget = max(1, int(budget))
+        self.free = self.budget
+        self.seq = 0
+        self.waiting = []
+        self.running = 0
+        self.counts = {} # state -> jobs that ended in it; finished jobs themselves aren't kept
+        self.latest = None # The job that finished last
+        self.held = False
+        self.cond = threading.Condition()
+
+    def Submit(self, name, func, cores=1, deps=(), priority=0, gate=None, shape=None):
+        """Adds a job; deps are Job objects that must finish successfully first
+
+        gate is a function that returns whether the job may start now.  A job whose gate says no stays
+        ready and is asked again later, and its cores go to the jobs after it.  shape(free, ready) decides
+        how many cores the job gets when it's about to start, from the free cores and the number of ready
+        jobs with a shape, itself included; None holds it back.
+        """
+        # A job asking for more than the whole budget would never start, so it gets the whole machine instead
+        cores = min(max(1, int(cores)), self.budget)
+        with self.cond:
+            job = Job(name, func, cores, [dep for dep in deps if dep is not None], priority, self.seq, gate, shape)
+            self.seq += 1
+            self.waiting.append(job)
+            self.cond.notify_all()
+        return job
+
+    def Graph(self):
+        """{name: names of the jobs it waits for} of the jobs still waiting, and of the chain that finished last
+
+        A finished job only remembers whichever of its dependencies finished last, so the graph of what's
+        done is just the chain behind the job that finished last, which is what the run's critical path needs.
+        """
+        with self.cond:
+            graph = {job.name: [dep.name for dep in job.deps] for job in self.waiting}
+            job = self.latest
+            while job is not None:
+                graph[job.name] = [] if job.last is None else [job.last.name]
+                job = job.last
+            return graph
+
+    def Wake(self):
+        """Has held back jobs asked again straight away, e.g. once whatever their gate waits for is there"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def _Execute(self, job):
+        try:
+            job.func()
+        except Exception as err:
+            job.error = err
+            logger.error(f"Job '{job.name}' failed: {err}")
+        finally:
+            # Neither what the job was bound to nor most of its dependencies are needed any more, so once
+            # nothing waits on them any longer finished jobs can go, bar the chain that finished last
+            job.func = job.gate = job.shape = None
+            with self.cond:
+                job.finished = time.time()
+                job.state = "failed" if job.error is not None else "done"
+                job.last = max(job.deps, key=lambda dep: dep.finished, default=None)
+                job.deps = []
+                self.latest = job
+                self.counts[job.state] = self.counts.get(job.state, 0) + 1
+                self.free += job.cores
+                self.running -= 1
+                self.cond.notify_all()
+
+    def _Dispatch(self):
+        """Starts every ready job that fits in the free cores.  Must be called with the lock held."""
+        ready = []
+        for job in list(self.waiting):
+            if any(dep.state in ("failed", "skipped") for dep in job.deps):
+                job.state = "skipped"
+                job.finished = time.time()
+                job.deps = []
+                self.counts["skipped"] = self.counts.get("skipped", 0) + 1
+                self.waiting.remove(job)
+                logger.warning(f"Skipping job '{job.name}' since one of its dependencies did not finish")
+                continue
+            if all(dep.state == "done" for dep in job.deps):
+                ready.append(job)
+
+        # Smaller jobs are allowed to backfill around a big MESA job that doesn't fit yet
+        ready.sort(key=lambda job: (-job.priority, job.seq))
+        self.held = False
+        elastic = sum(1 for job in ready if job.shape is not None)
+        for job in ready:
+            if job.shape is not None:
+                cores = job.shape(self.free, elastic)
+                elastic -= 1
+                if cores is None:
+                    # Like a gate, a shape may only be waiting for cores to free up, so it's looked at again
+                    self.held = True
+                    continue
+                job.cores = min(max(1, int(cores)), self.budget)
+            if job.cores > self.free:
+                continue
+            if job.gate is not None and not job.gate():
+                self.held = True
+                continue
+            self.free -= job.cores
+            self.running += 1
+            self.waiting.remove(job)
+            job.state = "running"
+            job.started = time.time()
+            logger.info(f"Starting job '{job.name}' on {job.cores} core(s); {self.free}/{self.budget} cores free")
+            threading.Thread(target=self._Execute, args=(job,), name=job.name, daemon=True).start()
+
+        return len(ready) > 0 or self.running > 0
+
+    def Run(self, feed=None, ahead=1000):
+        """Blocks until every submitted job has finished, failed or been skipped
+
+        feed, if given, is called for more jobs whenever fewer than ahead are waiting or running, and returns
+        False once it has no more, so a huge grid is planned as it goes rather than all up front.
+        """
+        more = feed is not None
+        starved = False
+        while True:
+            # More jobs are planned while few are left, or straight away if none of those left can start
+            while more:
+                with self.cond:
+                    if len(self.waiting) + self.running >= ahead and not starved:
+                        break
+                starved = False
+                # Called without the lock, so finishing jobs aren't held up while it plans
+                more = feed()
+            with self.cond:
+                progress = self._Dispatch()
+                if not self.waiting and not self.running or not progress:
+                    if more:
+                        starved = True
+                        continue
+                    # Nothing is running and nothing can start, so the remaining jobs can never run
+                    for job in self.waiting:
+                        job.state = "skipped"
+                        self.counts["skipped"] = self.counts.get("skipped", 0) + 1
+                        logger.error(f"Job '{job.name}' has unsatisfiable dependencies")
+                    self.waiting.clear()
+                    break
+                self.cond.wait(self.GatePoll if self.held else None)
+
+        with self.cond:
+            counts = dict(self.counts)
+        logger.info(f"Scheduler finished: {counts}")
+        return counts
@@ -0,0 +1,203 @@
+import glob
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from MesaStella.ProgCache import AtomicCopy
+
+logger = logging.getLogger(__name__)
+
+def DirSize(path):
+    """Bytes a directory takes up on disk, counting hard-linked files once and symlinks not at all"""
+    total = 0
+    seen = set()
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_blocks * 512
+    return total
+
+def Alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class ScratchSpace:
+    """Sim working directories on fast local storage, whose results are copied back to durable storage in the background
+
+    Each process gets a directory of its own under root.  Sims left there by a process on this host that has
+    since died are taken over, so a rerun can resume them.  Space is budgeted per sim: a working directory
+    counts for the larger of its size when it was last measured and the biggest sim seen so far (simbytes
+    to start with).  Admit() only lets a new sim in while that total stays under maxbytes, evicting idle
+    directories whose results are all copied back if need be.  Sims already running always carry on, so
+    the cap is soft rather than a way to deadlock.
+    """
+
+    def __init__(self, root, name, maxbytes, simbytes, threads=4, synchronous=False, onfree=None):
+        self.root = os.path.join(root, name)
+        self.maxbytes = maxbytes
+        self.largest = simbytes
+        # Whether WriteBack waits for its copies, for when the next stage may run on another machine
+        self.synchronous = synchronous
+        self.onfree = onfree
+        self.pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="WriteBack")
+        self.lock = threading.Lock()
+        self.dirs = {} # name -> {"size", "users", "pending", "done", "used"}
+        self.admitted = 0 # Sims let in that haven't entered yet
+        os.makedirs(self.root, exist_ok=True)
+        self.Adopt(root)
+
+    def Adopt(self, root):
+        """Takes over the sims of dead processes on this host, and any left in our own directory"""
+        host = socket.gethostname()
+        for entry in os.listdir(root):
+            path = os.path.join(root, entry)
+            owner, _, pid = entry.rpartition("-")
+            if path == self.root or owner != host or not pid.isdigit() or Alive(int(pid)):
+                continue
+            for sim in os.listdir(path):
+                if not os.path.exists(os.path.join(self.root, sim)):
+                    os.replace(os.path.join(path, sim), os.path.join(self.root, sim))
+            shutil.rmtree(path, ignore_errors=True)
+        for sim in os.listdir(self.root):
+            if sim.startswith(".trash-"):
+                shutil.rmtree(os.path.join(self.root, sim), ignore_errors=True)
+            else:
+                self.dirs[sim] = {"size": DirSize(os.path.join(self.root, sim)), "users": 0, "pending": 0, "done": False, "used": 0}
+        if self.dirs:
+            logger.info(f"Took over {len(self.dirs)} sim(s) left in scratch by an earlier run")
+
+    def Path(self, name):
+        return os.path.join(self.root, name)
+
+    def Reserved(self):
+        """Bytes budgeted for every directory, and for sims let in but not there yet.  Must be called with the lock held."""
+        return sum(max(entry["size"], self.largest) for entry in self.dirs.values()) + self.admitted * self.largest
+
+    def Fits(self):
+        """Whether a new sim fits; the first always does, so a sim bigger than the cap still runs.  Must be called with the lock held."""
+        return (not self.dirs and not self.admitted) or self.Reserved() + self.largest <= self.maxbytes
+
+    def Admit(self):
+        """Whether a new sim fits, reserving its space if so; makes room by evicting idle directories first"""
+        with self.lock:
+            while not self.Fits():
+                idle = [(entry["done"], entry["used"], name) for name, entry in self.dirs.items() if entry["users"] == 0 and entry["pending"] == 0]
+                if not idle:
+                    break
+                # Finished sims first, then the ones left alone the longest
+                _, _, name = min(idle, key=lambda item: (not item[0], item[1]))
+                logger.info(f"Evicting {name} from scratch to make room; everything it needs is in the grid")
+                trash = self._Discard(name)
+                if trash is not None:
+                    # Deleted in the background, since this may be holding up a scheduler
+                    self.pool.submit(shutil.rmtree, trash, True)
+            fits = self.Fits()
+            if fits:
+                self.admitted += 1
+        return fits
+
+    def Enter(self, name, new=False):
+        """Marks a stage of the sim as running in scratch; returns whether its directory is already there"""
+        with self.lock:
+            if new and self.admitted > 0:
+                self.admitted -= 1
+            entry = self.dirs.setdefault(name, {"size": 0, "users": 0, "pending": 0, "done": False, "used": 0})
+            entry["users"] += 1
+            entry["used"] = time.time()
+        return os.path.isdir(self.Path(name))
+
+    def Leave(self, name, done=False):
+        """Marks a stage of the sim as over; a done sim's directory goes as soon as its results are copied back"""
+        with self.lock:
+            entry = self.dirs[name]
+            entry["users"] -= 1
+            entry["done"] |= done
+        self._Settle(name)
+
+    def WriteBack(self, name, files, then=None):
+        """Copies (scratch path, durable path) pairs in the background and calls then() once they're all there
+
+        Returns the future of the copy, which raises whatever went wrong.
+        """
+        with self.lock:
+            self.dirs[name]["pending"] += 1
+
+        def Copy():
+            try:
+                for src, dst in files:
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    AtomicCopy(src, dst)
+                    shutil.copymode(src, dst)
+                if then is not None:
+                    then()
+            except Exception as err:
+                logger.error(f"Couldn't copy the results of {name} back from scratch: {err}")
+                raise
+            finally:
+                size = DirSize(self.Path(name))
+                with self.lock:
+                    self.dirs[name]["pending"] -= 1
+                    self.dirs[name]["size"] = size
+                    self.largest = max(self.largest, size)
+                self._Settle(name)
+
+        future = self.pool.submit(Copy)
+        if self.synchronous:
+            future.result()
+        return future
+
+    def _Settle(self, name):
+        with self.lock:
+            entry = self.dirs.get(name)
+            if entry is None or not entry["done"] or entry["users"] or entry["pending"]:
+                return
+            trash = self._Discard(name)
+        if trash is not None:
+            shutil.rmtree(trash, ignore_errors=True)
+        if self.onfree is not None:
+            self.onfree()
+
+    def _Discard(self, name):
+        """Forgets a sim and moves its directory out of the way for deleting; returns where to.  Must be called with the lock held."""
+        del self.dirs[name]
+        # Renamed in one step, so a stage of the sim starting now finds no directory rather than half of one
+        trash = os.path.join(self.root, f".trash-{uuid.uuid4().hex}")
+        try:
+            os.replace(self.Path(name), trash)
+        except FileNotFoundError:
+            return None
+        return trash
+
+    def Matching(self, name, patterns):
+        """Paths relative to the sim's directory of its files that match any of the glob patterns"""
+        found = set()
+        for pattern in patterns:
+            found.update(path for path in glob.glob(pattern, root_dir=self.Path(name), recursive=True)
+                         if os.path.isfile(os.path.join(self.Path(name), path)))
+        return sorted(found)
+
+    def Close(self):
+        """Waits for every copy and clears out the directories of sims nothing is running in"""
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            trashes = [self._Discard(name) for name, entry in list(self.dirs.items()) if entry["users"] == 0]
+        for trash in trashes:
+            if trash is not None:
+                shutil.rmtree(trash, ignore_errors=True)
+        if not os.listdir(self.root):
+            os.rmdir(self.root)
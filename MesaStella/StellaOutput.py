@@ -0,0 +1,103 @@
+import logging
+
+import numpy as np
+
+from MesaStella import Retention
+
+logger = logging.getLogger(__name__)
+
+# Columns ExportData relies on; the rest of the header is read as it comes
+RequiredColumns = ["time", "Mbol", "MU", "MB", "MV", "MI", "MR"]
+
+class StellaOutputError(Exception):
+    pass
+
+def IsNumber(token):
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+def FindHeader(raw):
+    """Byte offsets of the light curve table's header line, found by its tokens rather than its spacing
+
+    The header is the last all-text line starting with 'time' that has every required column, so the
+    column alignment Stella happens to use doesn't matter.
+    """
+    pos = len(raw)
+    while True:
+        pos = raw.rfind(b"time", 0, pos)
+        if pos < 0:
+            return None
+        start = raw.rfind(b"\n", 0, pos) + 1
+        end = raw.find(b"\n", pos)
+        end = len(raw) if end < 0 else end
+        tokens = raw[start:end].decode(errors="replace").split()
+        if tokens and tokens[0] == "time" and all(column in tokens for column in RequiredColumns):
+            if not any(IsNumber(token) for token in tokens):
+                return start, end
+
+def ColumnEnds(header, sample):
+    """Right edges of the columns in a well-formed data row, for rows whose numbers run into each other"""
+    ends = []
+    inside = False
+    for position, char in enumerate(sample):
+        if char != " " and not inside:
+            inside = True
+        elif char == " " and inside:
+            inside = False
+            ends.append(position)
+    if inside:
+        ends.append(len(sample))
+    return ends if len(ends) == len(header) else None
+
+def ParseFixedWidth(rows, ncols, ends):
+    """Slow path for blocks where whitespace splitting doesn't give ncols fields on every row"""
+    out = np.full((len(rows), ncols), np.nan)
+    starts = [0] + ends[:-1]
+    for i, row in enumerate(rows):
+        tokens = row.split()
+        if len(tokens) != ncols:
+            tokens = [row[start:end] for start, end in zip(starts, ends)]
+        for j, token in enumerate(tokens):
+            try:
+                out[i, j] = float(token.replace("D", "E"))
+            except ValueError:
+                pass # Overflowed Fortran fields ('******') and the like are left as NaN
+    return out
+
+def ReadLightCurve(path):
+    """Reads the light curve table of a Stella mesa.tt into {column: float64 array}"""
+    # Through Retention, so a light curve compressed since the sim finished reads the same
+    with Retention.Open(path) as file:
+        raw = file.read()
+
+    found = FindHeader(raw)
+    if found is None:
+        raise StellaOutputError(f"No light curve header with columns {RequiredColumns} in '{path}'")
+    header = raw[found[0]:found[1]].decode().split()
+    ncols = len(header)
+    body = raw[found[1] + 1:]
+
+    # Fast path: one split and one conversion for the whole block, as long as every row has every field
+    tokens = body.split()
+    nrows = sum(1 for line in body.splitlines() if line.strip())
+    if nrows == 0:
+        raise StellaOutputError(f"Light curve table in '{path}' has no rows")
+    table = None
+    if len(tokens) == nrows * ncols:
+        try:
+            table = np.array(tokens, dtype=np.float64).reshape(nrows, ncols)
+        except ValueError:
+            table = None
+    if table is None:
+        rows = [line for line in body.decode(errors="replace").splitlines() if line.strip()]
+        sample = next((row for row in rows if len(row.split()) == ncols), None)
+        ends = ColumnEnds(header, sample) if sample is not None else None
+        if ends is None:
+            raise StellaOutputError(f"Couldn't work out the column layout of '{path}'")
+        logger.warning(f"'{path}' has malformed rows; falling back to fixed-width parsing")
+        table = ParseFixedWidth(rows, ncols, ends)
+
+    return {name: np.ascontiguousarray(table[:, j]) for j, name in enumerate(header)}
@@ -0,0 +1,205 @@
+import ast
+import itertools
+import json
+import logging
+import math
+import operator
+
+logger = logging.getLogger(__name__)
+
+# The simlist's columns (see the README); gridtag names the block rather than being swept
+Columns = ["mass", "energy", "windscalar", "metallicity", "hefrac", "ni56", "csmvelo", "csmrate", "csmtime"]
+# Columns older simlists have that are read but no longer used
+Ignored = ["csmoptimize", "progoptimize"]
+
+class SweepError(Exception):
+    pass
+
+# What a constraint may use besides the columns
+Functions = {"abs": abs, "min": min, "max": max, "sqrt": math.sqrt, "log10": math.log10, "exp": math.exp}
+Operators = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv, ast.Pow: operator.pow,
+    ast.Mod: operator.mod, ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Not: operator.not_,
+    ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Eq: operator.eq, ast.NotEq: operator.ne,
+}
+
+def CheckExpression(node, where):
+    """Raises SweepError unless the expression only does arithmetic and comparisons on columns, numbers and Functions"""
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name):
+            if child.id not in Columns and child.id not in Functions:
+                raise SweepError(f"Constraint '{where}' uses '{child.id}', which isn't a column ({', '.join(Columns)})")
+        elif isinstance(child, ast.Call):
+            if not isinstance(child.func, ast.Name) or child.func.id not in Functions or child.keywords:
+                raise SweepError(f"Constraint '{where}' calls something other than {', '.join(Functions)}")
+        elif isinstance(child, ast.Constant):
+            if not isinstance(child.value, (int, float)) or isinstance(child.value, bool):
+                raise SweepError(f"Constraint '{where}' has a constant that isn't a number")
+        elif not isinstance(child, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.Load, ast.And, ast.Or,
+                                    *Operators)):
+            raise SweepError(f"Constraint '{where}' has '{type(child).__name__}', which constraints can't use")
+
+def Evaluate(node, row):
+    if isinstance(node, ast.Expression):
+        return Evaluate(node.body, row)
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        return row[node.id]
+    if isinstance(node, ast.BinOp):
+        return Operators[type(node.op)](Evaluate(node.left, row), Evaluate(node.right, row))
+    if isinstance(node, ast.UnaryOp):
+        return Operators[type(node.op)](Evaluate(node.operand, row))
+    if isinstance(node, ast.BoolOp):
+        values = (Evaluate(value, row) for value in node.values)
+        return all(values) if isinstance(node.op, ast.And) else any(values)
+    if isinstance(node, ast.Compare):
+        left = Evaluate(node.left, row)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = Evaluate(comparator, row)
+            if not Operators[type(op)](left, right):
+                return False
+            left = right
+        return True
+    if isinstance(node, ast.Call):
+        return Functions[node.func.id](*(Evaluate(arg, row) for arg in node.args))
+    raise SweepError(f"Can't evaluate '{type(node).__name__}'")
+
+def Number(value, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise SweepError(f"{where} has to be a number, not {value!r}")
+    return value
+
+def Tidy(value):
+    """Drops the float noise of stepping through a range, since the values end up in directory names"""
+    return float(f"{value:.12g}")
+
+def Values(value, where):
+    """The values one column takes: a number, a list of them, or a range {start, stop, step} or {start, stop, num[, log]}"""
+    if isinstance(value, list):
+        if not value:
+            raise SweepError(f"{where} is an empty list")
+        return [Number(item, where) for item in value]
+    if not isinstance(value, dict):
+        return [Number(value, where)]
+
+    unknown = set(value) - {"start", "stop", "step", "num", "log"}
+    if unknown:
+        raise SweepError(f"{where} has {', '.join(sorted(unknown))}; a range has start, stop and either step or num (and log)")
+    if "start" not in value or "stop" not in value or ("step" in value) == ("num" in value):
+        raise SweepError(f"{where} needs start, stop and either step or num")
+    start, stop = Number(value["start"], f"{where} start"), Number(value["stop"], f"{where} stop")
+    if stop < start:
+        raise SweepError(f"{where} stops before it starts")
+    if "step" in value:
+        step = Number(value["step"], f"{where} step")
+        if step <= 0 or value.get("log"):
+            raise SweepError(f"{where} needs a positive step, and can't be logarithmic (use num)")
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        if all(isinstance(item, int) for item in (start, stop, step)):
+            return [start + i * step for i in range(count)]
+        return [Tidy(start + i * step) for i in range(count)]
+    num = value["num"]
+    if isinstance(num, bool) or not isinstance(num, int) or num < 1:
+        raise SweepError(f"{where} needs a whole, positive num")
+    if value.get("log"):
+        if start <= 0:
+            raise SweepError(f"{where} is logarithmic, so it has to start above zero")
+        start, stop = math.log10(start), math.log10(stop)
+        return [Tidy(10**(start + (stop - start) * i / max(1, num - 1))) for i in range(num)]
+    return [Tidy(start + (stop - start) * i / max(1, num - 1)) for i in range(num)]
+
+def Validate(spec):
+    """Checks a sweep spec and works out each block's axes; returns [(gridtag, [(columns, [value tuples])], constraints)]
+
+    Every mistake is reported before anything runs, with the block and column it's in.
+    """
+    if not isinstance(spec, dict) or set(spec) - {"defaults", "grid"} or not isinstance(spec.get("grid"), list) or not spec["grid"]:
+        raise SweepError("A sweep spec has a [defaults] table and one or more [[grid]] blocks, and nothing else")
+    defaults = spec.get("defaults", {})
+    unknown = set(defaults) - set(Columns) - set(Ignored)
+    if unknown:
+        raise SweepError(f"[defaults] has {', '.join(sorted(unknown))}, which aren't simlist columns ({', '.join(Columns)})")
+
+    blocks = []
+    for number, block in enumerate(spec["grid"], 1):
+        gridtag = block.get("gridtag")
+        if not isinstance(gridtag, str) or not gridtag:
+            raise SweepError(f"Grid block {number} needs a gridtag, as a string")
+        name = f"grid '{gridtag}'"
+        unknown = set(block) - set(Columns) - set(Ignored) - {"gridtag", "linked", "where"}
+        if unknown:
+            raise SweepError(f"{name} has {', '.join(sorted(unknown))}, which aren't simlist columns ({', '.join(Columns)})")
+
+        axes = []
+        given = set()
+        for group in block.get("linked", []):
+            if not isinstance(group, dict) or not group:
+                raise SweepError(f"{name} has a linked group that isn't a table of columns")
+            columns = list(group)
+            for column in columns:
+                if column not in Columns:
+                    raise SweepError(f"{name} links '{column}', which isn't a simlist column")
+                if column in given:
+                    raise SweepError(f"{name} gives '{column}' more than once")
+                given.add(column)
+            lists = [Values(group[column], f"{name} linked {column}") for column in columns]
+            if len({len(values) for values in lists}) != 1:
+                raise SweepError(f"{name} links {', '.join(columns)}, which have to have as many values each")
+            axes.append((columns, list(zip(*lists))))
+        for column, value in block.items():
+            if column in Columns:
+                if column in given:
+                    raise SweepError(f"{name} gives '{column}' more than once")
+                given.add(column)
+                axes.append(([column], [(item,) for item in Values(value, f"{name} {column}")]))
+        for column in Columns:
+            if column not in given:
+                if column not in defaults:
+                    raise SweepError(f"{name} doesn't give '{column}', and neither does [defaults]")
+                axes.append(([column], [(item,) for item in Values(defaults[column], f"[defaults] {column}")]))
+
+        constraints = []
+        where = block.get("where", [])
+        for text in [where] if isinstance(where, str) else where:
+            try:
+                tree = ast.parse(text, mode="eval")
+            except SyntaxError as err:
+                raise SweepError(f"{name} has a constraint that doesn't parse, '{text}': {err.msg}")
+            CheckExpression(tree, text)
+            constraints.append((text, tree))
+        blocks.append((gridtag, axes, constraints))
+    return blocks
+
+def Load(path):
+    """Reads and validates a sweep spec from a TOML or JSON file"""
+    if path.endswith(".json"):
+        with open(path, "r") as file:
+            spec = json.load(file)
+    else:
+        import tomllib
+        with open(path, "rb") as file:
+            spec = tomllib.load(file)
+    blocks = Validate(spec)
+    for gridtag, axes, constraints in blocks:
+        logger.info(f"Sweep grid '{gridtag}': {math.prod(len(values) for _, values in axes)} rows before "
+                    f"{len(constraints)} constraint(s), over {', '.join('+'.join(columns) for columns, values in axes if len(values) > 1) or 'nothing'}")
+    return blocks
+
+def Expand(blocks):
+    """Simlist-style rows of every block, one at a time
+
+    Linked groups vary slowest, then the block's own columns in the order it gives them, with the last varying fastest.
+    """
+    for gridtag, axes, constraints in blocks:
+        for combination in itertools.product(*(values for _, values in axes)):
+            row = {column: value for (columns, _), values in zip(axes, combination) for column, value in zip(columns, values)}
+            try:
+                if not all(Evaluate(tree, row) for _, tree in constraints):
+                    continue
+            except (ArithmeticError, ValueError) as err:
+                # e.g. log10 of zero; a row its constraints can't be worked out for isn't run
+                logger.warning(f"Leaving out a row of '{gridtag}' whose constraints can't be evaluated ({err}): {row}")
+                continue
+            row["gridtag"] = gridtag
+            yield row
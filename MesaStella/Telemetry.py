@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The stage being measured on each thread, which the runs it starts add their resource usage to
+Current = threading.local()
+
+# What the Prometheus textfile has for each stage: (metric, type, help, field of the stage's totals)
+Metrics = [
+    ("mesastella_stage_runs_total", "counter", "Stages that finished, by outcome", None),
+    ("mesastella_stage_wall_seconds_total", "counter", "Wall time spent in stages", "wall_s"),
+    ("mesastella_stage_cpu_seconds_total", "counter", "CPU time of stages and everything they ran", "cpu_s"),
+    ("mesastella_stage_read_bytes_total", "counter", "Bytes read by stages", "read_bytes"),
+    ("mesastella_stage_written_bytes_total", "counter", "Bytes written by stages", "written_bytes"),
+    ("mesastella_stage_max_rss_bytes", "gauge", "Largest peak resident set size of a stage", "max_rss_bytes"),
+]
+
+def ThreadIO():
+    """Bytes the calling thread has read and written through files and pipes, cached or not; zeros where /proc doesn't say"""
+    try:
+        with open("/proc/thread-self/io") as file:
+            fields = dict(line.split(":", 1) for line in file)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def ThreadCPU():
+    """User plus system CPU seconds of the calling thread"""
+    if hasattr(resource, "RUSAGE_THREAD"):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return time.thread_time()
+
+def Reap(process):
+    """Waits for a Popen like its wait(), adding what it and every child it waited for used to the stage running on this thread
+
+    Returns the run's resource.struct_rusage, or None if it had already been waited for.
+    """
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.wait()
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    record = getattr(Current, "record", None)
+    if record is not None:
+        record["runs"] += 1
+        record["exit_codes"].append(process.returncode)
+        record["child_cpu_s"] += usage.ru_utime + usage.ru_stime
+        # Linux gives the peak in kB, and counts I/O in 512-byte blocks that actually went to or from the disk
+        record["child_rss_bytes"] = max(record["child_rss_bytes"], usage.ru_maxrss * 1024)
+        record["child_read_bytes"] += usage.ru_inblock * 512
+        record["child_written_bytes"] += usage.ru_oublock * 512
+    return usage
+
+def Labels(labels):
+    def Escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{Escape(value)}"' for key, value in labels.items()) + "}"
+
+class Recorder:
+    """Measures every stage as it runs, appending one JSON line per stage and keeping a Prometheus textfile up to date
+
+    labels go on every metric, so the textfiles of several workers can be collected side by side.
+    """
+
+    def __init__(self, path, promfile=None, labels=None):
+        self.path = path
+        self.promfile = promfile
+        self.labels = dict(labels or {})
+        self.lock = threading.Lock()
+        self.totals = {} # stage -> {field: value}
+        self.running = {} # stage -> [stages, cores]
+
+    @contextmanager
+    def Stage(self, job, sim, stage, cores=1, threads=None):
+        """Measures the block as one run of a stage: wall and CPU time, peak memory, I/O and how it ended
+
+        threads is the OMP_NUM_THREADS its runs get, if any.  Runs started on this thread with Runner.Run
+        (or anything else that waits with Reap) count towards it.
+        """
+        record = {"runs": 0, "exit_codes": [], "child_cpu_s": 0.0, "child_rss_bytes": 0, "child_read_bytes": 0, "child_written_bytes": 0}
+        outer = getattr(Current, "record", None)
+        Current.record = record
+        self._Running(stage, cores, 1)
+
+        started = time.time()
+        clock = time.monotonic()
+        cpu = ThreadCPU()
+        read, written = ThreadIO()
+        error = None
+        try:
+            yield record
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            Current.record = outer
+            wall = time.monotonic() - clock
+            nowread, nowwritten = ThreadIO()
+            selfcpu = ThreadCPU() - cpu
+            # A stage run in this process can only be given this process's peak so far
+            rss = record["child_rss_bytes"] or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            event = {
+                **self.labels, "job": job, "sim": sim, "stage": stage,
+                "status": "done" if error is None else "failed",
+                "start": round(started, 3), "end": round(started + wall, 3), "wall_s": round(wall, 3),
+                "cpu_s": round(selfcpu + record["child_cpu_s"], 3), "child_cpu_s": round(record["child_cpu_s"], 3),
+                "parallelism": round((selfcpu + record["child_cpu_s"]) / wall, 2) if wall > 0 else None,
+                "cores": cores, "omp_threads": threads, "max_rss_bytes": rss,
+                "read_bytes": nowread - read + record["child_read_bytes"],
+                "written_bytes": nowwritten - written + record["child_written_bytes"],
+                "runs": record["runs"], "exit_codes": record["exit_codes"],
+            }
+            if error is not None:
+                event["error"] = f"{type(error).__name__}: {error}"
+            self._Running(stage, cores, -1)
+            self.Record(event)
+
+    def _Running(self, stage, cores, change):
+        with self.lock:
+            counts = self.running.setdefault(stage, [0, 0])
+            counts[0] += change
+            counts[1] += change * cores
+        self.Export()
+
+    def Record(self, event):
+        """Appends a finished stage to the event stream and the totals"""
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(event) + "\n")
+            totals = self.totals.setdefault(event["stage"], {"done": 0, "failed": 0, "wall_s": 0, "cpu_s": 0, "read_bytes": 0,
+                                                               "written_bytes": 0, "max_rss_bytes": 0})
+            totals[event["status"]] += 1
+            for field in ("wall_s", "cpu_s", "read_bytes", "written_bytes"):
+                totals[field] += event[field]
+            totals["max_rss_bytes"] = max(totals["max_rss_bytes"], event["max_rss_bytes"])
+        self.Export()
+        logger.info(f"{event['job']} {event['status']} after {event['wall_s']:.1f} s: {event['cpu_s']:.1f} CPU s, "
+                    f"peak {event['max_rss_bytes'] / 1024**2:.0f} MB, {event['read_bytes'] / 1024**2:.1f} MB read, "
+                    f"{event['written_bytes'] / 1024**2:.1f} MB written")
+
+    def Export(self):
+        """Rewrites the Prometheus textfile through a rename, so the collector never sees half of it"""
+        if self.promfile is None:
+            return
+        with self.lock:
+            lines = []
+            for metric, kind, description, field in Metrics:
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"]
+                for stage, totals in sorted(self.totals.items()):
+                    if field is None:
+                        lines += [f"{metric}{Labels({**self.labels, 'stage': stage, 'status': status})} {totals[status]}" for status in ("done", "failed")]
+                    else:
+                        lines.append(f"{metric}{Labels({**self.labels, 'stage': stage})} {round(totals[field], 3)}")
+            for metric, index, description in (("mesastella_stages_running", 0, "Stages running now"),
+                                               ("mesastella_cores_busy", 1, "Cores held by the stages running now")):
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+                lines += [f"{metric}{Labels({**self.labels, 'stage': stage})} {counts[index]}" for stage, counts in sorted(self.running.items())]
+            lines += ["# HELP mesastella_updated_timestamp_seconds When this file was written", "# TYPE mesastella_updated_timestamp_seconds gauge",
+                      f"mesastella_updated_timestamp_seconds{Labels(self.labels)} {time.time():.3f}"]
+        tmp = f"{self.promfile}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.promfile)
+
+def Load(paths, since=0):
+    """The events of several telemetry files that started at or after since, leaving out lines cut short"""
+    events = []
+    for path in paths:
+        try:
+            with open(path) as file:
+                for line in file:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if event["start"] >= since:
+                        events.append(event)
+        except FileNotFoundError:
+            continue
+    return events
+
+def CriticalPath(events, graph):
+    """The chain of stages that decided when the run finished
+
+    Starts from the stage that finished last and goes back through whichever of its dependencies finished
+    last.  graph is {job: [jobs it waited for]}, as the schedulers' Graph() gives it.
+    """
+    latest = {}
+    for event in events:
+        if event["job"] not in latest or event["end"] > latest[event["job"]]["end"]:
+            latest[event["job"]] = event
+    if not latest:
+        return []
+    path = [max(latest.values(), key=lambda event: event["end"])]
+    while True:
+        deps = [latest[dep] for dep in graph.get(path[-1]["job"], []) if dep in latest]
+        if not deps:
+            break
+        path.append(max(deps, key=lambda event: event["end"]))
+    return path[::-1]
+
+def Utilisation(events, budget, slices=20):
+    """(seconds since the start, fraction of the budget's cores busy) of equal slices of the run"""
+    start = min(event["start"] for event in events)
+    width = max(max(event["end"] for event in events) - start, 1e-9) / slices
+    busy = [0.0] * slices
+    for event in events:
+        first = int((event["start"] - start) / width)
+        for index in range(min(first, slices - 1), slices):
+            low = start + index * width
+            if low >= event["end"]:
+                break
+            overlap = min(event["end"], low + width) - max(event["start"], low)
+            busy[index] += max(overlap, 0) * min(event["cores"], budget)
+    return [(index * width, cores / (width * budget)) for index, cores in enumerate(busy)]
+
+def PeakCores(events):
+    """Most cores held by stages at once"""
+    changes = sorted([(event["start"], event["cores"]) for event in events] + [(event["end"], -event["cores"]) for event in events])
+    peak = held = 0
+    for _, change in changes:
+        held += change
+        peak = max(peak, held)
+    return peak
+
+def Report(events, graph, budget=None, slowest=10):
+    """A text summary of a run's stages: where the time went, the critical path, core use over time and the slowest sims
+
+    budget is the cores the run had, or None to take the most that were ever in use.
+    """
+    if not events:
+        return "No stages ran"
+    budget = budget or PeakCores(events) or 1
+    start = min(event["start"] for event in events)
+    span = max(event["end"] for event in events) - start
+    coretime = sum(event["wall_s"] * min(event["cores"], budget) for event in events)
+    failed = sum(event["status"] != "done" for event in events)
+    lines = [f"{len(events)} stages ({failed} failed) over {span:.1f} s on {budget} cores, which were busy "
+             f"{100 * coretime / max(span * budget, 1e-9):.0f}% of the time", ""]
+
+    # Which stages the core time went to says whether the grid is bound by setup, compiles, MESA, Stella or export
+    lines.append(f"{'Stage':<12}{'Runs':>6}{'Failed':>8}{'Wall s':>10}{'Mean s':>9}{'Max s':>9}{'CPU s':>10}{'CPU/wall':>10}"
+                 f"{'Peak MB':>9}{'Read MB':>10}{'Written MB':>12}{'Core time':>11}")
+    stages = {}
+    for event in events:
+        stages.setdefault(event["stage"], []).append(event)
+    for stage, group in sorted(stages.items(), key=lambda item: -sum(event["wall_s"] * event["cores"] for event in item[1])):
+        wall = sum(event["wall_s"] for event in group)
+        cpu = sum(event["cpu_s"] for event in group)
+        share = sum(event["wall_s"] * min(event["cores"], budget) for event in group) / max(coretime, 1e-9)
+        lines.append(f"{stage:<12}{len(group):>6}{sum(event['status'] != 'done' for event in group):>8}{wall:>10.1f}{wall / len(group):>9.1f}"
+                     f"{max(event['wall_s'] for event in group):>9.1f}{cpu:>10.1f}{cpu / max(wall, 1e-9):>10.2f}"
+                     f"{max(event['max_rss_bytes'] for event in group) / 1024**2:>9.0f}{sum(event['read_bytes'] for event in group) / 1024**2:>10.1f}"
+                     f"{sum(event['written_bytes'] for event in group) / 1024**2:>12.1f}{100 * share:>10.0f}%")
+
+    path = CriticalPath(events, graph)
+    ran = sum(event["wall_s"] for event in path)
+    lines += ["", f"Critical path: {len(path)} stages, {ran:.1f} s running and {path[-1]['end'] - path[0]['start'] - ran:.1f} s waiting "
+                  f"from +{path[0]['start'] - start:.1f} s"]
+    previous = None
+    for event in path:
+        waited = event["start"] - (previous["end"] if previous else event["start"])
+        lines.append(f"  +{event['start'] - start:>8.1f} s  {event['job']}: {event['wall_s']:.1f} s" + (f" after waiting {waited:.1f} s" if waited > 0.05 else ""))
+        previous = event
+
+    lines += ["", "Cores busy over time:"]
+    for offset, fraction in Utilisation(events, budget):
+        lines.append(f"  +{offset:>8.1f} s  {'#' * round(40 * min(fraction, 1)):<40} {100 * fraction:>4.0f}%")
+
+    sims = {}
+    for event in events:
+        if event["stage"] != "Build":
+            sims.setdefault(event["sim"], {}).setdefault(event["stage"], 0)
+            sims[event["sim"]][event["stage"]] += event["wall_s"]
+    lines += ["", f"Slowest sims (of {len(sims)}):"]
+    for sim, walls in sorted(sims.items(), key=lambda item: -sum(item[1].values()))[:slowest]:
+        lines.append(f"  {sum(walls.values()):>9.1f} s  {sim}: " + ", ".join(f"{stage} {wall:.1f} s" for stage, wall in walls.items()))
+    return "\n".join(lines)
@@ -0,0 +1,161 @@
+import glob
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+def Speedup(threads, serial):
+    """Amdahl's law: how much faster a run is on threads than on one, if serial of it can't be parallelised"""
+    return 1 / (serial + (1 - serial) / threads)
+
+def FitSerial(samples):
+    """Serial fraction that best explains wall times at several thread counts, or None without at least two counts
+
+    samples is {threads: [wall times]}.  Sims differ in how long they take, so each thread count is
+    represented by its median, and the fit is in log space so long and short runs weigh the same.
+    """
+    medians = {threads: sorted(walls)[len(walls) // 2] for threads, walls in samples.items() if walls}
+    if len(medians) < 2:
+        return None
+    best = None
+    for step in range(101):
+        serial = step / 100
+        residuals = [math.log(wall) + math.log(Speedup(threads, serial)) for threads, wall in medians.items()]
+        # The single-threaded time that fits best is the mean of these, so the error is their spread
+        mean = sum(residuals) / len(residuals)
+        error = sum(len(samples[threads]) * (residual - mean)**2 for threads, residual in zip(medians, residuals))
+        if best is None or error < best[0]:
+            best = (error, serial)
+    return best[1]
+
+class ThreadTuner:
+    """Decides how many OpenMP threads each MESA run gets, learning how well each stage scales as runs finish
+
+    Each stage's scaling is modelled with Amdahl's law, starting from a prior serial fraction and refitted
+    from the wall times of its runs at the thread counts they got, including earlier runs' telemetry.
+    Given the free cores and how many runs are ready, Choose() picks the thread count that gets the most
+    MESA work done per second across all of them, preferring more threads per run when that's a tie.  As
+    Stella and the other single-core stages take and release cores, the next runs are sized to what's left.
+    """
+
+    # Runs a thread count needs before it counts towards the fit
+    MinSamples = 3
+
+    def __init__(self, minthreads, maxthreads, serial=0.1):
+        self.maxthreads = max(1, int(maxthreads))
+        self.minthreads = min(max(1, int(minthreads)), self.maxthreads)
+        self.prior = serial
+        self.lock = threading.Lock()
+        self.samples = {} # stage -> {threads: [wall times]}
+        self.serial = {} # stage -> fitted serial fraction
+
+    def Learn(self, paths, stages=("PreCC", "PostCC")):
+        """Takes in the MESA runs recorded in earlier telemetry files"""
+        from MesaStella.Telemetry import Load
+        count = 0
+        for event in Load(paths):
+            # Stages that ran nothing, e.g. a cached progenitor, say nothing about scaling
+            if event["stage"] in stages and event["status"] == "done" and event.get("omp_threads") and event.get("runs"):
+                self.Observe(event["stage"], event["omp_threads"], event["wall_s"], refit=False)
+                count += 1
+        with self.lock:
+            for stage in self.samples:
+                self._Refit(stage)
+        if count:
+            logger.info(f"Learned MESA thread scaling from {count} earlier run(s): {self.Describe()}")
+
+    def Observe(self, stage, threads, wall, refit=True):
+        if wall <= 0:
+            return
+        with self.lock:
+            self.samples.setdefault(stage, {}).setdefault(int(threads), []).append(wall)
+            if refit:
+                self._Refit(stage)
+
+    def _Refit(self, stage):
+        """Must be called with the lock held"""
+        samples = {threads: walls for threads, walls in self.samples.get(stage, {}).items() if len(walls) >= self.MinSamples}
+        serial = FitSerial(samples)
+        if serial is None:
+            return
+        previous = self.serial.get(stage)
+        self.serial[stage] = serial
+        if previous is None or abs(serial - previous) >= 0.05:
+            logger.info(f"{stage} scaling now fits a serial fraction of {serial:.2f} "
+                        f"({Speedup(self.maxthreads, serial):.1f}x on {self.maxthreads} threads)")
+
+    def Serial(self, stage):
+        with self.lock:
+            return self.serial.get(stage, self.prior)
+
+    def Describe(self):
+        with self.lock:
+            return ", ".join(f"{stage} serial fraction {serial:.2f}" for stage, serial in sorted(self.serial.items())) or "nothing fitted yet"
+
+    def Choose(self, stage, free, ready=1):
+        """Threads for the next run of stage, with free cores and ready runs waiting (this one included); None if it should wait"""
+        if free < self.minthreads:
+            return None
+        serial = self.Serial(stage)
+        best = None
+        for threads in range(self.minthreads, min(self.maxthreads, free) + 1):
+            rate = min(max(1, ready), free // threads) * Speedup(threads, serial)
+            if best is None or rate >= best[0] * (1 - 1e-9):
+                best = (rate, threads)
+        return best[1]
+
+def NumaNodes():
+    """{cpu: NUMA node} from sysfs; every CPU is on node 0 where there's no NUMA information"""
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[len("node"):])
+        with open(path) as file:
+            for part in file.read().strip().split(","):
+                if part:
+                    first, _, last = part.partition("-")
+                    for cpu in range(int(first), int(last or first) + 1):
+                        nodes[cpu] = node
+    return nodes
+
+class CpuSets:
+    """Hands out disjoint sets of this process's CPUs, each within one NUMA node where it fits
+
+    Runs pinned to a set of their own don't migrate between cores or compete for them with the run next
+    door, and keep their memory local.  Take() gives None when there aren't enough free CPUs, e.g. when
+    the core budget is bigger than the machine, and the run then goes unpinned.
+    """
+
+    def __init__(self, cpus=None):
+        self.cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+        nodes = NumaNodes()
+        self.node = {cpu: nodes.get(cpu, 0) for cpu in self.cpus}
+        self.free = set(self.cpus)
+        self.lock = threading.Lock()
+
+    def Take(self, count):
+        with self.lock:
+            if count < 1 or count > len(self.free):
+                return None
+            bynode = {}
+            for cpu in sorted(self.free):
+                bynode.setdefault(self.node[cpu], []).append(cpu)
+            # The fullest node that still fits the whole set, which leaves the emptier nodes for bigger runs
+            fits = [cpus for cpus in bynode.values() if len(cpus) >= count]
+            if fits:
+                taken = min(fits, key=len)[:count]
+            else:
+                # Spread over as few nodes as possible
+                taken = [cpu for cpus in sorted(bynode.values(), key=len, reverse=True) for cpu in cpus][:count]
+            self.free.difference_update(taken)
+            return taken
+
+    def Give(self, cpus):
+        if cpus:
+            with self.lock:
+                self.free.update(cpus)
+
+def PinEnv(cpus):
+    """OpenMP settings that keep a run's threads each on one of its CPUs"""
+    return {"OMP_PLACES": ",".join(f"{{{cpu}}}" for cpu in cpus), "OMP_PROC_BIND": "close"}
@@ -0,0 +1,323 @@
+import json
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from collections import Counter
+
+from MesaStella.ProgCache import FileLock
+
+logger = logging.getLogger(__name__)
+
+def JobID(name):
+    # Job names like 'PostCC:M12_E1.0_...' aren't all safe as file names
+    return "".join(char if char.isalnum() or char in "_-.=" else "_" for char in name)
+
+def WriteJSON(path, data):
+    """Writes through a temporary file, so readers on any host see the whole file or none of it"""
+    tmp = os.path.join(os.path.dirname(path), f".tmp-{uuid.uuid4().hex}.json")
+    with open(tmp, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+def ReadJSON(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def Listing(path, suffix=".json"):
+    """Names in a queue directory without their suffix, leaving out files still being written"""
+    return [name[:-len(suffix)] for name in os.listdir(path) if name.endswith(suffix) and not name.startswith(".tmp-")]
+
+class WorkQueue:
+    """Queue of stages in a directory shared between hosts, e.g. over NFS, that workers anywhere claim jobs from
+
+    jobs/ has one file per job, written by the coordinator: its spec, cores, priority and the jobs it
+    depends on.  A worker claims a job by writing its lease to leases/ while holding the queue's lock, and
+    keeps touching the lease while the job runs.  Anyone who sees a lease's modification time stay the same
+    for longer than lease seconds, by their own clock, takes it that the worker died; the lease is moved to
+    expired/ and the job goes back in the queue, until it has been tried attempts times.  Finished jobs are
+    recorded in done/, failed/ or skipped/.  It's all plain files under one flock, since SQLite's locking
+    can't be trusted over NFS, and hosts' clocks are never compared.
+    """
+
+    Dirs = ("jobs", "leases", "expired", "done", "failed", "skipped", "workers")
+
+    def __init__(self, root):
+        self.root = root
+        for name in self.Dirs:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+        settings = ReadJSON(os.path.join(root, "queue.json")) or {}
+        self.lease = settings.get("lease", 300)
+        self.attempts = settings.get("attempts", 3)
+        self.meta = {} # Job files only change when resubmitted, so each host reads them once
+        self.seen = {} # id -> (lease mtime, local time it was first seen at)
+        self.seq = len(Listing(os.path.join(root, "jobs")))
+
+    def Path(self, kind, jobid, suffix=".json"):
+        return os.path.join(self.root, kind, f"{jobid}{suffix}")
+
+    def Lock(self):
+        return FileLock(os.path.join(self.root, "queue.lock"))
+
+    def Open(self, lease=300, attempts=3):
+        """Starts a coordinator's run: sets how long leases last and how often a job is tried, for every worker"""
+        self.lease, self.attempts = lease, attempts
+        with self.Lock():
+            WriteJSON(os.path.join(self.root, "queue.json"), {"lease": lease, "attempts": attempts})
+            if os.path.exists(os.path.join(self.root, "closed")):
+                os.remove(os.path.join(self.root, "closed"))
+
+    def Close(self):
+        """Tells the workers no more jobs are coming, so they leave once the queue is empty"""
+        with open(os.path.join(self.root, "closed"), "w"):
+            pass
+
+    def Closed(self):
+        return os.path.exists(os.path.join(self.root, "closed"))
+
+    def Submit(self, name, spec, cores=1, deps=(), priority=0, after=()):
+        """Adds a job with a JSON-able spec for the workers' handler; deps are ids from earlier Submits.  Returns its id.
+
+        after are ids of jobs it waits for too, but which needn't succeed for it to run.  Submitting a job
+        that's already in the queue replaces it and forgets how it went last time.
+        """
+        jobid = JobID(name)
+        meta = {"name": name, "spec": spec, "cores": max(1, int(cores)), "deps": [dep for dep in deps if dep is not None],
+                "after": [job for job in after if job is not None], "priority": priority, "seq": self.seq}
+        self.seq += 1
+        with self.Lock():
+            for kind in ("done", "failed", "skipped"):
+                if os.path.exists(self.Path(kind, jobid)):
+                    os.remove(self.Path(kind, jobid))
+            for entry in os.listdir(os.path.join(self.root, "expired")):
+                if entry.rsplit(".", 2)[0] == jobid:
+                    os.remove(os.path.join(self.root, "expired", entry))
+            WriteJSON(self.Path("jobs", jobid), meta)
+        self.meta[jobid] = meta
+        return jobid
+
+    def Jobs(self):
+        """{id: job} of every job in the queue"""
+        for jobid in Listing(os.path.join(self.root, "jobs")):
+            if jobid not in self.meta:
+                meta = ReadJSON(self.Path("jobs", jobid))
+                if meta is not None:
+                    self.meta[jobid] = meta
+        return self.meta
+
+    def Graph(self):
+        """{name: names of the jobs it waits for} of every job, like StageScheduler.Graph"""
+        jobs = self.Jobs()
+        return {meta["name"]: [jobs[dep]["name"] for dep in meta["deps"] + meta.get("after", []) if dep in jobs] for meta in jobs.values()}
+
+    def Sweep(self, own=()):
+        """Requeues jobs of dead workers and skips jobs whose dependencies failed.  Must be called with the lock held.
+
+        own is the jobs the caller holds leases on itself.  Returns the jobs, {id: state} and {id: expired leases}.
+        """
+        jobs = self.Jobs()
+        finished = {kind: set(Listing(os.path.join(self.root, kind))) for kind in ("done", "failed", "skipped")}
+        leases = set(Listing(os.path.join(self.root, "leases")))
+        expired = Counter(name.rsplit(".", 1)[0] for name in Listing(os.path.join(self.root, "expired")))
+
+        now = time.monotonic()
+        for jobid in leases - set(own):
+            path = self.Path("leases", jobid)
+            if any(jobid in ids for ids in finished.values()):
+                # The worker recorded the job but died before giving up its lease
+                os.remove(path)
+                leases.discard(jobid)
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                leases.discard(jobid)
+                continue
+            seen = self.seen.get(jobid)
+            if seen is None or seen[0] != mtime:
+                self.seen[jobid] = (mtime, now)
+                continue
+            if now - seen[1] < self.lease:
+                continue
+            lease = ReadJSON(path) or {}
+            expired[jobid] += 1
+            os.replace(path, self.Path("expired", f"{jobid}.{expired[jobid]}"))
+            leases.discard(jobid)
+            del self.seen[jobid]
+            name = jobs.get(jobid, {}).get("name", jobid)
+            if expired[jobid] >= self.attempts:
+                WriteJSON(self.Path("failed", jobid), {"error": f"lease expired {expired[jobid]} times", "time": time.time()})
+                finished["failed"].add(jobid)
+                logger.error(f"Job '{name}' lost its worker {lease.get('worker', '?')} {expired[jobid]} times; giving up on it")
+            else:
+                logger.warning(f"Job '{name}' lost its worker {lease.get('worker', '?')}; putting it back in the queue")
+
+        states = {}
+        for jobid in sorted(jobs, key=lambda jobid: jobs[jobid]["seq"]):
+            state = next((kind for kind, ids in finished.items() if jobid in ids), "running" if jobid in leases else "waiting")
+            # Dependencies are always submitted first, so their states are already settled
+            if state == "waiting" and any(states.get(dep) in ("failed", "skipped") for dep in jobs[jobid]["deps"]):
+                WriteJSON(self.Path("skipped", jobid), {"time": time.time()})
+                state = "skipped"
+                logger.warning(f"Skipping job '{jobs[jobid]['name']}' since one of its dependencies did not finish")
+            states[jobid] = state
+        return jobs, states, expired
+
+    def Workers(self):
+        return len(Listing(os.path.join(self.root, "workers")))
+
+    def Run(self, poll=10):
+        """Blocks until every job has finished, failed or been skipped, as StageScheduler.Run does; returns the counts"""
+        last = None
+        while True:
+            with self.Lock():
+                _, states, _ = self.Sweep()
+            counts = dict(Counter(states.values()))
+            if not counts.get("waiting") and not counts.get("running"):
+                break
+            if counts != last:
+                logger.info(f"Work queue: {counts}; {self.Workers()} worker(s) registered")
+                last = counts
+            time.sleep(poll)
+        logger.info(f"Work queue finished: {counts}")
+        return counts
+
+class Worker:
+    """Claims jobs from a WorkQueue that fit in its cores and runs each with handler(spec) in a thread of its own
+
+    The spec a handler gets also has the job's attempt, which is above 1 when a worker died partway through it.
+    gate(spec), if given, is asked before claiming a job, so that a worker can hold off on jobs it has no room for.
+    shape(spec, free, ready), if given, sizes a job to the worker's free cores, with the specs of the ready jobs
+    it hasn't got to yet; it returns the cores to run the job on, None to hold it back, or the job's own cores.
+    The handler's spec then has the cores it got.
+    """
+
+    def __init__(self, queue, handler, cores, name=None, poll=5, gate=None, shape=None):
+        self.queue = queue
+        self.handler = handler
+        self.gate = gate
+        self.shape = shape
+        self.cores = max(1, int(cores))
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.poll = poll
+        self.free = self.cores
+        self.running = {} # id -> cores
+        self.lost = set()
+        self.counts = Counter()
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+
+    def Claim(self):
+        """Takes leases on the best ready jobs that fit in the free cores; returns them and how many jobs are left anywhere"""
+        claimed = []
+        with self.queue.Lock():
+            with self.cond:
+                own = list(self.running)
+            jobs, states, expired = self.queue.Sweep(own)
+            ready = [jobid for jobid, state in states.items() if state == "waiting"
+                     and all(states.get(dep) == "done" for dep in jobs[jobid]["deps"])
+                     and all(states.get(job) in ("done", "failed", "skipped") for job in jobs[jobid].get("after", []))]
+            # The same order as StageScheduler, with smaller jobs backfilling around a big one that doesn't fit
+            ready.sort(key=lambda jobid: (-jobs[jobid]["priority"], jobs[jobid]["seq"]))
+            for position, jobid in enumerate(ready):
+                cores = jobs[jobid]["cores"]
+                if self.shape is not None:
+                    cores = self.shape(jobs[jobid]["spec"], self.free, [jobs[other]["spec"] for other in ready[position:]])
+                    if cores is None:
+                        continue
+                cores = min(max(1, int(cores)), self.cores)
+                if cores > self.free or (self.gate is not None and not self.gate(jobs[jobid]["spec"])):
+                    continue
+                # Read again, in case a coordinator resubmitted it since it was cached
+                meta = ReadJSON(self.queue.Path("jobs", jobid)) or jobs[jobid]
+                attempt = expired[jobid] + 1
+                WriteJSON(self.queue.Path("leases", jobid), {"worker": self.name, "host": socket.gethostname(), "pid": os.getpid(),
+                                                             "attempt": attempt, "started": time.time()})
+                with self.cond:
+                    self.free -= cores
+                    self.running[jobid] = cores
+                claimed.append((jobid, meta, attempt))
+            remaining = sum(1 for state in states.values() if state in ("waiting", "running"))
+        return claimed, remaining
+
+    def Heartbeat(self):
+        """Touches the worker's leases until it stops, noting any another host has taken over"""
+        while not self.stopped.wait(self.queue.lease / 5):
+            with self.cond:
+                held = list(self.running)
+            for jobid in held + [None]:
+                path = self.queue.Path("workers", self.name) if jobid is None else self.queue.Path("leases", jobid)
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    if jobid is not None and jobid not in self.lost:
+                        self.lost.add(jobid)
+                        logger.error(f"Worker {self.name} lost its lease on '{jobid}', most likely after going quiet for over "
+                                     f"{self.queue.lease} s; another worker may be running it too")
+
+    def _Execute(self, jobid, meta, attempt):
+        started = time.time()
+        error = None
+        try:
+            logger.info(f"Worker {self.name} starting job '{meta['name']}' (attempt {attempt}) on {self.running[jobid]} core(s)")
+            self.handler({**meta["spec"], "attempt": attempt, "cores": self.running[jobid]})
+        except Exception as err:
+            error = err
+            logger.error(f"Job '{meta['name']}' failed: {err}")
+        finally:
+            record = {"worker": self.name, "attempt": attempt, "started": started, "finished": time.time()}
+            if error is not None:
+                record["error"] = str(error)
+            with self.queue.Lock():
+                lease = ReadJSON(self.queue.Path("leases", jobid))
+                if lease is None or lease["worker"] != self.name:
+                    logger.warning(f"Not recording '{meta['name']}', since worker {self.name} no longer holds its lease")
+                else:
+                    WriteJSON(self.queue.Path("failed" if error is not None else "done", jobid), record)
+                    os.remove(self.queue.Path("leases", jobid))
+            with self.cond:
+                self.free += self.running.pop(jobid)
+                self.counts["failed" if error is not None else "done"] += 1
+                self.cond.notify_all()
+
+    def Run(self):
+        """Works through the queue until it's closed and has nothing left to run; returns the counts of jobs this worker ran"""
+        WriteJSON(self.queue.Path("workers", self.name), {"host": socket.gethostname(), "pid": os.getpid(), "cores": self.cores,
+                                                          "started": time.time()})
+        heartbeat = threading.Thread(target=self.Heartbeat, name=f"Heartbeat:{self.name}", daemon=True)
+        heartbeat.start()
+        logger.info(f"Worker {self.name} taking jobs from '{self.queue.root}' on {self.cores} core(s)")
+        try:
+            while True:
+                claimed, remaining = self.Claim()
+                for jobid, meta, attempt in claimed:
+                    threading.Thread(target=self._Execute, args=(jobid, meta, attempt), name=meta["name"], daemon=True).start()
+                with self.cond:
+                    if not self.running and remaining == 0 and self.queue.Closed():
+                        break
+                    # Woken early when one of this worker's jobs finishes and frees its cores
+                    self.cond.wait(self.poll)
+        finally:
+            self.stopped.set()
+            if os.path.exists(self.queue.Path("workers", self.name)):
+                os.remove(self.queue.Path("workers", self.name))
+        logger.info(f"Worker {self.name} finished: {dict(self.counts)}")
+        return dict(self.counts)
+
+def RunCommand(spec):
+    """Handler for jobs whose spec is just a shell command"""
+    subprocess.run(spec["command"], shell=True, check=True)
+
+if __name__ == "__main__":
+    # A worker for shell command jobs, e.g. to try a queue out: python -m MesaStella.WorkQueue <root> [cores]
+    import sys
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    Worker(WorkQueue(sys.argv[1]), RunCommand, int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()).Run()
@@ -0,0 +1 @@
+"""Support modules for MesaStellaCore.py"""
@@ -1,66 +1,109 @@
-import numpy as np
 import os
-import pandas as pd
 import shutil
 import configparser
-import subprocess
-import signal
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+import argparse
+import socket
 from functools import partial
 import logging
 import time
+import glob
+import hashlib
 
+from MesaStella.Scheduler import StageScheduler, StagePriority
+from MesaStella.ProgCache import ProgenitorCache, HashFiles
+from MesaStella.BuildCache import BuildCache
+from MesaStella.Materialize import Materialize
+from MesaStella.Inlists import RenderInlists, ReplaceBlock
+from MesaStella import Runner
+from MesaStella.Manifest import RunManifest, ParamHash
+from MesaStella import Restart
+from MesaStella import Checkpoints
+from MesaStella import WorkQueue
+from MesaStella import Telemetry
+from MesaStella.Scratch import ScratchSpace
+from MesaStella import Retention
+from MesaStella.Threads import ThreadTuner, CpuSets, PinEnv
+from MesaStella import Sweep
+# numpy, pandas and everything built on them (exporting, grids, fitting, emulators, refinement) are imported where
+# they're used, so that workers and other tools importing this start in milliseconds
 
 
-### Set up logging
 
-Logfiles = ["Logs/Latest.log", "Logs/MESA.log", "Logs/Stella.log"]
+### Command line
 
-# Check if any of the log files exist
-if any(os.path.exists(log) for log in Logfiles):
-    # Create a timestamp in year-month-day_hms format
-    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
-    archive_dir = f"Logs/Archive/{timestamp}"
-    os.makedirs(archive_dir, exist_ok=True)
+def ParseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the simlist's grid of MESA + Stella models")
+    parser.add_argument("mode", nargs="?", default="run", choices=["run", "coordinate", "worker", "compact"],
+                        help="run: everything on this machine.  coordinate: queue the stages in [QUEUE] Dir for workers on any host "
+                             "sharing this directory, then wait for them.  worker: run stages from that queue.  "
+                             "compact: apply a [RETENTION] policy to the simlist's finished sims.")
+    parser.add_argument("--queue", help="Directory of the shared job queue, instead of [QUEUE] Dir")
+    parser.add_argument("--cores", type=int, help="Cores this worker runs stages on, instead of [SCHEDULER] CoreBudget")
+    parser.add_argument("--policy", choices=["keep", "compact", "lean"], help="Retention policy for compact mode, instead of [RETENTION] Policy")
+    return parser.parse_args(argv)
 
-    # Move existing logs into the archive directory
-    for log in Logfiles:
-        if os.path.exists(log):
-            shutil.move(log, archive_dir)
+WorkerName = f"{socket.gethostname()}-{os.getpid()}"
+
+### Logging
 
 # Primary logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO) # Minimum level passed to console
-
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
-
-file_handler = logging.FileHandler("Logs/Latest.log", mode="w")
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-
 # MESA and Stella logs
-
 MesaLogger = logging.getLogger("MESA")
 MesaLogger.propagate = False
 MesaLogger.setLevel(logging.INFO)
-MesaFileHandler = logging.FileHandler("Logs/MESA.log", mode="w")
-MesaFileHandler.setLevel(logging.INFO)
-MesaFileHandler.setFormatter(formatter)
-MesaLogger.addHandler(MesaFileHandler)
 
 StellaLogger = logging.getLogger("Stella")
 StellaLogger.propagate = False
 StellaLogger.setLevel(logging.INFO)
-StellaFileHandler = logging.FileHandler("Logs/Stella.log", mode="w")
-StellaFileHandler.setLevel(logging.INFO)
-StellaFileHandler.setFormatter(formatter)
-StellaLogger.addHandler(StellaFileHandler)
+
+def SetupLogging(logdir):
+    """Archives the logs of the last run in logdir and starts this run's"""
+    os.makedirs(logdir, exist_ok=True)
+    Logfiles = [os.path.join(logdir, name) for name in ("Latest.log", "MESA.log", "Stella.log", "Telemetry.jsonl", "Telemetry.prom", "Telemetry.txt")]
+    
+    # Check if any of the log files exist
+    if any(os.path.exists(log) for log in Logfiles):
+        # Create a timestamp in year-month-day_hms format
+        timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+        archive_dir = os.path.join(logdir, "Archive", timestamp)
+        os.makedirs(archive_dir, exist_ok=True)
+        
+        # Move existing logs into the archive directory
+        for log in Logfiles:
+            if os.path.exists(log):
+                shutil.move(log, archive_dir)
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO) # Minimum level passed to console
+    
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+    
+    file_handler = logging.FileHandler(Logfiles[0], mode="w")
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    
+    # Support modules log through the same handlers
+    PackageLogger = logging.getLogger("MesaStella")
+    PackageLogger.setLevel(logging.INFO)
+    PackageLogger.addHandler(console_handler)
+    PackageLogger.addHandler(file_handler)
+    
+    MesaFileHandler = logging.FileHandler(Logfiles[1], mode="w")
+    MesaFileHandler.setLevel(logging.INFO)
+    MesaFileHandler.setFormatter(formatter)
+    MesaLogger.addHandler(MesaFileHandler)
+    
+    StellaFileHandler = logging.FileHandler(Logfiles[2], mode="w")
+    StellaFileHandler.setLevel(logging.INFO)
+    StellaFileHandler.setFormatter(formatter)
+    StellaLogger.addHandler(StellaFileHandler)
 
 ###
 
@@ -68,50 +111,201 @@ StellaLogger.addHandler(StellaFileHandler)
 MainDir = os.path.dirname(os.path.realpath(__file__))
 GridDir = os.path.join(MainDir, "mesa-24.08.1/ModelGrids/")
 ProgOptimizeDir = os.path.join(MainDir, "ProgOptimize")
+CheckpointDir = os.path.join(MainDir, "Checkpoints")
+BuildCacheDir = os.path.join(MainDir, "BuildCache")
+MesaDir = os.path.join(MainDir, "mesa-24.08.1")
 SourceDir_12M = os.path.join(GridDir, "000_Source_12M")
 SourceDir_20M = os.path.join(GridDir, "000_Source_20M")
 DataDir = os.path.join(MainDir, "DataExports")
 InputDir = os.path.join(MainDir, "InputFiles")
 
-# Load user-set information from config file
+# Load user-set information from config file, next to this script so that it's found from anywhere
 config = configparser.ConfigParser(inline_comment_prefixes="#")
-config.read("SetupConfig.cfg")
+config.read(os.path.join(MainDir, "SetupConfig.cfg"))
 
 # MAIN
-User = config["MAIN"]["User"]
-MesaSDKDir = config["MAIN"]["MesaSDK_Dir"]
-NumThreads = eval(config["MAIN"]["NumThreads"])
-SimlistName = config["MAIN"]["SimlistName"]
-TimeoutTime = eval(config["MAIN"]["TimeoutTime"])
-
-# Define observed data globals
-obsinfo = {}
-obsinds = {}
-obsmags = {}
-obstimes = {}
-dmags = {}
-ll0 = {}
-
-def BandConv(data, bandout):
-    out = {}
-    
-    for band in ["U", "B", "V", "R", "I"]:
-        out[band] = data[f"M{band}"]
-    
-    # These conversions are based upon Lupton (2005).  These equations are from solving the system with Mathematica for the ugriz components.
-    out["u"] = 7.30606e-11 * (-5.66804e9 + 4.31686e10*data["MB"] + 77341.9 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]))
-    out["g"] = 3.44116e-8 * (-1.90779e6 + 1.453e7*data["MB"] - 38.1182 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]))
-    out["r"] = 4.75955e-11 * (1.14344e9 - 7.65731e9*data["MB"] + 20088.3 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]) + 3.6325e10*data["MV"])
-    out["i"] = 1.29688e-13 * (2.76958e12 + 6.7614e12*data["MB"] + 2.6263e13*data["MR"] - 1.7738e7 * np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]) - 3.2075e13*data["MV"])
-    out["z"] = 2.05854e-15 * (6.85196e14 + 4.25968e14*data["MB"] + 1.65457e15*data["MR"] - 1.11749e9 *np.sqrt(3.58517e10 - 3.81558e10*data["MB"] + 1.453e11*data["MB"]**2 - 3.768e11*data["MV"]) - 2.02072e15*data["MV"])
-
-    return out[bandout]
+User = config.get("MAIN", "User", fallback="root")
+MesaSDKDir = config.get("MAIN", "MesaSDK_Dir", fallback="/root/mesasdk")
+NumThreads = config.getint("MAIN", "NumThreads", fallback=os.cpu_count())
+SimlistName = config.get("MAIN", "SimlistName", fallback="simlist.csv")
+TimeoutTime = config.getfloat("MAIN", "TimeoutTime", fallback=3600)
+
+# SETUP
+MaterializeMode = config.get("SETUP", "Materialize", fallback="link")
+Resume = config.getboolean("SETUP", "Resume", fallback=True)
+
+# SCRATCH
+ScratchDir = config.get("SCRATCH", "Dir", fallback="")
+ScratchMaxGB = config.getfloat("SCRATCH", "MaxGB", fallback=50)
+ScratchSimGB = config.getfloat("SCRATCH", "SimGB", fallback=2)
+ScratchThreads = config.getint("SCRATCH", "Threads", fallback=4)
+ScratchKeep = config.get("SCRATCH", "Keep", fallback="*/LOGS/history.data */LOGS/profiles.index").split()
+
+# RETENTION
+RetentionPolicy = config.get("RETENTION", "Policy", fallback="keep")
+RetentionCodec = config.get("RETENTION", "Codec", fallback="xz")
+RetentionLevel = config.getint("RETENTION", "Level", fallback=6)
+RetentionDelete = config.get("RETENTION", "Delete", fallback="*/star *.o */make/*.mod PostCC/stella/obj/*.mod *.exe PostCC/stella/res/stella_extras */photos/*").split()
+RetentionCompress = config.get("RETENTION", "Compress", fallback="*.mod */LOGS/*.data PostCC/stella/res/*").split()
+RetentionDrop = config.get("RETENTION", "Drop", fallback="*/LOGS/profile*.data PostCC/shock_part[1-4].mod").split()
+
+# THREADS
+AutoThreads = config.getboolean("THREADS", "Auto", fallback=True)
+MinThreads = config.getint("THREADS", "MinThreads", fallback=4)
+SerialFraction = config.getfloat("THREADS", "SerialFraction", fallback=0.1)
+PinCpus = config.getboolean("THREADS", "Pin", fallback=True)
+
+# SCHEDULER
+CoreBudget = config.getint("SCHEDULER", "CoreBudget", fallback=os.cpu_count())
+PlanAhead = config.getint("SCHEDULER", "PlanAhead", fallback=1000)
+
+# CACHE
+ProgCacheMaxGB = config.getfloat("CACHE", "ProgCacheMaxGB", fallback=20)
+CheckpointMaxGB = config.getfloat("CACHE", "CheckpointMaxGB", fallback=20)
+
+# EXPORT
+ExportCSV = config.getboolean("EXPORT", "CSV", fallback=False)
+ResampleStep = config.getfloat("EXPORT", "ResampleStep", fallback=0.5)
+ExportBands = config.get("EXPORT", "Bands", fallback="u g r i z ATLAS_c ATLAS_o").split()
+
+# TIMEOUTS
+# Each stage gets its own time budget, falling back to TimeoutTime
+StageTimeouts = {stage: config.getfloat("TIMEOUTS", stage, fallback=TimeoutTime) for stage in ("PreCC", "PostCC", "Stella")}
+
+# RETRY
+MaxAttempts = config.getint("RETRY", "MaxAttempts", fallback=1)
+RetryBackoff = config.getfloat("RETRY", "Backoff", fallback=60)
+RelaxedControls = [control.strip() for control in config.get("RETRY", "RelaxedControls", fallback="").split(";") if control.strip()]
+
+# FIT
+FitPhotometry = config.get("FIT", "Photometry", fallback="")
+FitShifts = (config.getfloat("FIT", "ShiftMin", fallback=0), config.getfloat("FIT", "ShiftMax", fallback=30),
+             config.getfloat("FIT", "ShiftStep", fallback=0.25)) # Made into a range of shifts by FitGrids
+FitMu = (config.getfloat("FIT", "DistanceModulus", fallback=0), config.getfloat("FIT", "DistanceModulusErr", fallback=float("inf")))
+FitEBV = (config.getfloat("FIT", "EBV", fallback=0), config.getfloat("FIT", "EBVErr", fallback=float("inf")))
+FitPenalty = config.getfloat("FIT", "Penalty", fallback=25)
+FitWorkers = config.getint("FIT", "Workers", fallback=1)
+
+# EMULATOR
+BuildEmulator = config.getboolean("EMULATOR", "Build", fallback=True)
+EmulatorVariance = config.getfloat("EMULATOR", "Variance", fallback=0.999)
+EmulatorLengthScale = config.getfloat("EMULATOR", "LengthScale", fallback=1.0)
+
+# FEATURES
+FeatureIndexing = config.getboolean("FEATURES", "Enabled", fallback=True)
+FeatureBands = config.get("FEATURES", "Bands", fallback="Mbol MU MB MV MR MI u g r i z").split()
+
+# REFINE
+RefineEnabled = config.getboolean("REFINE", "Enabled", fallback=False)
+RefineMode = config.get("REFINE", "Mode", fallback="change")
+RefineBands = config.get("REFINE", "Bands", fallback="MB MV MR").split()
+RefineBatch = config.getint("REFINE", "BatchSize", fallback=10)
+RefineMaxSims = config.getint("REFINE", "MaxSims", fallback=100)
+RefineMaxIterations = config.getint("REFINE", "MaxIterations", fallback=10)
+RefineTolerance = config.getfloat("REFINE", "Tolerance", fallback=0.05)
+RefineMinSpacing = config.getfloat("REFINE", "MinSpacing", fallback=0.01)
+
+# QUEUE
+QueueDir = os.path.join(MainDir, config.get("QUEUE", "Dir", fallback="Queue"))
+QueueLease = config.getfloat("QUEUE", "Lease", fallback=300)
+QueueAttempts = config.getint("QUEUE", "Attempts", fallback=3)
+QueuePoll = config.getfloat("QUEUE", "Poll", fallback=5)
+
+# LOGGING
+TailLines = config.getint("LOGGING", "TailLines", fallback=200)
+ProgressInterval = config.getfloat("LOGGING", "ProgressInterval", fallback=10)
+PrometheusDir = config.get("LOGGING", "PrometheusDir", fallback="")
+
+def MesaEnv(threads):
+    """Shell lines that set up MESA and its SDK"""
+    sdkroot = "/root/mesasdk" if User == "root" else MesaSDKDir
+    return (
+    f'export MESA_DIR="{MesaDir}"\n'
+    # A run's thread count is decided when it starts, so the rendered one is just the fallback
+    f'export OMP_NUM_THREADS=${{MESA_STELLA_THREADS:-{threads}}}\n'
+    f'export MESASDK_ROOT="{sdkroot}"\n'
+    'source "$MESASDK_ROOT/bin/mesasdk_init.sh"\n'
+    'export PATH="$PATH:$MESA_DIR/scripts/shmesa"'
+    )
+
+# What the stages share in a process, made by Setup() so that importing this doesn't touch anything
+LogDir = None
+ProgCache = None
+CheckpointCache = None
+Progress = None
+RunStarted = None
+Meter = None
+Timeouts = None
+Manifest = None
+Binaries = None
+Scratch = None
+Tuner = None
+Pinning = None
+
+def Setup(mode="run", cores=None):
+    """Starts the logs and opens the caches, run manifest and telemetry that stages use
+
+    main() calls this before running anything.  Other tools can call it too, to make Sims and run or export
+    them without starting a grid.  cores is what a worker may use, if not CoreBudget.
+    """
+    global LogDir, ProgCache, CheckpointCache, Progress, RunStarted, Meter, Timeouts, Manifest, Binaries, Scratch, Tuner, Pinning
+    
+    # Workers log to a directory of their own, so they neither archive nor interleave with the coordinator's logs
+    LogDir = os.path.join("Logs", "Workers", WorkerName) if mode == "worker" else "Logs"
+    SetupLogging(LogDir)
+    
+    # Every unique progenitor is built once and then shared through this cache
+    os.makedirs(ProgOptimizeDir, exist_ok=True)
+    ProgCache = ProgenitorCache(ProgOptimizeDir, ProgCacheMaxGB * 1024**3)
+    
+    # Intermediate post-core-collapse models, so sims that only differ later in the run branch off a shared prefix
+    os.makedirs(CheckpointDir, exist_ok=True)
+    CheckpointCache = ProgenitorCache(CheckpointDir, CheckpointMaxGB * 1024**3, kind="checkpoint")
+    
+    # Live progress of every running MESA and Stella stage, also mirrored to Logs/Progress.json
+    Progress = Runner.ProgressRegistry(os.path.join(LogDir, "Progress.json"), ProgressInterval)
+    
+    # Wall and CPU time, peak memory, I/O and outcome of every stage, for Logs/Telemetry.jsonl, Prometheus and the end-of-run report
+    RunStarted = time.time()
+    Meter = Telemetry.Recorder(os.path.join(LogDir, "Telemetry.jsonl"),
+                               os.path.join(PrometheusDir, f"MesaStella-{WorkerName}.prom") if PrometheusDir else os.path.join(LogDir, "Telemetry.prom"),
+                               {"worker": WorkerName})
+    
+    # Every stage that runs out of time is recorded here across runs, to tune StageTimeouts from
+    Timeouts = Runner.TimeoutLog(os.path.join("Logs", "Timeouts.jsonl"))
+    
+    # Which stages of which sims have finished, so a rerun after a crash picks up where it left off
+    Manifest = RunManifest(os.path.join(GridDir, "Manifest.jsonl"))
+    
+    # The star executables and Stella binaries are compiled once per template and linked into every sim
+    Binaries = BuildCache(BuildCacheDir, MesaEnv(NumThreads), MesaDir, "/root/mesasdk" if User == "root" else MesaSDKDir)
+    
+    # Sims run on fast local storage, with their results copied back to the grid as each stage finishes.  A worker
+    # waits for the copies, since the sim's next stage may run on another machine; the coordinator runs no stages.
+    if ScratchDir and mode in ("run", "worker"):
+        Scratch = ScratchSpace(ScratchDir, WorkerName, ScratchMaxGB * 1024**3, ScratchSimGB * 1024**3, ScratchThreads, synchronous=mode == "worker")
+    
+    # MESA runs get as many threads as make the best use of the free cores, learned from how earlier runs scaled,
+    # and each MESA or Stella run is pinned to CPUs of its own
+    if mode in ("run", "worker"):
+        if AutoThreads:
+            # Never more than this process may use, or a MESA stage could wait forever for cores it can't have
+            Tuner = ThreadTuner(min(MinThreads, cores or CoreBudget), NumThreads, SerialFraction)
+            Tuner.Learn(glob.glob(os.path.join("Logs", "**", "Telemetry.jsonl"), recursive=True))
+        if PinCpus:
+            Pinning = CpuSets()
 
 class InvalidSimType(Exception):
     pass
 
+class SimulationFailed(Exception):
+    pass
+
+class TimeoutException(Exception):
+    pass
+
 class Sim:
-    def __init__(self, mass, energy, ni56, windscalar, metallicity, HeFrac, csmtime, csmrate, csmvelo, CSMOptimize, ProgOptimize, gridtag):
+    def __init__(self, mass, energy, ni56, windscalar, metallicity, HeFrac, csmtime, csmrate, csmvelo, gridtag):
         # Non-CSM parameters
         self.mass = mass
         self.energy = energy
@@ -119,13 +313,14 @@ class Sim:
         self.windscalar = windscalar
         self.metallicity = metallicity
         self.HeFrac = HeFrac
-        self.ProgOptimize = ProgOptimize
+        
+        # Set when this sim is the one that builds (or fetches) the progenitor shared by its group of simlist rows
+        self.BuildsProgenitor = False
         
         # CSM parameters
         self.csmtime = csmtime
         self.csmrate = csmrate
         self.csmvelo = csmvelo
-        self.CSMOptimize = CSMOptimize
         
         # Others
         self.GridTag = gridtag
@@ -149,6 +344,23 @@ class Sim:
         )
         self.dirname = dirname
         self.simdir = os.path.join(GridDir, dirname)
+        # Where the sim runs: in scratch if there is one, and its results are copied back to simdir
+        self.workdir = Scratch.Path(dirname) if Scratch is not None else self.simdir
+        
+        # Everything that affects the output, including what isn't in the directory name
+        params = {
+            "mass": mass, "energy": energy, "ni56": ni56, "windscalar": windscalar, "metallicity": metallicity,
+            "HeFrac": HeFrac, "csmtime": csmtime, "csmrate": csmrate, "csmvelo": csmvelo,
+            "template": os.path.basename(self.TheSourceDir),
+        }
+        self.paramhash = ParamHash(params)
+        # Plain Python values, since the simlist hands us numpy ones
+        self.params = {key: value.item() if hasattr(value, "item") else value for key, value in params.items()}
+        self.RenderedFiles = []
+        self.Resumed = False # Set when a previous run already created the directory
+        self.Threads = NumThreads # OpenMP threads of this sim's MESA runs, and the CPUs they're pinned to, if any
+        self.Cpus = None
+        self.Checkpoints = None # Filled in by CheckpointKeys
         
         self.premodname =(
         f"M{self.mass}_" # Mass
@@ -159,391 +371,546 @@ class Sim:
         )
         
         logger.info(f"Created Sim instance with name {dirname}")
-        logger.info(f"CSM optimization is: {self.CSMOptimize}")
         
     def MakeSource(self):
-        """Creates source shell scripts for running the make and run files later on"""
-        
-        def UpdateBlock(fp, block, start_marker = "# BEGIN BLOCK", end_marker = "# END BLOCK"):
-            with open(fp, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-        
-            # Find indices of the start and end markers
-            start_index = next(i for i, line in enumerate(lines) if line.strip() == "# BEGIN BLOCK")
-            end_index   = next(i for i, line in enumerate(lines) if line.strip() == "# END BLOCK")
-        
-            # Remove the old block (including markers)
-            del lines[start_index:end_index + 1]
-        
-            # Create the new block with markers
-            blocklines = block.split("\n")
-            new_block = [
-                start_marker + "\n",
-                *[line + "\n" for line in blocklines],
-                end_marker + "\n"
-            ]
-        
-            # Insert the new block in place of the old block
-            lines[start_index:start_index] = new_block
-        
-            # Write updated lines back to the file
-            with open(fp, "w", encoding="utf-8") as f:
-                f.writelines(lines)
-        
-        mesadir = os.path.join(MainDir, "mesa-24.08.1")
-    
-        if User == "root":  
-            env = (
-            f'export MESA_DIR="{mesadir}"\n'
-            f'export OMP_NUM_THREADS={NumThreads}\n'
-            f'export MESASDK_ROOT="/root/mesasdk"\n'
-            'source "$MESASDK_ROOT/bin/mesasdk_init.sh"\n'
-            'export PATH="$PATH:$MESA_DIR/scripts/shmesa"'
-            )
-        else:
-            env = (
-            f'export MESA_DIR="{mesadir}"\n'
-            f'export OMP_NUM_THREADS={NumThreads}\n'
-            f'export MESASDK_ROOT="{MesaSDKDir}"\n'
-            'source "$MESASDK_ROOT/bin/mesasdk_init.sh"\n'
-            'export PATH="$PATH:$MESA_DIR/scripts/shmesa"'
-            )
-        
-        for simtype in ["PreCC", "PostCC"]:
-            fp = os.path.join(self.TheSourceDir, f"{simtype}/run_mesa.sh")
-            UpdateBlock(fp, env)
-            
-        # Update the optimize shell script in case CSM optimization is enabled
-        fp = os.path.join(self.TheSourceDir, "PostCC/run_mesa_optimized.sh")
-        UpdateBlock(fp, env)
-        
-        if User == "root":
-            env2 = (
-            "\n"
-            f'export MESA_DIR="{mesadir}"\n'
-            f'export OMP_NUM_THREADS=1\n'
-            f'export MESASDK_ROOT="{MesaSDKDir}"\n'
-            'source "$MESASDK_ROOT/bin/mesasdk_init.sh"\n'
-            'export PATH="$PATH:$MESA_DIR/scripts/shmesa"'
-            )
-        else:
-            env2 = (
-            "\n"
-            f'export MESA_DIR="{mesadir}"\n'
-            f'export OMP_NUM_THREADS=1\n'
-            f'export MESASDK_ROOT="{MesaSDKDir}"\n'
-            'source "$MESASDK_ROOT/bin/mesasdk_init.sh"\n'
-            'export PATH="$PATH:$MESA_DIR/scripts/shmesa"'
-            )
-        
-        # Update the shell script for Stella
-        fp = os.path.join(self.TheSourceDir, "PostCC/stella/run_stella.sh")
-        UpdateBlock(fp, env2)
-        
-        logger.info("Updated source shell scripts")
+        """Renders the shell scripts for running the make and run files later on; returns {relpath: text}"""
+        # MESA runs use the configured thread count, Stella is single-threaded
+        scripts = {
+            "PreCC/run_mesa.sh": MesaEnv(NumThreads),
+            "PostCC/run_mesa.sh": MesaEnv(NumThreads),
+            "PostCC/stella/run_stella.sh": "\n" + MesaEnv(1),
+        }
+        return {relpath: ReplaceBlock(os.path.join(self.TheSourceDir, relpath), block) for relpath, block in scripts.items()}
 
     def CreateSim(self):
         """Creates simulation directory with MESA and Stella"""
         
-        def ConfigInlist(filepath, line, value):
-            """Replaces placeholders in inlists with requested values"""
-            with open(filepath, 'r') as file:
-                lines = file.readlines()
-            
-            lines[line] = lines[line].replace("PLACEHOLDER", str(value))
-            
-            # Write the lines back to the inlist
-            with open(filepath, 'w') as file:
-                file.writelines(lines)
-            logger.info(f"Set line {line} in file '{filepath}' to {value}")
-        
-        # Copy source to simdir
-        shutil.copytree(self.TheSourceDir,
-                        self.simdir
-                        )        
-        # Check if it's a CSM sim or not to configure MESA for optimized speed during directory setup
-        if self.CSMOptimize == True:
-            
-            shutil.copy(os.path.join(InputDir, "PreCSM.mod"),
-                        os.path.join(self.TheSourceDir, "PostCC/shock_part4.mod")
-                        )
-            
-            logger.info("Copied CSM acclerator model")
-        # If progenitor optimization is true, check if a progenitor model has already been built.  If so, use it
-        if self.ProgOptimize == True:
-            premod_path = os.path.join(ProgOptimizeDir, self.premodname)
-            if os.path.exists(premod_path) == True:
-                shutil.copy(premod_path,
-                            os.path.join(self.simdir, "PostCC/pre_ccsn.mod")
-                            )
-                logger.info(f"Copied progenitor acclerator model '{self.premodname}'")
-
-
-        ### Configure inlist(s) for the pre-CC MESA model
-        
-        # Metallicity
-        ConfigInlist(
-            os.path.join(self.simdir, "PreCC/inlist_mass_Z_wind_rotation"),
-            3,
-            self.metallicity
-            )
-        ConfigInlist(
-            os.path.join(self.simdir, "PreCC/inlist_mass_Z_wind_rotation"),
-            9,
-            self.metallicity
-            )
-        ConfigInlist(
-            os.path.join(self.simdir, "PreCC/inlist_mass_Z_wind_rotation"),
-            14,
-            self.metallicity
-            )
-        
-        # Helium fraction
-        ConfigInlist(
-            os.path.join(self.simdir, "PreCC/inlist_mass_Z_wind_rotation"),
-            15,
-            self.HeFrac
-            )
-        
-        # Mass
-        ConfigInlist(
-            os.path.join(self.simdir, "PreCC/inlist_mass_Z_wind_rotation"),
-            13,
-            self.mass
-            )
-        
-        # Dutch wind scaling factor
-        ConfigInlist(
-            os.path.join(self.simdir, "PreCC/inlist_mass_Z_wind_rotation"),
-            16,
-            self.windscalar
-            )
+        # Everything parameterised for this sim is rendered in memory first, so each file is written exactly once
+        rendered = {**RenderInlists(self.TheSourceDir, self), **self.MakeSource()}
+        self.RenderedFiles = sorted(rendered)
         
-        ### Configure inlists for the post-CC MESA model
+        # A directory left behind by an interrupted run of this grid gets rebuilt; anything else is left alone
+        if os.path.exists(self.simdir) and Resume and Manifest.Known(self.dirname):
+            logger.warning(f"Removing incomplete simulation directory '{self.simdir}' left by an earlier run")
+            shutil.rmtree(self.simdir)
+        if self.workdir != self.simdir:
+            # Claims the directory in the grid that the results go to, which fails just the same if it isn't ours
+            os.makedirs(self.simdir)
+            if os.path.exists(self.workdir):
+                shutil.rmtree(self.workdir)
         
-        # Explosion energy
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_edep"),
-            49,
-            str(self.energy) + "d+50"
-            )
+        # Copy source to the sim's directory, sharing the read-only parts of the template unless told otherwise
+        self.MaterializeStats = Materialize(self.TheSourceDir, self.workdir, MaterializeMode, exclude=rendered)
+        stats = self.MaterializeStats
         
-        # Mass
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_edep"),
-            37,
-            self.mass
-            )
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_mass_Z"),
-            12,
-            self.mass
-            )
+        for relpath, text in rendered.items():
+            path = os.path.join(self.workdir, relpath)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(text)
+            shutil.copymode(os.path.join(self.TheSourceDir, relpath), path)
+            stats["copied"] += 1
+            stats["bytes_written"] += len(text)
         
-        # Metallicity
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_mass_Z"),
-            3,
-            self.metallicity
-            )
+        logger.info(f"Materialized {self.dirname} ({MaterializeMode}): {stats['copied']} copied or rendered, {stats['reflinked']} reflinked, "
+                    f"{stats['hardlinked'] + stats['symlinked']} linked, {stats['skipped']} stale outputs skipped; "
+                    f"{stats['bytes_written'] / 1024**2:.2f} MB written, {stats['bytes_shared'] / 1024**2:.2f} MB shared with the template")
         
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_mass_Z"),
-            7,
-            self.metallicity
-            )
-        
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_mass_Z"),
-            11,
-            self.metallicity
-            )
-        
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_edep"),
-            38,
-            self.metallicity
-            )
-        
-        # Ni56
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_shock_part3"),
-            27,
-            self.ni56
-            )
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_shock_part5"),
-            56,
-            self.ni56
-            )
-        
-        # CSM parameters
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_stella"),
-            9,
-            self.csmtime
-            )
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_stella"),
-            10,
-            self.csmrate
-            )
-        ConfigInlist(
-            os.path.join(self.simdir, "PostCC/inlist_stella"),
-            11,
-            self.csmvelo
-            )
-            
-        # Adds CSM cells if CSM is present
-        if self.csmrate != 0:
-            ConfigInlist(
-                os.path.join(self.simdir, "PostCC/inlist_stella"),
-                4,
-                40
-                )
-        else:
-            ConfigInlist(
-                os.path.join(self.simdir, "PostCC/inlist_stella"),
-                4,
-                0
-                )
+        logger.info(f"Rendered {len(rendered)} inlists and scripts for {self.dirname}")
         
-        logger.info("Updated inlists")
+    def StageArtifacts(self, stage):
+        """The files a finished stage leaves behind, which a resumed run checks before skipping it"""
+        if stage == "CreateSim":
+            return [os.path.join(self.simdir, relpath) for relpath in self.RenderedFiles]
+        if stage == "PreCC":
+            return [os.path.join(self.simdir, "PostCC/pre_ccsn.mod")]
+        if stage == "PostCC":
+            return [os.path.join(self.simdir, "PostCC", name) for name in ("shock_part5.mod", "mesa.hyd", "mesa.abn")]
+        if stage == "Stella":
+            return [os.path.join(self.simdir, "PostCC/stella/res/mesa.tt")]
+        if stage == "ExportData":
+            return [os.path.join(DataDir, str(self.GridTag), f"Data_{self.dirname}.csv")] if ExportCSV else []
+        return []
+    
+    def WriteBackFiles(self, stage, since, artifacts=True):
+        """(scratch, grid) paths of what a stage leaves that's kept: its artifacts, and whatever matching [SCRATCH] Keep it wrote after since"""
+        relpaths = [relpath for relpath in Scratch.Matching(self.dirname, ScratchKeep)
+                    if os.path.getmtime(os.path.join(self.workdir, relpath)) >= since]
+        if artifacts:
+            for path in self.StageArtifacts(stage):
+                # The optional CSV export goes straight to DataExports
+                if not path.startswith(self.simdir):
+                    continue
+                relpath = os.path.relpath(path, self.simdir)
+                if not os.path.isfile(os.path.join(self.workdir, relpath)):
+                    raise FileNotFoundError(f"{stage} for {self.dirname} finished without producing '{relpath}'")
+                relpaths.append(relpath)
+        return [(os.path.join(self.workdir, relpath), os.path.join(self.simdir, relpath)) for relpath in sorted(set(relpaths))]
+    
+    def Restage(self):
+        """Rebuilds the sim's directory in scratch from the template and what the grid has of it, e.g. after it was evicted"""
+        Materialize(self.TheSourceDir, self.workdir, MaterializeMode)
+        for dirpath, _, filenames in os.walk(self.simdir):
+            for name in filenames:
+                relpath = os.path.relpath(os.path.join(dirpath, name), self.simdir)
+                path = os.path.join(self.workdir, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Unlinked first, since it may be a link to the template
+                if os.path.lexists(path):
+                    os.remove(path)
+                shutil.copy2(os.path.join(self.simdir, relpath), path)
+        logger.info(f"Restored {self.dirname} to scratch from '{self.simdir}'")
+    
+    def Retain(self, policy=None):
+        """Slims down the finished sim's directory in the grid as the [RETENTION] policy says"""
+        policy = policy or RetentionPolicy
+        if policy == "keep":
+            return
+        delete = RetentionDelete + (RetentionDrop if policy == "lean" else [])
+        # The manifest's artifacts are what a rerun checks, so they're only ever compressed
+        protect = [os.path.relpath(path, self.simdir) for path in Manifest.Artifacts(self.dirname, self.paramhash) if path.startswith(self.simdir)]
+        stats = Retention.Compact(self.simdir, self.TheSourceDir, delete, RetentionCompress, protect, RetentionCodec, RetentionLevel)
+        logger.info(f"Retained {self.dirname} ({policy}): deleted {stats['deleted']} and compressed {stats['compressed']} file(s), "
+                    f"{stats['before'] / 1024**2:.1f} MB -> {stats['after'] / 1024**2:.1f} MB")
+    
+    def IsDone(self, stage):
+        return Resume and Manifest.IsDone(self.dirname, self.paramhash, stage)
+    
+    def ProgenitorKey(self):
+        """Hashes everything that determines the pre-CC model: the rendered PreCC inlists and the template's run script and sources"""
+        precc = os.path.join(self.workdir, "PreCC")
+        # 'inlist' itself is just a copy of whichever header MESA is running, so it's left out
+        files = [name for name in os.listdir(precc) if name.startswith("inlist_")]
+        files += ["rn"] + [os.path.join("src", name) for name in os.listdir(os.path.join(precc, "src"))]
+        return HashFiles(precc, files)
+    
+    def CheckpointKeys(self):
+        """(header, output model, cache key) of every post-core-collapse part but the last, which each sim always runs itself
         
+        Worked out from the template and the sim's rendered inlists, so the whole grid can be planned before any sim exists.
+        """
+        if self.Checkpoints is None:
+            rendered = RenderInlists(self.TheSourceDir, self)
+            files = {stage: {relpath.split("/", 1)[1]: text for relpath, text in rendered.items() if relpath.startswith(f"{stage}/")}
+                     for stage in ("PreCC", "PostCC")}
+            base = Checkpoints.RunDigest(os.path.join(self.TheSourceDir, "PreCC"), files["PreCC"])
+            self.Checkpoints = Checkpoints.PartKeys(os.path.join(self.TheSourceDir, "PostCC"), files["PostCC"], base)[:-1]
+        return self.Checkpoints
+    
+    def FetchCheckpoint(self):
+        """Copies the deepest cached checkpoint of this sim's run into its directory; returns its index, or None"""
+        for index, (header, output, key) in reversed(list(enumerate(self.CheckpointKeys()))):
+            if CheckpointCache.Fetch(key, os.path.join(self.workdir, "PostCC", output)):
+                logger.info(f"Branching {self.dirname} from the cached checkpoint {output} ({key[:12]})")
+                return index
+        return None
+    
+    def PublishCheckpoints(self, start, part=None):
+        """Adds every part this sim ran itself, from start on, to the checkpoint cache, or only the part with header part"""
+        for header, output, key in self.CheckpointKeys()[start:]:
+            path = os.path.join(self.workdir, "PostCC", output)
+            if part in (None, header) and os.path.exists(path):
+                CheckpointCache.Publish(key, path, {"name": f"{output} of {self.dirname}", "sim": self.dirname, "part": header})
+    
     def RunSim(self, simtype):
         """Runs a simulation of a given type (PreCC, PostCC, Stella)"""
         # so hip to be square
-        def RunShellWithMESA(filename):
-            process = subprocess.Popen(f"./{filename}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-    
-            # This prints the output as it comes from the script
-            MesaLogger.info("------------- Beginning MESA simulation -------------")
-            for line in process.stdout:
-                MesaLogger.info(line)
+        def RunShell(filename, cwd, SimLogger, name, component, finished=None):
+            # Use the cached binaries if there are any, in which case the run scripts skip compiling
+            env = dict(os.environ, MESA_STELLA_THREADS=str(self.Threads if name == "MESA" else 1))
+            if self.Cpus is not None:
+                env.update(PinEnv(self.Cpus))
+            if Binaries.Link(self.TheSourceDir, component, self.workdir):
+                env["MESA_STELLA_PREBUILT"] = "1"
+                SimLogger.info(f"Linked cached {component} binaries into '{self.workdir}'")
             
-            for line in process.stderr:
-                MesaLogger.error(line)
-                
-            MesaLogger.info("------------- Finished MESA simulation -------------")
+            # Each run gets its own working directory rather than chdir-ing the whole process, so sims can run side by side.
+            # The full output goes to a log of its own, so concurrent runs don't interleave in MESA.log and Stella.log
+            logpath = os.path.join(MainDir, "Logs", "Sims", self.dirname, f"{simtype}.log.gz")
+            update = Progress.Updater(self.dirname, simtype)
+            if finished is not None:
+                # finished(header) hears about each part as soon as MESA is through with it, not once the whole run is
+                progress = update
+                def update(**fields):
+                    progress(**fields)
+                    if "finished" in fields:
+                        finished(fields["finished"])
+            parser = (Runner.StellaProgress if name == "Stella" else Runner.MesaProgress)(update)
+            Progress.Update(self.dirname, simtype, state="running", started=time.time())
+            SimLogger.info(f"------------- Beginning {name} simulation in '{cwd}', logging to '{logpath}' -------------")
             
-        def RunShellWithStella(filename):
-            StellaLogger.info("------------- Beginning Stella simulation -------------")
-            process = subprocess.Popen(f"./{filename}", stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1, shell=True)
-            # This prints the output as it comes from the script
-            for line in process.stdout:
-                StellaLogger.info(line)
-                
+            # The run gets its own process group, so a timeout takes down star and Stella rather than just the shell
+            budget = StageTimeouts[simtype]
+            result = Runner.Run(f"./{filename}", cwd, env, logpath, parser, budget, TailLines, self.Cpus)
             
-            for line in process.stderr:
-                StellaLogger.error(line)
+            SimLogger.info(f"------------- Finished {name} simulation in '{cwd}' after {result.elapsed:.0f} s with code {result.returncode} -------------")
             
-            StellaLogger.info("------------- Finished Stella simulation -------------")
+            if result.timedout:
+                Progress.Update(self.dirname, simtype, state="timed out", elapsed=result.elapsed)
+                Timeouts.Record(self.dirname, simtype, budget, result.elapsed, progress=Progress.Get(self.dirname, simtype))
+                SimLogger.error(f"Last output of {self.dirname} {simtype}:\n{result.Tail()}")
+                raise TimeoutException(f"{name} simulation in '{cwd}' timed out after {budget} s and was terminated")
+            if result.returncode != 0:
+                Progress.Update(self.dirname, simtype, state="failed", elapsed=result.elapsed)
+                SimLogger.error(f"Last output of {self.dirname} {simtype}:\n{result.Tail()}")
+                raise SimulationFailed(f"{name} simulation in '{cwd}' exited with code {result.returncode}")
+            Progress.Update(self.dirname, simtype, state="done", elapsed=result.elapsed)
+        
+        def RunShellWithMESA(filename, cwd, start=0, finished=None):
+            # MESA runs that die partway are picked up again from their latest photo rather than from the start.
+            # Parts before start are never run, since the sim branches off a checkpoint after them.
+            since = os.path.getmtime(os.path.join(cwd, "inlist_mass_Z_wind_rotation" if simtype == "PreCC" else "inlist_mass_Z"))
+            failed = set()
+            script = filename
+            resume = None
+            if self.Resumed or start:
+                # A previous run of the grid may have got partway through this stage already
+                resume = Restart.PrepareResume(cwd, since, filename, failed=failed, start=start)
+                if resume is not None:
+                    script = resume["script"]
+                    if self.Resumed:
+                        logger.info(f"Resuming {simtype} for {self.dirname} at {resume['part']} from photo {resume['photo']}")
             
-        if simtype == "PreCC":
-            # Run the shell script
-            logger.info("Beginning pre-core-collapse simulation")
-            os.chdir(os.path.join(self.simdir, "PreCC")) # This is necessary for MESA's rn script to run properly
-            RunShellWithMESA("run_mesa.sh")
-            logger.info("Finished pre-core-collapse simulation")
-            # This copies the output from the pre-CC model to the post-CC model
+            for attempt in range(1, MaxAttempts + 1):
+                try:
+                    RunShell(script, cwd, MesaLogger, "MESA", simtype, finished)
+                    return
+                except (SimulationFailed, TimeoutException) as err:
+                    if resume is not None and resume["photo"] is not None:
+                        # Don't keep restarting from a photo that MESA can't get past
+                        failed.add(resume["photo"])
+                    if attempt == MaxAttempts:
+                        raise
+                    delay = RetryBackoff * 2**(attempt - 1)
+                    logger.warning(f"{simtype} for {self.dirname} failed on attempt {attempt} of {MaxAttempts} ({err}); retrying in {delay:.0f} s")
+                    time.sleep(delay)
+                
+                resume = Restart.PrepareResume(cwd, since, filename, RelaxedControls, failed, start)
+                if resume is None:
+                    # Every part finished, so whatever failed came after them; start over
+                    script = filename
+                    logger.info(f"Rerunning {simtype} for {self.dirname} from the start")
+                else:
+                    script = resume["script"]
+                    Progress.Update(self.dirname, simtype, attempt=attempt + 1, resumed_part=resume["part"], resumed_photo=resume["photo"])
+                    logger.info(f"Restarting {simtype} for {self.dirname} at {resume['part']} "
+                                f"({'from photo ' + resume['photo'] if resume['photo'] else 'from its start'}, "
+                                f"{resume['skipped']} finished part(s) skipped{', relaxed controls' if resume['relaxed'] else ''})")
             
-            shutil.copyfile(
-                os.path.join(self.simdir, "PreCC/final.mod"),
-                os.path.join(self.simdir, "PostCC/pre_ccsn.mod")
-                )
+        def RunShellWithStella(filename, cwd):
+            RunShell(filename, cwd, StellaLogger, "Stella", "Stella")
             
-            logger.info("Copied pre-core-collapse model to the post-core-collapse simulation")
+        if simtype == "PreCC":
+            def Build():
+                # Run the shell script
+                logger.info(f"Beginning pre-core-collapse simulation for {self.dirname}")
+                RunShellWithMESA("run_mesa.sh", os.path.join(self.workdir, "PreCC")) # MESA's rn script has to run from within the sim directory
+                logger.info(f"Finished pre-core-collapse simulation for {self.dirname}")
+                return os.path.join(self.workdir, "PreCC/final.mod")
             
-            shutil.copyfile(
-                os.path.join(self.simdir, "PreCC/final.mod"),
-                os.path.join(ProgOptimizeDir, self.premodname)
-                )
+            # This runs the pre-CC model only if no identical one is cached, and copies the result to the post-CC model either way
+            info = {"premodname": self.premodname, "template": os.path.basename(self.TheSourceDir)}
+            ProgCache.Build(self.ProgenitorKey(), os.path.join(self.workdir, "PostCC/pre_ccsn.mod"), Build, info)
             
-            logger.info("Saved pre-core-collapse model to ProgOptimize in case we can use it later")
+            logger.info("Copied pre-core-collapse model to the post-core-collapse simulation")
 
         elif simtype == "PostCC":
-            # Choose to run optimized method or not
-            if self.CSMOptimize == True:
-                logger.info("Beginning post-core-collapse simulation with optimization")
-                os.chdir(os.path.join(self.simdir, "PostCC"))
-                RunShellWithMESA("run_mesa_optimized.sh")
-            else:
-                logger.info("Beginning post-core-collapse simulation without optimization")
-                os.chdir(os.path.join(self.simdir, "PostCC"))
-                RunShellWithMESA("run_mesa.sh")
+            # Start from the deepest checkpoint any sim with the same run so far has left in the cache
+            branch = self.FetchCheckpoint()
+            start = 0 if branch is None else branch + 1
+            
+            # Sims that share a progenitor pick it up from the cache once its builder has published it
+            if branch is None and self.BuildsProgenitor != True:
+                if ProgCache.Fetch(self.ProgenitorKey(), os.path.join(self.workdir, "PostCC/pre_ccsn.mod")):
+                    logger.info(f"Copied cached progenitor '{self.premodname}' to {self.dirname}")
+                else:
+                    # e.g. the sim it was to branch off failed before making its checkpoint, or the progenitor was evicted
+                    logger.warning(f"Neither a checkpoint nor progenitor '{self.premodname}' is cached for {self.dirname}; making the progenitor itself")
+                    self.RunSim("PreCC")
             
-            logger.info("Finished post-core-collapse simulation")
+            logger.info(f"Beginning post-core-collapse simulation for {self.dirname}" + (f" from {self.CheckpointKeys()[branch][1]}" if start else ""))
+            try:
+                # Each part is cached as soon as it's done, so sims branching off it needn't wait for the rest of this run
+                RunShellWithMESA("run_mesa.sh", os.path.join(self.workdir, "PostCC"), start, partial(self.PublishCheckpoints, start))
+            finally:
+                # Parts finished even if a later one failed, and any done without MESA saying so, e.g. skipped optional ones
+                self.PublishCheckpoints(start)
+            logger.info(f"Finished post-core-collapse simulation for {self.dirname}")
                 
         elif simtype == "Stella":
             
-            logger.info("Beginning Stella simulation")
-            os.chdir(os.path.join(self.simdir, "PostCC"))
+            logger.info(f"Beginning Stella simulation for {self.dirname}")
             
             # Copy MESA's output to Stella
-            shutil.copyfile("mesa.abn", os.path.join(self.simdir, "PostCC/stella/modmake/mesa.abn"))
-            shutil.copyfile("mesa.hyd", os.path.join(self.simdir, "PostCC/stella/modmake/mesa.hyd"))
+            shutil.copyfile(os.path.join(self.workdir, "PostCC/mesa.abn"), os.path.join(self.workdir, "PostCC/stella/modmake/mesa.abn"))
+            shutil.copyfile(os.path.join(self.workdir, "PostCC/mesa.hyd"), os.path.join(self.workdir, "PostCC/stella/modmake/mesa.hyd"))
             
             # Run the shell script
-            os.chdir(os.path.join("stella"))
+            RunShellWithStella("run_stella.sh", os.path.join(self.workdir, "PostCC/stella"))
             
-            RunShellWithStella("run_stella.sh")
-            
-            logger.info("Finished Stella simulation")
+            logger.info(f"Finished Stella simulation for {self.dirname}")
     
         else:
             logger.error(f"Invalid simulation type '{simtype}' was passed to RunSim")
             raise InvalidSimType("Invalid simulation type - is it 'PreCC', 'PostCC', or 'Stella'?")
     
     def ExportData(self):
+        """Reads Stella's light curve and appends it to the columnar store of the sim's grid"""
+        import numpy as np
+        from MesaStella.StellaOutput import ReadLightCurve
+        from MesaStella import Photometry
         
-        datapath = os.path.join(self.simdir, "PostCC/stella/res/mesa.tt")
+        datapath = os.path.join(self.workdir, "PostCC/stella/res/mesa.tt")
         
-        # This searches mesa.tt for the CSV header, finds it, and then only interprets it and the subsequent lines as a data table.
-        csvstr = "time           Tbb         vFe        Teff      Rlast_sc   R(tau2/3)    Mbol     MU      MB      MV      MI      MR   Mbolavg  gdepos"
-        with open(datapath, "r") as file:
-            for linenum, line in enumerate(file):
-                if csvstr in line:
-                    found = True
-                    break
-        if found:
-            data = pd.read_csv(datapath,
-                               skiprows=linenum,
-                               skipinitialspace=True,
-                               header=0,
-                               delimiter=" ",
-                               )
-            
-            for band in ["u", "g", "r", "i", "z"]:
-                data[band] = BandConv(data, band)
-            
-            GridDir = os.path.join(DataDir, self.GridTag)
-            
-            if os.path.exists(GridDir) == False:
-                os.mkdir(GridDir)
-            
-            fpfinal = os.path.join(GridDir, f"Data_{self.dirname}.csv")
-            data.to_csv(fpfinal)
-            logger.info(f"Exported simulation data from '{self.simdir}'")
-        else:
-            logger.error("An error occured within ExportData; the data header may not have been found")
+        # The table is found by its header's column names, so Stella's spacing doesn't matter
+        data = ReadLightCurve(datapath)
+        
+        # All the synthetic bands in one pass; float64 so exports match the old conversion exactly
+        data.update(Photometry.Convert(data, ExportBands, np.float64))
+        
+        GridExport(self.GridTag).Append(self.dirname, self.params, data)
+        logger.info(f"Exported simulation data from '{self.simdir}' to grid '{self.GridTag}'")
+        
+        # The light curve is in memory already, and this way the sim can be queried as soon as it's done
+        if FeatureIndexing:
+            from MesaStella import Features
+            try:
+                GridFeatures(self.GridTag).Append(self.dirname, self.params, Features.FromColumns(data, FeatureBands, ResampleStep))
+            except Exception as err:
+                logger.warning(f"Couldn't extract the light curve features of {self.dirname}, which are added when the grid is next built: {err}")
+        
+        if ExportCSV:
+            import pandas as pd
+            fpfinal = os.path.join(DataDir, str(self.GridTag), f"Data_{self.dirname}.csv")
+            pd.DataFrame(data).to_csv(fpfinal, index=False)
 
-class TimeoutException(Exception):
-    pass
+# One store per grid tag, shared by every sim exporting to it, and what was in each when the run started
+ExportStores = {}
+Exported = {}
+ExportStoresLock = threading.Lock()
+
+def GridExport(gridtag):
+    from MesaStella.ExportStore import GridStore
+    with ExportStoresLock:
+        if gridtag not in ExportStores:
+            ExportStores[gridtag] = GridStore(os.path.join(DataDir, str(gridtag)))
+            Exported[gridtag] = ExportStores[gridtag].Dirnames()
+        return ExportStores[gridtag]
+
+# One feature index per grid tag, the same way
+FeatureIndexes = {}
+
+def GridFeatures(gridtag):
+    from MesaStella.FeatureIndex import FeatureIndex
+    with ExportStoresLock:
+        if gridtag not in FeatureIndexes:
+            FeatureIndexes[gridtag] = FeatureIndex(os.path.join(DataDir, str(gridtag)))
+        return FeatureIndexes[gridtag]
+
+def BuildJob(scheduler, sim, component, BuildJobs):
+    """Returns the job that compiles a component for the sim's template, queueing it the first time it's needed"""
+    key = (sim.TheSourceDir, component)
+    if key not in BuildJobs:
+        # A failed build isn't fatal; the sims then just compile their own copy like before
+        spec = {"stage": "Build", "template": sim.TheSourceDir, "component": component, "cores": 1}
+        BuildJobs[key] = scheduler.Submit(f"Build:{component}:{os.path.basename(sim.TheSourceDir)}", StageJob(scheduler, spec),
+                                          cores=1, priority=StagePriority["Build"])
+    return BuildJobs[key]
+
+def Tracked(sim, stage, func):
+    """Wraps a stage so that it's recorded in the manifest once it and its artifacts are done
+
+    With a scratch directory, that's once its artifacts are copied back to the grid, which happens in the
+    background while the sim's next stage goes on in scratch.
+    """
+    def Done():
+        Manifest.Complete(sim.dirname, sim.paramhash, stage, sim.StageArtifacts(stage))
+        if stage == "ExportData":
+            # The sim is in the grid's store by now, so a failure here only leaves it bigger than it needs to be
+            try:
+                sim.Retain()
+            except Exception as err:
+                logger.warning(f"Couldn't apply the retention policy to {sim.dirname}: {err}")
+    
+    def Stage():
+        Manifest.Start(sim.dirname, sim.paramhash, stage)
+        if Scratch is None:
+            func()
+            Done()
+            return
+        
+        started = time.time()
+        there = Scratch.Enter(sim.dirname, new=stage == "CreateSim")
+        try:
+            if not there and stage != "CreateSim":
+                sim.Restage()
+            func()
+            files = sim.WriteBackFiles(stage, started)
+        except Exception:
+            # What a failed stage left that's worth a look is kept too, and the sim is done with scratch either way
+            try:
+                Scratch.WriteBack(sim.dirname, sim.WriteBackFiles(stage, started, artifacts=False))
+            finally:
+                Scratch.Leave(sim.dirname, done=True)
+            raise
+        try:
+            Scratch.WriteBack(sim.dirname, files, Done)
+        finally:
+            Scratch.Leave(sim.dirname, done=stage == "ExportData")
+    return Stage
 
-def signal_handler(signum, frame):
-    raise TimeoutException("")
+def StageJob(scheduler, spec):
+    """What a scheduler is given for a stage: the spec itself for a work queue's workers, or RunStage bound to it here
 
+    Either way a job carries only its spec, a small dict of plain values, so it pickles and is cheap to hand over.
+    """
+    return spec if isinstance(scheduler, WorkQueue.WorkQueue) else partial(RunStage, spec)
 
-# Import params from simlist
-Simlist = pd.read_csv(os.path.join(InputDir, SimlistName))
+def SubmitStage(scheduler, sim, stage, index, cores, deps, checkpoint=None):
+    """Queues one stage of a sim as a spec that the sim is rebuilt from when the stage runs
 
-Simarr = np.array([])
+    checkpoint is (the job making it, its key) for a PostCC branching off another sim's checkpoint, which it waits
+    for without needing that job to succeed.
+    """
+    row = SimlistRow(sim.params, sim.GridTag.item() if hasattr(sim.GridTag, "item") else sim.GridTag)
+    spec = {"stage": stage, "index": int(index), "row": row, "cores": cores, "BuildsProgenitor": sim.BuildsProgenitor, "Resumed": sim.Resumed}
+    producer = None if checkpoint is None else checkpoint[0]
+    if isinstance(scheduler, WorkQueue.WorkQueue):
+        return scheduler.Submit(f"{stage}:{sim.dirname}", StageJob(scheduler, spec), cores=cores, deps=deps, priority=StagePriority[stage],
+                                after=[producer])
+    # New sims wait for room in scratch, and MESA stages are sized to the free cores; workers do both for themselves
+    gate = None
+    if Scratch is not None and stage == "CreateSim":
+        gate = Scratch.Admit
+    elif producer is not None:
+        gate = partial(CheckpointReady, *checkpoint)
+    return scheduler.Submit(f"{stage}:{sim.dirname}", StageJob(scheduler, spec), cores=cores, deps=deps, priority=StagePriority[stage],
+                            gate=gate, shape=partial(ShapeStage, spec) if Tuner is not None and stage in ("PreCC", "PostCC") else None)
 
-logger.info("Imported simlist")
+def CheckpointReady(producer, key):
+    """Whether a sim branching off a checkpoint can start: once it's cached, or once its job stops without caching it
 
-# Iterate over every simulation parameter set in the simlist
-for index, row in Simlist.iterrows():
+    In that case the sim starts from an earlier checkpoint, or the progenitor, instead of being skipped.
+    """
+    return CheckpointCache.Has(key) or producer.state in ("done", "failed", "skipped")
+
+def ShapeStage(spec, free, ready):
+    """Threads for a MESA stage about to start, from the free cores and how many MESA stages are ready; None to wait"""
+    threads = Tuner.Choose(spec["stage"], free, ready)
+    if threads is not None:
+        spec["cores"] = threads
+    return threads
+
+def WorkerShape(spec, free, ready):
+    """ShapeStage for a worker, which sees the specs of every ready job rather than just the MESA ones"""
+    if spec["stage"] not in ("PreCC", "PostCC"):
+        return spec["cores"]
+    return Tuner.Choose(spec["stage"], free, sum(1 for other in ready if other["stage"] in ("PreCC", "PostCC")))
+
+def ScratchGate(spec):
+    """Whether a worker has room for a job: any stage of a sim it may already have, or a new sim if its scratch fits one"""
+    return spec["stage"] != "CreateSim" or Scratch.Admit()
+
+def RunStage(spec):
+    """Runs one queued stage, in this process or on a worker, rebuilding its sim from the spec's row"""
+    stage = spec["stage"]
+    if stage == "Build":
+        name = os.path.basename(spec["template"])
+        with Meter.Stage(f"Build:{spec['component']}:{name}", name, stage, spec["cores"]):
+            return Binaries.Ensure(spec["template"], spec["component"])
+    sim = SimFromRow(spec["row"])
+    sim.BuildsProgenitor = spec["BuildsProgenitor"]
+    # A worker that died partway through the stage left its run to pick up from
+    sim.Resumed = spec["Resumed"] or spec.get("attempt", 1) > 1
+    
+    if stage == "CreateSim":
+        func = sim.CreateSim
+    elif stage == "ExportData":
+        func = sim.ExportData
+    else:
+        func = partial(sim.RunSim, stage)
+    # Only the MESA stages are threaded; Stella and everything run in Python are serial
+    sim.Threads = spec["cores"] if stage in ("PreCC", "PostCC") else 1
+    sim.Cpus = Pinning.Take(spec["cores"]) if Pinning is not None and stage in ("PreCC", "PostCC", "Stella") else None
+    started = time.monotonic()
+    try:
+        with Meter.Stage(f"{stage}:{sim.dirname}", sim.dirname, stage, spec["cores"], sim.Threads) as record:
+            Tracked(sim, stage, func)()
+    finally:
+        if Pinning is not None:
+            Pinning.Give(sim.Cpus)
+    # Stages that ran nothing, e.g. with a cached progenitor, say nothing about how MESA scales
+    if Tuner is not None and stage in ("PreCC", "PostCC") and record["runs"]:
+        Tuner.Observe(stage, sim.Threads, time.monotonic() - started)
+    if stage == "CreateSim":
+        logger.info(f"Created simulation with index {spec['index']}")
+
+def BuildChain(scheduler, sim, index, ProgBuilders, BuildJobs, CheckpointJobs):
+    """Queues the CreateSim -> PreCC -> PostCC -> Stella -> ExportData chain for one sim, leaving out stages a previous run finished"""
+    
+    # A stage only counts as done if everything before it is too
+    done = {}
+    previous = True
+    for stage in ("CreateSim", "PostCC", "Stella", "ExportData"):
+        done[stage] = previous = previous and sim.IsDone(stage)
+    # The export only counts if the model actually made it into the grid's store
+    GridExport(sim.GridTag)
+    done["ExportData"] = done["ExportData"] and sim.dirname in Exported[sim.GridTag]
+    
+    if done["ExportData"]:
+        logger.info(f"Simulation with index {index} ({sim.dirname}) already finished.  Skipping it.")
+        return
+    
+    created = None
+    if not done["CreateSim"]:
+        created = SubmitStage(scheduler, sim, "CreateSim", index, 1, [])
+    else:
+        sim.Resumed = True
     
+    postcc = stella = None
+    if not done["PostCC"]:
+        postdeps = [created]
+        
+        # Branch off the deepest checkpoint that's already cached or that an earlier sim in this run will make
+        keys = sim.CheckpointKeys()
+        branch = checkpoint = None
+        for depth in reversed(range(len(keys))):
+            key = keys[depth][2]
+            if key in CheckpointJobs or CheckpointCache.Has(key):
+                branch = depth
+                if key in CheckpointJobs:
+                    checkpoint = (CheckpointJobs[key], key)
+                logger.info(f"Sim with index {index} branches off checkpoint {keys[depth][1]} ({key[:12]})")
+                break
+        
+        # Sims that start from a checkpoint don't need a progenitor at all
+        if branch is None:
+            # Only the first sim of each progenitor group that still needs it runs PreCC; the rest wait for it and read the cache
+            progkey = (sim.TheSourceDir, sim.premodname)
+            if progkey not in ProgBuilders:
+                sim.BuildsProgenitor = True
+                Planned["progenitors"] += 1
+                ProgBuilders[progkey] = SubmitStage(scheduler, sim, "PreCC", index, NumThreads, [created, BuildJob(scheduler, sim, "PreCC", BuildJobs)])
+            else:
+                logger.info(f"Sim with index {index} shares progenitor '{sim.premodname}'.  Skipping pre-CC modeling.")
+            postdeps.append(ProgBuilders[progkey])
+        
+        postdeps.append(BuildJob(scheduler, sim, "PostCC", BuildJobs))
+        postcc = SubmitStage(scheduler, sim, "PostCC", index, NumThreads, postdeps, checkpoint)
+        # Everything past the branch point is this sim's to make, and later sims can branch off it
+        made = [key for header, output, key in keys[0 if branch is None else branch + 1:] if key not in CheckpointJobs]
+        for key in made:
+            CheckpointJobs[key] = postcc
+        Planned["checkpointed"] += bool(made)
+    if not done["Stella"]:
+        stella = SubmitStage(scheduler, sim, "Stella", index, 1, [postcc, BuildJob(scheduler, sim, "Stella", BuildJobs)])
+    SubmitStage(scheduler, sim, "ExportData", index, 1, [stella])
+    
+    if done["CreateSim"]:
+        logger.info(f"Resuming simulation with index {index} ({sim.dirname}) after {'Stella' if done['Stella'] else 'PostCC' if done['PostCC'] else 'CreateSim'}")
+
+
+def SimFromRow(row):
+    """Sets up a Sim from one row of simlist-style parameters"""
     # Non-CSM parameters
     mass = row["mass"]
     energy = row["energy"]
@@ -551,92 +918,278 @@ for index, row in Simlist.iterrows():
     metallicity = row["metallicity"]
     HeFrac = row["hefrac"]
     windscalar = row["windscalar"]
-    ProgOptimize = True if row["progoptimize"] == 1 else False
     
     # CSM parameters
     csmvelo = row["csmvelo"]
     csmrate = row["csmrate"]
     csmtime = row["csmtime"]
-    CSMOptimize = True if row["csmoptimize"] == 1 else False
+    # Older simlists' progoptimize and csmoptimize columns are left unread, as they no longer do anything
     
     # Grid tag
     GridTag = row["gridtag"]
     
-    signal.signal(signal.SIGALRM, signal_handler)
-    
-    # Timeout after the timeout time
-    signal.alarm(TimeoutTime)
-    
-    try:
-        sim1 = Sim(mass, energy, Ni56, windscalar, metallicity, HeFrac, csmtime, csmrate, csmvelo, CSMOptimize, ProgOptimize, GridTag)
-        
-        Simarr = np.append(Simarr, sim1)
-        
-        sim1.MakeSource()
-            
-        sim1.CreateSim()
-        logger.info(f"Created simulation with index {index}")
-        
-        # If CSM optimization is off:
-        if CSMOptimize != True:
-            # And if progenitor optimization is off, run PreCC.  Otherwise, skip it since we're optimizing with CSM or the progenitor
-            if ProgOptimize != True:
-                logger.info("------------- Running pre-core-collapse model -------------")
-                sim1.RunSim("PreCC")
-                logger.info("------------- Finished pre-core-collapse model -------------")
-        
-        if ProgOptimize == True:
-            logger.info("Progenitor optimization is true.  Skipping pre-CC modeling.")
-        logger.info("------------- Running post-core-collapse model -------------")
-        sim1.RunSim("PostCC")
-        logger.info("------------- Finished pre-core-collapse model -------------")
-    except Exception as err:
-        logger.error(f"An exception occured while running simulation with index {index}; Exception: {err}")
-    finally:
-        # Disable the alarm
-        signal.alarm(0)
-        del sim1
+    return Sim(mass, energy, Ni56, windscalar, metallicity, HeFrac, csmtime, csmrate, csmvelo, GridTag)
 
-logger.info("------------- Finished MESA simulations -------------")
-
-# Run the Stella sims in parallel
-results = []
-Executor = ProcessPoolExecutor
-
-logger.info("------------- Beginning Stella sl------------")
-
-with Executor(max_workers=NumThreads) as executor:
-    # Submit tasks for each instance
-    futures = {executor.submit(partial(sim.RunSim, "Stella")) for sim in Simarr}
-
-    for future in as_completed(futures):
-        try:
-            result = future.result()
-            logger.info("Finished Stella simulation")
-            results.append(result)
-        except Exception as E:
-            logger.info(f"Stella generated an exception: {E}")
-            logger.info("Continuing with next Stella simulation...")
-
-for sim in Simarr:
-    try:
-        sim.ExportData()
-    except Exception as err:
-        logger.info(f"Data exporting threw an exception: {err}")
+def SimlistRows():
+    """(index, row) of every sim the input asks for: the simlist's rows, or a sweep spec's, expanded one at a time
 
+    SimlistName ending in .toml or .json is a sweep spec, which is checked in full before the first row comes out.
+    A CSV simlist is read PlanAhead rows at a time, twice: once up front for each column's type over the whole
+    file, as reading it whole would give them, and then for its rows as they're needed, read as those types.
+    That keeps e.g. a mass column with a 12.5 anywhere in it giving 12.0 rather than 12 in every directory name.
+    """
+    global SimlistTypes
+    path = os.path.join(InputDir, SimlistName)
+    if SimlistName.endswith((".toml", ".json")):
+        return enumerate(Sweep.Expand(Sweep.Load(path)))
+    import pandas as pd
+    kinds = {}
+    for chunk in pd.read_csv(path, chunksize=PlanAhead):
+        for column, dtype in chunk.dtypes.items():
+            kinds.setdefault(column, set()).add(dtype)
+    # A column whose chunks disagree becomes float if they're all numbers, as pandas would make it, and text otherwise
+    types = {column: float if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in found) else str
+             for column, found in kinds.items() if len(found) > 1}
+    SimlistTypes = {column: types.get(column, next(iter(found))) for column, found in kinds.items()}
+    logger.info("Imported simlist")
+    return SimlistChunks(path, types)
 
-logger.info("------------- Finished Stella simulations.  Done! -------------")
+def SimlistChunks(path, types):
+    """(index, row) of every row of a CSV simlist, read PlanAhead rows at a time with the given column types"""
+    import pandas as pd
+    for chunk in pd.read_csv(path, chunksize=PlanAhead, dtype=types):
+        yield from chunk.iterrows()
 
+# How many rows, sims, progenitor builds and checkpointing PostCC runs have been planned, and the directories
+# the sims make, so a row that comes up again isn't run twice.  The directories are kept as sha256 digests,
+# which don't collide like hash() can; at 32 bytes each plus the set's overhead, they're the one thing
+# planning keeps for every row, so this grows with the grid, by some 100 bytes a row.
+Planned = {"rows": 0, "sims": 0, "progenitors": 0, "checkpointed": 0, "dirnames": set()}
 
+def Forget(jobs):
+    """Drops the entries of {key: job}, e.g. ProgBuilders, whose job has finished, so they only hold what's still to come
 
+    Later sims find what those jobs made in the caches instead.  Work queue jobs are ids, which are always kept.
+    """
+    for key in [key for key, job in jobs.items() if getattr(job, "finished", None) is not None]:
+        del jobs[key]
 
+def PlanRows(scheduler, rows, ProgBuilders, BuildJobs, CheckpointJobs):
+    """Sets up a Sim for each (index, row) of simlist-style parameters and queues its chain, yielding True after each row"""
+    for index, row in rows:
+        Planned["rows"] += 1
+        if Planned["rows"] % PlanAhead == 0:
+            Forget(ProgBuilders)
+            Forget(CheckpointJobs)
+        try:
+            sim1 = SimFromRow(row)
+            digest = hashlib.sha256(sim1.dirname.encode()).digest()
+            if digest in Planned["dirnames"]:
+                logger.warning(f"Skipping simulation with index {index}, since an earlier row already makes {sim1.dirname}")
+            else:
+                Planned["dirnames"].add(digest)
+                Planned["sims"] += 1
+                BuildChain(scheduler, sim1, index, ProgBuilders, BuildJobs, CheckpointJobs)
+        except Exception as err:
+            logger.error(f"An exception occured while setting up simulation with index {index}; Exception: {err}")
+        yield True
 
+def QueueRows(scheduler, rows, ProgBuilders, BuildJobs, CheckpointJobs):
+    """Plans every row at once; returns how many sims they make"""
+    before = Planned["sims"]
+    for _ in PlanRows(scheduler, rows, ProgBuilders, BuildJobs, CheckpointJobs):
+        pass
+    return Planned["sims"] - before
 
+def BuildGrids():
+    """Consolidates each grid into one memory-mapped array for analysis; returns {gridtag: path}"""
+    from MesaStella import LightCurveGrid
+    Grids = {}
+    for gridtag, store in ExportStores.items():
+        try:
+            Grids[gridtag] = LightCurveGrid.Build(store, os.path.join(DataDir, str(gridtag), "grid"), ResampleStep)
+        except Exception as err:
+            logger.error(f"Couldn't build the light curve grid for '{gridtag}': {err}")
+            continue
+        # Models exported before their features were, e.g. by an older version, are caught up from the grid
+        if FeatureIndexing and Grids[gridtag] is not None:
+            from MesaStella import FeatureIndex
+            try:
+                FeatureIndex.Update(GridFeatures(gridtag), Grids[gridtag], FeatureBands)
+            except Exception as err:
+                logger.error(f"Couldn't bring the feature index of '{gridtag}' up to date: {err}")
+    return Grids
 
+def FitGrids(Grids):
+    """Fits every grid to the observed light curve and ranks its models; returns {gridtag: ranked table}"""
+    Fits = {}
+    if not FitPhotometry:
+        return Fits
+    import numpy as np
+    from MesaStella import Fitting
+    Shifts = np.arange(FitShifts[0], FitShifts[1] + 1e-9, FitShifts[2])
+    try:
+        Observed = Fitting.LoadPhotometry(os.path.join(InputDir, FitPhotometry))
+        for gridtag, gridpath in Grids.items():
+            if gridpath is None:
+                continue
+            Ranked = Fitting.Fit(gridpath, Observed, Shifts, FitMu, FitEBV, FitPenalty, FitWorkers)
+            Ranked.to_csv(os.path.join(DataDir, str(gridtag), f"Fit_{Observed['name']}.csv"))
+            Fits[gridtag] = Ranked
+            Best = Ranked.iloc[0]
+            logger.info(f"Best fit to {Observed['name']} in '{gridtag}': {Best['dirname']} with reduced chi2 {Best['redchi2']:.2f}, "
+                        f"explosion {Best['shift']:.2f} days before the first point, mu = {Best['mu']:.2f}, E(B-V) = {Best['ebv']:.3f}")
+    except Exception as err:
+        logger.error(f"Couldn't fit the grids to '{FitPhotometry}': {err}")
+    return Fits
 
+def SimlistRow(params, gridtag):
+    """Turns a grid's parameters back into a simlist row"""
+    import pandas as pd
+    row = {
+        "mass": params["mass"], "energy": params["energy"], "ni56": params["ni56"], "metallicity": params["metallicity"],
+        "hefrac": params["HeFrac"], "windscalar": params["windscalar"], "csmvelo": params["csmvelo"], "csmrate": params["csmrate"],
+        "csmtime": params["csmtime"], "gridtag": gridtag,
+    }
+    # Whole numbers stay whole where the simlist has them that way, so directory names match the simlist's sims
+    for column, value in row.items():
+        if column in SimlistTypes and pd.api.types.is_integer_dtype(SimlistTypes[column]) and float(value).is_integer():
+            row[column] = int(value)
+    return row
 
+def RefineGrids(scheduler, Grids, Fits, NextIndex, ProgBuilders, BuildJobs, CheckpointJobs):
+    """Keeps adding batches of sims where the grids need them most until every refiner stops; returns the last grids and fits"""
+    from MesaStella import LightCurveGrid
+    from MesaStella import Refine
+    Refiners = {gridtag: Refine.Refiner(os.path.join(DataDir, str(gridtag), "Refinement.jsonl"), RefineMode, RefineBands, RefineBatch,
+                                        RefineMaxSims, RefineMaxIterations, RefineTolerance, RefineMinSpacing) for gridtag in Grids}
+    while True:
+        Rows = []
+        for gridtag, gridpath in Grids.items():
+            if gridpath is None or gridtag not in Refiners:
+                continue
+            try:
+                Proposals = Refiners[gridtag].Propose(LightCurveGrid.LightCurveGrid(gridpath), Fits.get(gridtag))
+            except Exception as err:
+                logger.error(f"Couldn't refine '{gridtag}': {err}")
+                del Refiners[gridtag]
+                continue
+            Rows += [SimlistRow(params, gridtag) for params in Proposals]
+        if not Rows:
+            return Grids, Fits
+        
+        logger.info(f"------------- Running {len(Rows)} refinement simulations -------------")
+        if isinstance(scheduler, WorkQueue.WorkQueue):
+            QueueRows(scheduler, enumerate(Rows, NextIndex), ProgBuilders, BuildJobs, CheckpointJobs)
+            scheduler.Run()
+        else:
+            scheduler.Run(partial(next, PlanRows(scheduler, enumerate(Rows, NextIndex), ProgBuilders, BuildJobs, CheckpointJobs), False), PlanAhead)
+        NextIndex += len(Rows)
+        Progress.Dump()
+        
+        Grids = BuildGrids()
+        Fits = FitGrids(Grids)
 
+def BuildEmulators(Grids):
+    """Trains an emulator on each grid, to predict light curves between its models, and checks it against every model left out in turn"""
+    from MesaStella import Emulator
+    for gridtag, gridpath in Grids.items():
+        if gridpath is None:
+            continue
+        try:
+            Report = Emulator.Build(gridpath, os.path.join(DataDir, str(gridtag), "emulator.npz"), EmulatorVariance, lengthscale=EmulatorLengthScale)
+            Report.to_csv(os.path.join(DataDir, str(gridtag), "EmulatorValidation.csv"), index=False)
+        except ValueError as err:
+            logger.warning(f"No emulator for '{gridtag}': {err}")
+        except Exception as err:
+            logger.error(f"Couldn't build the emulator for '{gridtag}': {err}")
 
+def Summarize(scheduler, distributed):
+    """Logs where the time went and writes it to Logs/Telemetry.txt, across the workers too, since they write their telemetry next to ours"""
+    TelemetryFiles = [os.path.join(LogDir, "Telemetry.jsonl")]
+    WorkerLogs = os.path.join("Logs", "Workers")
+    if distributed and os.path.isdir(WorkerLogs):
+        TelemetryFiles += [os.path.join(WorkerLogs, name, "Telemetry.jsonl") for name in os.listdir(WorkerLogs)]
+    Summary = Telemetry.Report(Telemetry.Load(TelemetryFiles, RunStarted), scheduler.Graph(), None if distributed else CoreBudget)
+    with open(os.path.join(LogDir, "Telemetry.txt"), "w") as file:
+        file.write(Summary + "\n")
+    logger.info(f"Run summary, also in '{os.path.join(LogDir, 'Telemetry.txt')}':\n{Summary}")
 
+# {column: type} of the simlist being run, which SimlistRow follows
+SimlistTypes = {}
 
+def main(argv=None):
+    """Runs the simlist's grid here, queues it for workers, or works as one of them, as the command line says"""
+    Args = ParseArgs(argv)
+    Distributed = Args.mode == "coordinate"
+    QueuePath = Args.queue or QueueDir
+    Setup(Args.mode, Args.cores if Args.mode == "worker" else None)
+    
+    # Workers only run the stages a coordinator queued, on whichever host they're started
+    if Args.mode == "worker":
+        WorkQueue.Worker(WorkQueue.WorkQueue(QueuePath), RunStage, Args.cores or CoreBudget, WorkerName, QueuePoll,
+                         ScratchGate if Scratch is not None else None, WorkerShape if Tuner is not None else None).Run()
+        Progress.Dump()
+        if Scratch is not None:
+            Scratch.Close()
+        return
+    
+    # The simlist, or the rows of a sweep spec, which are only made as they're needed
+    Rows = SimlistRows()
+    
+    # Slim down sims an earlier run finished, e.g. to move an old grid to a leaner policy
+    if Args.mode == "compact":
+        for index, row in Rows:
+            sim = SimFromRow(row)
+            if os.path.isdir(sim.simdir) and Manifest.IsDone(sim.dirname, sim.paramhash, "ExportData"):
+                sim.Retain(Args.policy)
+        return
+    
+    if Distributed:
+        scheduler = WorkQueue.WorkQueue(QueuePath)
+        scheduler.Open(QueueLease, QueueAttempts)
+    else:
+        scheduler = StageScheduler(CoreBudget)
+        if Scratch is not None:
+            # Held back sims are looked at again as soon as one leaves scratch
+            Scratch.onfree = scheduler.Wake
+        # Sims waiting to branch off a checkpoint are looked at again as soon as it's cached
+        CheckpointCache.onpublish = scheduler.Wake
+    ProgBuilders = {}
+    BuildJobs = {}
+    CheckpointJobs = {}
+    
+    # The coordinator queues every sim up front for the workers.  Here they're planned as the scheduler runs
+    # low on work, so however big the grid, only the next PlanAhead stages are held at a time.
+    if Distributed:
+        QueueRows(scheduler, Rows, ProgBuilders, BuildJobs, CheckpointJobs)
+        logger.info(f"------------- Queued {Planned['sims']} simulations in '{QueuePath}'; start workers with 'python MesaStellaCore.py worker' -------------")
+        scheduler.Run()
+    else:
+        logger.info(f"------------- Running simulations on a budget of {CoreBudget} cores -------------")
+        scheduler.Run(partial(next, PlanRows(scheduler, Rows, ProgBuilders, BuildJobs, CheckpointJobs), False), PlanAhead)
+    logger.info(f"{Planned['progenitors']} unique progenitor(s) and {Planned['checkpointed']} post-core-collapse run(s) making checkpoints across {Planned['sims']} simulations")
+    Progress.Dump()
+    
+    Grids = BuildGrids()
+    Fits = FitGrids(Grids)
+    
+    # In refinement mode the simlist is only the first, coarse batch; later ones go where the grid needs them most
+    if RefineEnabled:
+        Grids, Fits = RefineGrids(scheduler, Grids, Fits, Planned["rows"], ProgBuilders, BuildJobs, CheckpointJobs)
+    
+    if BuildEmulator:
+        BuildEmulators(Grids)
+    
+    # Let the workers go
+    if Distributed:
+        scheduler.Close()
+    if Scratch is not None:
+        Scratch.Close()
+    
+    Summarize(scheduler, Distributed)
+    
+    logger.info("------------- Finished simulations.  Done! -------------")
 
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,14 @@ scripts=(
     rn
 )
 
+# Skip make when MesaStellaCore.py has linked in a star executable from its build cache
+if [ -n "$MESA_STELLA_PREBUILT" ] && [ -x star ]; then
+    echo "Using prebuilt star executable"
+    scripts=(
+        rn
+    )
+fi
+
 # Run
 for script in "${scripts[@]}"; do
     if [ -x "$script" ]; then